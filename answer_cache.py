@@ -0,0 +1,125 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from settings import get_setting
+
+
+class AnswerCache:
+    """
+    Cache persistente (SQLite) das respostas do OportuneRAG, endereçado pelo conteúdo.
+
+    A chave é um hash de tudo o que determina a resposta (prompt, passagens recuperadas, LM e
+    seus parâmetros, hash do modelo compilado). Entradas expiram após `ttl_segundos` e, acima de
+    `max_entradas`, as menos acessadas recentemente são removidas.
+    """
+
+    def __init__(self, caminho, max_entradas=5000, ttl_segundos=7 * 24 * 3600):
+        self.caminho = caminho
+        self.max_entradas = max_entradas
+        self.ttl_segundos = ttl_segundos
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        pasta = os.path.dirname(caminho)
+        if pasta:
+            os.makedirs(pasta, exist_ok=True)
+        self._conn = sqlite3.connect(caminho, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS respostas (
+                chave TEXT PRIMARY KEY,
+                valor TEXT NOT NULL,
+                criado REAL NOT NULL,
+                acessado REAL NOT NULL
+            )"""
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_respostas_acessado ON respostas (acessado)")
+        self._conn.commit()
+
+    @staticmethod
+    def make_key(**partes):
+        """Gera a chave a partir das partes nomeadas (serializadas de forma canônica)."""
+        conteudo = json.dumps(partes, sort_keys=True, ensure_ascii=False, default=str)
+        return hashlib.sha256(conteudo.encode("utf-8")).hexdigest()
+
+    def get(self, chave):
+        """Retorna o valor armazenado ou None (miss ou entrada expirada)."""
+        agora = time.time()
+        with self._lock:
+            linha = self._conn.execute(
+                "SELECT valor, criado FROM respostas WHERE chave = ?", (chave,)
+            ).fetchone()
+            if linha is None or agora - linha[1] > self.ttl_segundos:
+                if linha is not None:
+                    self._conn.execute("DELETE FROM respostas WHERE chave = ?", (chave,))
+                    self._conn.commit()
+                self.misses += 1
+                return None
+            self._conn.execute("UPDATE respostas SET acessado = ? WHERE chave = ?", (agora, chave))
+            self._conn.commit()
+            self.hits += 1
+        return json.loads(linha[0])
+
+    def put(self, chave, valor):
+        """Armazena um valor serializável em JSON e aplica as regras de expiração/tamanho."""
+        agora = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO respostas (chave, valor, criado, acessado) VALUES (?, ?, ?, ?)",
+                (chave, json.dumps(valor, ensure_ascii=False), agora, agora),
+            )
+            self._evict(agora)
+            self._conn.commit()
+
+    def _evict(self, agora):
+        self._conn.execute("DELETE FROM respostas WHERE criado < ?", (agora - self.ttl_segundos,))
+        excedente = self._conn.execute("SELECT COUNT(*) FROM respostas").fetchone()[0] - self.max_entradas
+        if excedente > 0:
+            self._conn.execute(
+                "DELETE FROM respostas WHERE chave IN "
+                "(SELECT chave FROM respostas ORDER BY acessado ASC LIMIT ?)",
+                (excedente,),
+            )
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM respostas")
+            self._conn.commit()
+
+    def stats(self):
+        with self._lock:
+            entradas = self._conn.execute("SELECT COUNT(*) FROM respostas").fetchone()[0]
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "entradas": entradas,
+        }
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_answer_cache():
+    """Retorna o cache de respostas do processo, ou None se desabilitado (ANSWER_CACHE_ENABLED)."""
+    global _cache
+    if not get_setting("ANSWER_CACHE_ENABLED", True):
+        return None
+    with _cache_lock:
+        if _cache is None:
+            _cache = AnswerCache(
+                get_setting("ANSWER_CACHE_PATH", os.path.join(".cache", "respostas.sqlite")),
+                max_entradas=get_setting("ANSWER_CACHE_MAX_ENTRIES", 5000),
+                ttl_segundos=get_setting("ANSWER_CACHE_TTL_SECONDS", 7 * 24 * 3600),
+            )
+        return _cache
@@ -1,52 +1,93 @@
+import time
+_inicio_rerun = time.perf_counter()
+
 import streamlit as st
 import base64
+import logging
 from pathlib import Path
 import os
 from dotenv import load_dotenv
-from process import run_agent_analysis
-import pandas as pd
-from io import BytesIO
-import time
-import streamlit as st
+# A pilha de IA (process → dspy, weaviate, langchain) só é importada pela fila de jobs na primeira análise
+from job_queue import CONCLUIDO, ERRO, PENDENTE, get_job_queue
+from result_store import ResultStore
+from settings import get_setting
+from tracing import resumir_trace, spans_do_trace
 
 load_dotenv()
 api_key = st.secrets["OPENAI_API_KEY"]
+logger = logging.getLogger(__name__)
 
-all_resultados=[]
+# Bytes de HTML/CSS inline enviados neste rerun (o script inteiro é reexecutado a cada rerun)
+_payload_rerun = {"bytes": 0}
 
 if 'direcionadores' not in st.session_state:
     st.session_state.direcionadores = []
 
+def markdown_html(html):
+    """st.markdown com HTML liberado, contabilizando o tamanho enviado no rerun."""
+    _payload_rerun["bytes"] += len(html.encode("utf-8"))
+    st.markdown(html, unsafe_allow_html=True)
+
+@st.cache_resource
+def metricas_processo():
+    """Métricas que vivem enquanto o processo do Streamlit estiver de pé (ex.: tempo do primeiro rerun)."""
+    return {"startup_s": None}
+
 def stylable_container(key, css_styles):
-    st.markdown(f"""
+    markdown_html(f"""
         <style>
         div[data-testid="stHorizontalBlock"] > div:nth-child({key}) {{
             {css_styles}
         }}
         </style>
-    """, unsafe_allow_html=True)
+    """)
     return st.container()
 
-def add_bg_from_local(image_file):
+@st.cache_resource
+def _imagem_base64(image_file):
     with Path(image_file).open("rb") as file:
-        encoded_string = base64.b64encode(file.read()).decode()
-    st.markdown(
+        return base64.b64encode(file.read()).decode()
+
+@st.cache_resource
+def _ler_css(css_file):
+    with open(css_file, "r") as f:
+        return f.read()
+
+def add_bg_from_local(image_file):
+    # Com server.enableStaticServing (.streamlit/config.toml), a imagem em ./static é servida por URL;
+    # sem ele, o base64 é gerado uma vez por processo em vez de a cada rerun.
+    if st.get_option("server.enableStaticServing") and Path(image_file).parts[0] == "static":
+        url = f"app/{Path(image_file).as_posix()}"
+    else:
+        url = f"data:image/png;base64,{_imagem_base64(image_file)}"
+    markdown_html(
         f"""
         <style>
         .stApp {{
-            background-image: url(data:image/png;base64,{encoded_string});
+            background-image: url({url});
             background-size: cover;
             background-position: center;
             background-repeat: no-repeat;
         }}
         </style>
-        """,
-        unsafe_allow_html=True
+        """
     )
 
 def load_css(css_file):
-    with open(css_file, "r") as f:
-        st.markdown(f"<style>{f.read()}</style>", unsafe_allow_html=True)
+    markdown_html(f"<style>{_ler_css(css_file)}</style>")
+
+def render_metricas_rerun():
+    """Registra o tempo do primeiro rerun do processo e, com SHOW_APP_METRICS, mostra as métricas na barra lateral."""
+    duracao = time.perf_counter() - _inicio_rerun
+    metricas = metricas_processo()
+    if metricas["startup_s"] is None:
+        metricas["startup_s"] = duracao
+        logger.info("Startup do app: %.2fs", duracao)
+    if get_setting("SHOW_APP_METRICS", False):
+        st.sidebar.caption(
+            f"Startup: {metricas['startup_s']:.2f}s · Rerun: {duracao * 1000:.0f} ms · "
+            f"HTML/CSS inline: {_payload_rerun['bytes'] / 1024:.1f} KB"
+        )
 
 def get_button_style(button_class):
     if button_class == "current":
@@ -67,17 +108,17 @@ def setup_navigation():
     for i, page in enumerate(pages):
         button_class = "current" if i == st.session_state.current_page else "previous" if i == st.session_state.current_page - 1 else ""
 
-        if st.sidebar.button(page, key=f"nav_{i}", use_container_width=True, disabled=(i == st.session_state.current_page)):
+        if st.sidebar.button(page, key=f"nav_{i}", width="stretch", disabled=(i == st.session_state.current_page)):
             st.session_state.current_page = i
             st.rerun()
 
-        st.markdown(f"""
+        markdown_html(f"""
             <style>
             div.row-widget.stButton > button[key="nav_{i}"] {{
                 {get_button_style(button_class)}
             }}
             </style>
-            """, unsafe_allow_html=True)
+            """)
 
     return pages
 
@@ -91,15 +132,103 @@ def remove_direcionador(direcionador_to_remove):
     if direcionador_to_remove in st.session_state.direcionadores:
         st.session_state.direcionadores.remove(direcionador_to_remove)
 
-def convert_df_to_excel(df):
-    output = BytesIO()
-    with pd.ExcelWriter(output, engine='openpyxl') as writer:
-        df.to_excel(writer, sheet_name='Oportunidade de melhorias', index=False)
-        for column in df:
-            column_width = max(df[column].astype(str).map(len).max(), len(column))
-            col_idx = df.columns.get_loc(column)
-            writer.sheets['Oportunidade de melhorias'].column_dimensions[chr(65 + col_idx)].width = column_width + 2
-    return output.getvalue()
+def get_result_store():
+    """Armazenamento único dos resultados da sessão (visualização, edição e exportação)."""
+    if 'result_store' not in st.session_state:
+        st.session_state.result_store = ResultStore()
+    return st.session_state.result_store
+
+def render_download_excel(label, file_name, key):
+    # O Excel só é gerado quando o download é clicado (em outra thread, por isso nada de
+    # st.session_state dentro de gerar) e os bytes ficam guardados até a próxima versão dos resultados.
+    store = get_result_store()
+    versao = store.versao
+    cache = st.session_state.setdefault('excel_cache', {})
+
+    def gerar():
+        if cache.get('versao') != versao:
+            from excel_export import convert_df_to_excel
+
+            cache['bytes'] = convert_df_to_excel(store.to_frame())
+            cache['versao'] = versao
+        return cache['bytes']
+
+    st.download_button(
+        label=label,
+        data=gerar,
+        file_name=file_name,
+        mime='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+        key=key
+    )
+
+def render_cartao_oportunidade(registro):
+    return "\n\n".join(
+        f"**{campo}:** {valor}" for campo, valor in registro.items() if valor
+    ) + "\n\n---"
+
+def render_job(job_id):
+    """Mostra o estado de um job de diagnóstico: um painel por direcionador, com as oportunidades já recebidas."""
+    job = get_job_queue().get(job_id)
+    if job is None:
+        st.warning("Análise não encontrada.")
+        return None
+    if job["status"] == PENDENTE:
+        st.info(f"Análise na fila (posição {job['posicao']})...")
+        return job
+
+    estados = {"executando": "running", "concluido": "complete", "erro": "error"}
+    for item in job["progresso"].get("direcionadores", []):
+        direcao = item["direcionador"]
+        if item["status"] == "concluido":
+            label = f"{direcao}: {item['total']} oportunidades"
+        elif item["status"] == "erro":
+            label = f"{direcao}: falha na análise"
+        else:
+            label = f"{direcao}: {len(item['oportunidades'])} oportunidades recebidas..."
+        with st.status(label, state=estados[item["status"]], expanded=item["status"] == "executando"):
+            for registro in item["oportunidades"]:
+                st.markdown(render_cartao_oportunidade(registro))
+            if item["erro"]:
+                st.write(item["erro"])
+    if job["status"] == ERRO:
+        st.error(f"Falha na análise: {job['erro']}")
+    trace_id = job["progresso"].get("trace_id")
+    if trace_id and job["status"] in (CONCLUIDO, ERRO) and get_setting("SHOW_TRACE_PANEL", False):
+        render_painel_diagnostico(trace_id)
+    return job
+
+def render_painel_diagnostico(trace_id):
+    """Tempo, tokens e custo estimado por etapa do diagnóstico (spans do tracing.py)."""
+    spans = spans_do_trace(trace_id)
+    if not spans:
+        return
+    raiz = next((dados for dados in spans if dados["parent_id"] is None), None)
+    etapas = resumir_trace(spans)
+    with st.expander("Diagnóstico de desempenho"):
+        if raiz:
+            st.caption(
+                f"Total: {raiz['duracao_ms'] / 1000:.1f}s · "
+                f"{sum(etapa['tokens_prompt'] for etapa in etapas)} tokens de entrada · "
+                f"{sum(etapa['tokens_completion'] for etapa in etapas)} tokens de saída · "
+                f"US$ {sum(etapa['custo_usd'] for etapa in etapas):.4f}"
+            )
+        st.dataframe(etapas, hide_index=True)
+
+@st.fragment(run_every=1.0)
+def acompanhar_job(job_id):
+    """Atualiza o progresso do job a cada segundo e incorpora o resultado quando ele termina."""
+    job = render_job(job_id)
+    if job is None or job["status"] not in (CONCLUIDO, ERRO):
+        return
+
+    st.session_state.jobs_aplicados.add(job_id)
+    resultado = job["resultado"]
+    if resultado is not None and not resultado.empty:
+        get_result_store().append(resultado)
+        execution_time = time.time() - st.session_state.get('job_inicio', time.time())
+
+        st.session_state.job_mensagem = f"Oportunidade de melhorias obtidas para {resultado['Direcionador'].nunique()} direcionadores em {execution_time:.2f} segundos."
+    st.rerun()
 
 def render_diagnostico():
     if 'form_inputs' not in st.session_state:
@@ -111,8 +240,8 @@ def render_diagnostico():
             'causa': ''
         }
     
-    if 'all_resultados' not in st.session_state:
-        st.session_state.all_resultados = []
+    if 'jobs_aplicados' not in st.session_state:
+        st.session_state.jobs_aplicados = set()
         
     st.write("## Oportunidade de Melhoria")
 
@@ -168,6 +297,16 @@ def render_diagnostico():
             placeholder="Digite a causa"
         )
 
+        ignorar_cache = st.checkbox(
+            "Gerar novamente (ignorar respostas em cache)",
+            value=False
+        )
+
+        agrupar = st.checkbox(
+            "Gerar os direcionadores juntos (menos chamadas ao modelo, indicado para muitos direcionadores)",
+            value=get_setting("DIRECIONADORES_AGRUPADOS", False)
+        )
+
         submit_button = st.form_submit_button(label='Obter Oportunidade de melhorias')
 
         if submit_button:
@@ -180,137 +319,168 @@ def render_diagnostico():
             }
 
             if ramo_empresa and st.session_state.direcionadores and nome_processo and atividade and evento and causa:
-                with st.spinner('Oportunidade de melhorias em andamento...'):
-                    start_time = time.time()
-                    new_resultados = []
-                    
-                    if type(st.session_state.direcionadores) == str:
-                        direcao = st.session_state.direcionadores
-                        processo = f"""ramo_empresa: {ramo_empresa}, direcionadores: {direcao}, nome_do_processo: {nome_processo}, atividade: {atividade}, evento: {evento}, causa: {causa}"""
-                        analyst = run_agent_analysis(processo)
-                        analyst['Direcionador'] = direcao
-                        new_resultados.append(analyst)
-                    else:
-                        for direcao in st.session_state.direcionadores:
-                            processo = f"""ramo_empresa: {ramo_empresa}, direcionadores: {direcao}, nome_do_processo: {nome_processo}, atividade: {atividade}, evento: {evento}, causa: {causa}"""
-                            analyst = run_agent_analysis(processo)
-                            analyst['Direcionador'] = direcao
-                            new_resultados.append(analyst)
-                    
-                    if new_resultados:
-                        st.session_state.all_resultados.extend(new_resultados)
-                        resultados = pd.concat(st.session_state.all_resultados, ignore_index=True)
-                        execution_time = time.time() - start_time
-                        
-                        st.success(f"Oportunidade de melhorias obtidas para {len(st.session_state.direcionadores)} direcionadores em {execution_time:.2f} segundos.")
-                        
-                        st.session_state.resultados = resultados
-                        st.session_state.excel_file = convert_df_to_excel(resultados)
-                        st.session_state.show_download_button = True
+                direcionadores = st.session_state.direcionadores
+                if type(direcionadores) == str:
+                    direcionadores = [direcionadores]
+
+                # A análise roda nas threads da fila de jobs; a página só acompanha o progresso pelo ID
+                job_id = get_job_queue().submit("diagnostico", {
+                    "campos": st.session_state.form_inputs,
+                    "direcionadores": list(direcionadores),
+                    "usar_cache": not ignorar_cache,
+                    "agrupado": agrupar
+                })
+                st.session_state.job_id = job_id
+                st.session_state.job_inicio = time.time()
+                st.query_params["job"] = job_id
             else:
                 st.warning("Por favor, preencha todos os campos e adicione pelo menos um direcionador.")
 
-    if hasattr(st.session_state, 'show_download_button') and st.session_state.show_download_button:
-        st.download_button(
+    # Retoma o acompanhamento de um job após reconexão do navegador
+    if not st.session_state.get('job_id') and "job" in st.query_params:
+        st.session_state.job_id = st.query_params["job"]
+
+    job_id = st.session_state.get('job_id')
+    if job_id:
+        if job_id in st.session_state.jobs_aplicados:
+            render_job(job_id)
+        else:
+            acompanhar_job(job_id)
+
+    if st.session_state.get('job_mensagem'):
+        st.success(st.session_state.pop('job_mensagem'))
+
+    if len(get_result_store()):
+        render_download_excel(
             label="📥Baixar Excel",
-            data=st.session_state.excel_file,
             file_name='oportunidade_melhoria.xlsx',
-            mime='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+            key="download_diagnostico"
         )
 
 
 
 
+TAMANHO_PAGINA = 20
+COLUNAS_TEXTO_LONGO = ["Oportunidade de Melhoria", "Solução", "Backlog de Atividades", "Investimento", "Ganhos"]
+
+def alteracoes_pendentes():
+    """
+    Deltas ainda não aplicados (edições por ID de linha e IDs excluídos) da versão atual dos resultados.
+
+    'editadas'/'excluidas' já estão sobrepostos aos dados do editor; 'editor' guarda os do editor
+    montado, que ficam no estado do próprio widget até outro editor ser montado.
+    """
+    versao = get_result_store().versao
+    pendentes = st.session_state.get('alteracoes_pendentes')
+    if pendentes is None or pendentes['versao'] != versao:
+        pendentes = {'versao': versao, 'editadas': {}, 'excluidas': set(), 'editor': {'editadas': {}, 'excluidas': set()}}
+        st.session_state.alteracoes_pendentes = pendentes
+    return pendentes
+
+def consolidar_editor(pendentes):
+    """Passa os deltas do editor anterior para os que são sobrepostos aos dados do próximo editor."""
+    for row_id, campos in pendentes['editor']['editadas'].items():
+        pendentes['editadas'].setdefault(row_id, {}).update(campos)
+    pendentes['excluidas'] |= pendentes['editor']['excluidas']
+    pendentes['editor'] = {'editadas': {}, 'excluidas': set()}
+
+def todas_alteracoes(pendentes):
+    """Deltas consolidados mais os do editor montado: (editadas, excluidas)."""
+    editadas = {row_id: dict(campos) for row_id, campos in pendentes['editadas'].items()}
+    for row_id, campos in pendentes['editor']['editadas'].items():
+        editadas.setdefault(row_id, {}).update(campos)
+    return editadas, pendentes['excluidas'] | pendentes['editor']['excluidas']
+
+def registrar_delta(key, ids):
+    # Callback do editor: o estado do widget acumula as edições desde a montagem e as posições da
+    # página viram IDs estáveis do ResultStore. Os dados do editor não mudam a cada edição (mudariam a
+    # identidade do widget, que seria recriado e perderia a rolagem); só ao montar outro editor.
+    pendentes = alteracoes_pendentes()
+    estado = st.session_state[key]
+    pendentes['editor'] = {
+        'editadas': {ids[int(posicao)]: dict(campos) for posicao, campos in estado['edited_rows'].items()},
+        'excluidas': {ids[posicao] for posicao in estado['deleted_rows']},
+    }
+
 def render_planilha_final():
-    if 'resultados' not in st.session_state:
+    store = get_result_store()
+    if not len(store):
         st.warning("Não foi executado a obtenção das Oportunidade de melhorias.")
         return
-    
-    resultados = st.session_state.resultados
-    st.session_state.resultados_dict = resultados.to_dict('records')
+
+    pendentes = alteracoes_pendentes()
 
     st.write("## Planilha Final")
-    changes_made = False
-    deleted_indices = set()
 
-    for idx, row in enumerate(st.session_state.resultados_dict):
-        if idx in deleted_indices:  # Skip opportunities already marked for deletion
-            continue
-        
-        with st.form(key=f'opportunity_form_{idx}'):
-            st.write(f"### Oportunidade {idx + 1} - Direcionador: {row.get('Direcionador', 'N/A')}")
-            
-            oportunidade_de_melhoria = st.text_area(
-                "Oportunidade de Melhoria", 
-                value=row['Oportunidade de Melhoria'], 
-                height=100
-            )
-            solucao = st.text_area(
-                "Solução", 
-                value=row['Solução'], 
-                height=100
-            )
-            backlog_de_atividades = st.text_area(
-                "Backlog de Atividades", 
-                value=row.get('Backlog de Atividades', ''), 
-                height=100
-            )
-            investimento = st.text_area(
-                "Investimento", 
-                value=row.get('Investimento', ''), 
-                height=100
-            )
-            ganhos = st.text_area(
-                "Ganhos", 
-                value=row.get('Ganhos', ''), 
-                height=100
-            )
-            
-            col1, col2 = st.columns(2)
-            with col1:
-                save_button = st.form_submit_button(label=f"Salvar Edição para Oportunidade {idx + 1}")
-            with col2:
-                delete_button = st.form_submit_button(label=f"Excluir Oportunidade {idx + 1}", type="secondary")
-            
-            if save_button:
-                row.update({
-                    'Oportunidade de Melhoria': oportunidade_de_melhoria,
-                    'Solução': solucao,
-                    'Backlog de Atividades': backlog_de_atividades,
-                    'Investimento': investimento,
-                    'Ganhos': ganhos
-                })
-                changes_made = True
-                st.success(f"Edição salva para Oportunidade {idx + 1}")
-            
-            if delete_button:
-                deleted_indices.add(idx)
-                st.warning(f"Oportunidade {idx + 1} marcada para exclusão.")
-
-    if deleted_indices:
-        st.session_state.resultados_dict = [
-            row for idx, row in enumerate(st.session_state.resultados_dict) if idx not in deleted_indices
-        ]
-        changes_made = True
-
-    if changes_made:
-        edited_df = pd.DataFrame(st.session_state.resultados_dict)
-        st.session_state.resultados = edited_df
-        st.session_state.excel_file = convert_df_to_excel(edited_df)
-        st.session_state.show_download_button = True
-
-    if hasattr(st.session_state, 'show_download_button') and st.session_state.show_download_button:
-        st.download_button(
-            label="📥 Baixar Excel com Todas as Edições",
-            data=st.session_state.excel_file,
-            file_name='Oportunidade_de_melhorias_final.xlsx',
-            mime='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
-        )
+    total_paginas = max(1, -(-len(store) // TAMANHO_PAGINA))
+    if st.session_state.get('pagina_planilha', 1) > total_paginas:
+        st.session_state.pagina_planilha = total_paginas
+    pagina = st.number_input(
+        f"Página (de {total_paginas})", min_value=1, max_value=total_paginas, step=1, key='pagina_planilha'
+    )
+
+    key = f"editor_{pendentes['versao']}_{pagina}_{st.session_state.get('descartes', 0)}"
+    # O estado do widget só sobrevive se o mesmo editor foi desenhado no rerun anterior; senão ele é
+    # montado de novo (outra página ou volta à planilha) e os deltas do anterior entram nos dados
+    if pendentes.get('montado') != (key, st.session_state.reruns - 1):
+        consolidar_editor(pendentes)
+    pendentes['montado'] = (key, st.session_state.reruns)
+
+    # Só a página atual é montada e enviada ao navegador, já com os deltas pendentes sobrepostos
+    inicio = (pagina - 1) * TAMANHO_PAGINA
+    trecho = store.pagina(inicio, TAMANHO_PAGINA)
+    trecho = trecho[~trecho.index.isin(pendentes['excluidas'])]
+    for row_id in trecho.index.intersection(list(pendentes['editadas'])):
+        for coluna, valor in pendentes['editadas'][row_id].items():
+            trecho.at[row_id, coluna] = valor
+
+    column_config = {coluna: st.column_config.TextColumn(coluna, width="large") for coluna in COLUNAS_TEXTO_LONGO}
+    column_config['Direcionador'] = st.column_config.TextColumn("Direcionador", disabled=True)
+    st.data_editor(
+        trecho,
+        key=key,
+        on_change=registrar_delta,
+        args=(key, list(trecho.index)),
+        num_rows="delete",
+        hide_index=True,
+        column_config=column_config,
+        width="stretch"
+    )
+
+    editadas, excluidas = todas_alteracoes(pendentes)
+    total_editadas = len(set(editadas) - excluidas)
+    total_excluidas = len(excluidas)
+    if total_editadas or total_excluidas:
+        st.info(f"{total_editadas} oportunidades editadas e {total_excluidas} excluídas aguardando aplicação.")
+        col1, col2 = st.columns(2)
+        with col1:
+            if st.button("Aplicar Alterações", key="aplicar_alteracoes", type="primary"):
+                store.aplicar(editadas, excluidas)
+                st.rerun()
+        with col2:
+            if st.button("Descartar Alterações", key="descartar_alteracoes"):
+                del st.session_state.alteracoes_pendentes
+                # Nova chave: o editor é recriado sem as edições guardadas no estado do widget
+                st.session_state.descartes = st.session_state.get('descartes', 0) + 1
+                st.rerun()
+
+    stats = store.stats()
+    st.caption(
+        f"{stats['linhas']} oportunidades ({stats['linhas_excluidas']} excluídas) · "
+        f"{stats['bytes'] / 1024:.0f} KB em memória"
+    )
+
+    render_download_excel(
+        label="📥 Baixar Excel com Todas as Edições",
+        file_name='Oportunidade_de_melhorias_final.xlsx',
+        key="download_planilha_final"
+    )
 
 
 def main():
     st.set_page_config(page_title="Oportunidade de Melhoria", layout="wide")
-    add_bg_from_local('background.png')
+    st.session_state.reruns = st.session_state.get('reruns', 0) + 1
+    add_bg_from_local('static/background.png')
     load_css('style.css')
     
     pages = setup_navigation()
@@ -318,7 +488,7 @@ def main():
     
     col1, col2 = st.columns([3, 1])
     with col1:
-        st.markdown(f'<p class="big-font">{pages[st.session_state.current_page]}</p>', unsafe_allow_html=True)
+        markdown_html(f'<p class="big-font">{pages[st.session_state.current_page]}</p>')
     with col2:
         st.image('logo.png', width=200)
     
@@ -346,5 +516,7 @@ def main():
             if st.button("Finalizar", key="finish_button"):
                 st.success("Processo finalizado com sucesso!")
 
+    render_metricas_rerun()
+
 if __name__ == "__main__":
     main()
\ No newline at end of file
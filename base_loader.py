@@ -0,0 +1,91 @@
+import hashlib
+import json
+import os
+
+import pandas as pd
+
+from settings import get_setting
+
+
+renomear = {"EMPRESA": "EMPRESA",
+            "SEGMENTO DE MERCADO": "SEGMENTO_MERCADO",
+            "PROCESSO": "PROCESSO",
+            "ATIVIDADE RELACIONADA": "ATIVIDADE_RELACIONADA",
+            "TIPO DE MELHORIA": "MELHORIA_SUGERIDA",
+            "DESCONEXÕES (GAP)": "GAPS",
+            "CAUSA": "CAUSA",
+            "MELHORIA/SOLUÇÃO": "SOLUCAO",
+            "GANHOS/OBJETIVO": "GANHOS"
+}
+
+COLUNAS_BASE = list(renomear.values())
+
+
+def texto_combinado(row):
+    """Texto concatenado de uma linha da base, usado para gerar a embedding."""
+    return f"{row['MELHORIA_SUGERIDA']} {row['SEGMENTO_MERCADO']} {row['EMPRESA']} {row['PROCESSO']} {row['ATIVIDADE_RELACIONADA']} {row['GAPS']} {row['CAUSA']} {row['SOLUCAO']} {row['GANHOS']}"
+
+
+def ler_excel(caminho):
+    """Lê a planilha de oportunidades e aplica o mapeamento `renomear` às nove primeiras colunas."""
+    df_base = pd.read_excel(caminho, skiprows = 2, header = 1)
+    df_base = df_base.iloc[:, :9]
+    df_base = df_base.rename(columns=renomear)
+    return df_base.astype("string")
+
+
+def _sha256(caminho):
+    digest = hashlib.sha256()
+    with open(caminho, "rb") as f:
+        for bloco in iter(lambda: f.read(1 << 20), b""):
+            digest.update(bloco)
+    return digest.hexdigest()
+
+
+def carregar_base(caminho='Base.xlsx', pasta_cache=None):
+    """
+    Carrega a base de oportunidades a partir de um cache Parquet, gerado a partir do Excel no primeiro uso.
+
+    O cache é refeito automaticamente quando o arquivo de origem muda: o mtime/tamanho é conferido a
+    cada chamada e, se diferir, o SHA-256 decide se o conteúdo realmente mudou. Sem pyarrow, lê o
+    Excel diretamente.
+
+    Parâmetros:
+    caminho (str): Planilha de origem.
+    pasta_cache (str, opcional): Pasta do cache (padrão: configuração BASE_CACHE_DIR ou .cache/base).
+
+    Retorna:
+    pandas.DataFrame: Nove colunas de `renomear`, tipadas como string.
+    """
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        return ler_excel(caminho)
+
+    pasta_cache = pasta_cache or get_setting("BASE_CACHE_DIR", os.path.join(".cache", "base"))
+    nome = os.path.splitext(os.path.basename(caminho))[0]
+    caminho_parquet = os.path.join(pasta_cache, f"{nome}.parquet")
+    caminho_meta = os.path.join(pasta_cache, f"{nome}.meta.json")
+
+    stat = os.stat(caminho)
+    meta = None
+    if os.path.exists(caminho_meta) and os.path.exists(caminho_parquet):
+        with open(caminho_meta, encoding="utf-8") as f:
+            meta = json.load(f)
+        if meta["mtime_ns"] == stat.st_mtime_ns and meta["tamanho"] == stat.st_size:
+            return pd.read_parquet(caminho_parquet)
+
+    sha = _sha256(caminho)
+    if meta is None or meta["sha256"] != sha:
+        df_base = ler_excel(caminho)
+        os.makedirs(pasta_cache, exist_ok=True)
+        temporario = f"{caminho_parquet}.{os.getpid()}.tmp"
+        df_base.to_parquet(temporario, index=False)
+        os.replace(temporario, caminho_parquet)
+    else:
+        # Só o mtime mudou (ex.: arquivo copiado de novo): o cache continua válido
+        df_base = pd.read_parquet(caminho_parquet)
+
+    with open(caminho_meta, "w", encoding="utf-8") as f:
+        json.dump({"mtime_ns": stat.st_mtime_ns, "tamanho": stat.st_size, "sha256": sha}, f)
+    return df_base
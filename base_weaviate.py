@@ -1,39 +1,34 @@
-import pandas as pd
-import openai
-import weaviate
+import argparse
+import hashlib
+import json
 import os
-import streamlit as st
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
+import weaviate
+import streamlit as st
+from tenacity import Retrying, stop_after_attempt, wait_exponential_jitter
+from tqdm import tqdm
 
-df_base = pd.read_excel('Base.xlsx', skiprows = 2, header = 1)
-df_base = df_base.iloc[:, :9]
+from base_loader import COLUNAS_BASE, carregar_base, texto_combinado
+from embeddings import EmbeddingCache, get_embedder
+from rate_limiter import INGESTAO, set_prioridade_padrao
+from settings import get_setting
 
-renomear = {"EMPRESA": "EMPRESA",
-            "SEGMENTO DE MERCADO": "SEGMENTO_MERCADO",
-            "PROCESSO": "PROCESSO",
-            "ATIVIDADE RELACIONADA": "ATIVIDADE_RELACIONADA",
-            "TIPO DE MELHORIA": "MELHORIA_SUGERIDA",
-            "DESCONEXÕES (GAP)": "GAPS",
-            "CAUSA": "CAUSA",
-            "MELHORIA/SOLUÇÃO": "SOLUCAO",
-            "GANHOS/OBJETIVO": "GANHOS"
-}
 
-df_base = df_base.rename(columns=renomear)
+# Namespace fixo: o mesmo conteúdo gera sempre o mesmo UUID de objeto
+NAMESPACE_OPORTUNIDADES = uuid.UUID("6f1c2a4e-8d3b-5e7f-9a10-4b2c6d8e0f13")
 
-# Configuração da API OpenAI
-openai.api_key = st.secrets["OPENAI_API_KEY"]
+def hash_linha(registro):
+    """Hash de conteúdo das nove colunas renomeadas (EMPRESA … GANHOS) de uma linha."""
+    valores = [str(registro[coluna]) for coluna in COLUNAS_BASE]
+    return hashlib.sha256(json.dumps(valores, ensure_ascii=False).encode("utf-8")).hexdigest()
 
-# Conexão com o Weaviate
-client = weaviate.Client(
-    url=st.secrets["WEAVIATE_URL"],
-    auth_client_secret=weaviate.AuthApiKey(
-        api_key=st.secrets["WEAVIATE_API_KEY"] 
-    ),
-    additional_headers={
-        "X-OpenAI-Api-Key": openai.api_key,  
-    }
-)
+def id_linha(hash_conteudo):
+    """UUID determinístico do objeto no Weaviate para uma linha da base."""
+    return str(uuid.uuid5(NAMESPACE_OPORTUNIDADES, hash_conteudo))
 
 schema = {
     "classes": [
@@ -56,42 +51,224 @@ schema = {
     ]
 }
 
-# Verifica se o schema já existe
-if not client.schema.contains({'classes': [{'class': 'DocsOportunidades'}]}):
-    client.schema.create(schema)
-
-# Função para gerar embeddings com OpenAI
-def generate_embedding(text):
-    if not text:  # Garantir que o texto não seja vazio
-        return None
-    response = openai.embeddings.create(
-        model="text-embedding-ada-002",  # Modelo de embeddings
-        input=text
-    )
-    return response['data'][0]['embedding']
-
-# Iterar sobre as linhas do DataFrame df_base e processar os dados
-for _, row in df_base.iterrows():
-    # Criar uma string concatenada para gerar embedding
-    combined_text = f"{row['MELHORIA_SUGERIDA']} {row['SEGMENTO_MERCADO']} {row['EMPRESA']} {row['PROCESSO']} {row['ATIVIDADE_RELACIONADA']} {row['GAPS']} {row['CAUSA']} {row['SOLUCAO']} {row['GANHOS']}"
-    embedding = generate_embedding(combined_text)
-
-    if embedding:  # Verificar se a embedding foi gerada corretamente
-        # Adicionar ao Weaviate
-        client.data_object.create(
-            class_name="DocsOportunidades",
-            properties={
-                "EMPRESA": row['EMPRESA'],
-                "SEGMENTO_MERCADO": row['SEGMENTO_MERCADO'],
-                "PROCESSO": row['PROCESSO'],
-                "ATIVIDADE_RELACIONADA": row['ATIVIDADE_RELACIONADA'],
-                "MELHORIA_SUGERIDA": row['MELHORIA_SUGERIDA'],
-                "GAPS": row['GAPS'],
-                "CAUSA": row['CAUSA'],
-                "SOLUCAO": row['SOLUCAO'],
-                "GANHOS": row['GANHOS']
-            },
-            vector=embedding  # Adiciona o embedding gerado
+
+class WeaviateStore:
+    """Destino Weaviate Cloud: grava os objetos com a API de inserção em lote (insert_many)."""
+
+    def __init__(self, nome_colecao="DocsOportunidades"):
+        self.client = weaviate.connect_to_weaviate_cloud(
+            cluster_url=st.secrets["WEAVIATE_URL"],
+            auth_credentials=weaviate.auth.AuthApiKey(st.secrets["WEAVIATE_API_KEY"]),
+            headers={"X-OpenAI-Api-Key": st.secrets["OPENAI_API_KEY"]},
         )
+        # Verifica se o schema já existe
+        if not self.client.collections.exists(nome_colecao):
+            self.client.collections.create_from_dict(schema["classes"][0])
+        self.colecao = self.client.collections.get(nome_colecao)
+
+    def inserir(self, objetos):
+        from weaviate.classes.data import DataObject
+
+        resultado = self.colecao.data.insert_many([
+            DataObject(properties=objeto["propriedades"], vector=objeto["vetor"], uuid=objeto["uuid"])
+            for objeto in objetos
+        ])
+        if resultado.errors:
+            primeiro = next(iter(resultado.errors.values()))
+            raise RuntimeError(f"{len(resultado.errors)} objetos rejeitados pelo Weaviate: {primeiro.message}")
+
+    def ids(self):
+        """UUIDs de todos os objetos já gravados na coleção."""
+        return {str(objeto.uuid) for objeto in self.colecao.iterator(return_properties=["EMPRESA"])}
+
+    def remover(self, ids):
+        from weaviate.classes.query import Filter
+
+        ids = list(ids)
+        for inicio in range(0, len(ids), 1000):
+            self.colecao.data.delete_many(where=Filter.by_id().contains_any(ids[inicio:inicio + 1000]))
+
+    def close(self):
+        self.client.close()
+
+
+class MemoryStore:
+    """Destino em memória, para benchmarks e testes da ingestão sem rede."""
+
+    def __init__(self, latencia=0.0):
+        self.latencia = latencia
+        self.objetos = {}
+        self._lock = threading.Lock()
+
+    def inserir(self, objetos):
+        if self.latencia:
+            time.sleep(self.latencia)
+        with self._lock:
+            self.objetos.update((objeto["uuid"], objeto) for objeto in objetos)
+
+    def ids(self):
+        with self._lock:
+            return set(self.objetos)
+
+    def remover(self, ids):
+        with self._lock:
+            for id_objeto in ids:
+                self.objetos.pop(id_objeto, None)
+
+    def close(self):
+        pass
+
+
+def _com_retry(funcao, *args, tentativas=5):
+    """Executa `funcao` com backoff exponencial com jitter entre as tentativas."""
+    for tentativa in Retrying(
+        stop=stop_after_attempt(tentativas),
+        wait=wait_exponential_jitter(initial=1, max=30),
+        reraise=True,
+    ):
+        with tentativa:
+            return funcao(*args)
+
+
+def ingerir(df_base, embedder, store, tamanho_lote=100, concorrencia=4, tentativas=5, progresso=True,
+            cache_embeddings=None):
+    """
+    Gera as embeddings em lote e grava as linhas da base no `store`, com lotes processados em paralelo.
+
+    Parâmetros:
+    df_base (pandas.DataFrame): Base com as colunas de `renomear` (ver base_loader.carregar_base).
+    embedder: Objeto com `embed(textos)` (ver embeddings.py).
+    store: Destino com `inserir(objetos)` (WeaviateStore ou MemoryStore).
+    tamanho_lote (int): Linhas por requisição de embeddings e por inserção em lote.
+    concorrencia (int): Lotes processados simultaneamente.
+    tentativas (int): Tentativas de gravação de cada lote no `store` antes de desistir.
+    cache_embeddings (EmbeddingCache, opcional): Reaproveita vetores de linhas já vistas.
+
+    Retorna:
+    dict: linhas gravadas, embeddings geradas, lotes com falha, duração (s) e vazão (linhas/s).
+    """
+    registros = df_base[COLUNAS_BASE].fillna("").astype(str).to_dict("records")
+    lotes = [registros[inicio:inicio + tamanho_lote] for inicio in range(0, len(registros), tamanho_lote)]
+    contagem = {"embeddings": 0}
+    lock_contagem = threading.Lock()
+
+    def processar(lote):
+        hashes = [hash_linha(registro) for registro in lote]
+        vetores = cache_embeddings.get_many(hashes, embedder.nome) if cache_embeddings else {}
+        faltantes = [(chave, registro) for chave, registro in zip(hashes, lote) if chave not in vetores]
+        if faltantes:
+            # Sem retry aqui: o OpenAIEmbedder já repete os erros transitórios pelo RateLimiter
+            novos = embedder.embed([texto_combinado(registro) for _, registro in faltantes])
+            novos = list(zip([chave for chave, _ in faltantes], novos))
+            vetores.update(novos)
+            if cache_embeddings:
+                cache_embeddings.put_many(novos, embedder.nome)
+            with lock_contagem:
+                contagem["embeddings"] += len(novos)
+        objetos = [
+            {"uuid": id_linha(chave), "propriedades": registro, "vetor": [float(valor) for valor in vetores[chave]]}
+            for chave, registro in zip(hashes, lote)
+        ]
+        _com_retry(store.inserir, objetos, tentativas=tentativas)
+        return len(lote)
+
+    inicio = time.perf_counter()
+    gravadas, falhas = 0, 0
+    with ThreadPoolExecutor(max_workers=concorrencia) as executor, \
+            tqdm(total=len(registros), unit="linhas", disable=not progresso) as barra:
+        futures = [executor.submit(processar, lote) for lote in lotes]
+        for future in as_completed(futures):
+            try:
+                quantidade = future.result()
+                gravadas += quantidade
+                barra.update(quantidade)
+            except Exception as e:
+                falhas += 1
+                print(f"ERRO NA INGESTÃO DE LOTE: {e}")
+    duracao = time.perf_counter() - inicio
+    return {
+        "linhas": gravadas,
+        "embeddings": contagem["embeddings"],
+        "lotes_com_falha": falhas,
+        "duracao_s": duracao,
+        "linhas_por_s": gravadas / duracao if duracao else 0.0,
+    }
+
+def sincronizar(df_base, embedder, store, cache_embeddings=None, **kwargs):
+    """
+    Sincronização incremental e idempotente: grava só as linhas novas ou alteradas e remove do
+    `store` os objetos cujas linhas sumiram da base (ou mudaram de conteúdo).
+
+    Os IDs dos objetos derivam do hash de conteúdo da linha, então rodar duas vezes sobre a mesma
+    planilha não gera duplicatas. `kwargs` são repassados para ingerir.
+
+    Retorna:
+    dict: relatório de ingerir acrescido de `novas`, `removidas` e `inalteradas`.
+    """
+    registros = df_base[COLUNAS_BASE].fillna("").astype(str)
+    ids_desejados = registros.apply(lambda registro: id_linha(hash_linha(registro)), axis=1)
+    # Linhas duplicadas na planilha viram um único objeto
+    registros = registros[~ids_desejados.duplicated()]
+    ids_desejados = ids_desejados[~ids_desejados.duplicated()]
+
+    existentes = store.ids()
+    novas = registros[~ids_desejados.isin(existentes)]
+    obsoletos = existentes - set(ids_desejados)
+
+    relatorio = ingerir(novas, embedder, store, cache_embeddings=cache_embeddings, **kwargs)
+    if obsoletos:
+        _com_retry(store.remover, obsoletos, tentativas=kwargs.get("tentativas", 5))
+    relatorio.update({
+        "novas": len(novas),
+        "removidas": len(obsoletos),
+        "inalteradas": len(registros) - len(novas),
+    })
+    return relatorio
+
+def main():
+    parser = argparse.ArgumentParser(description="Ingestão da Base.xlsx na coleção DocsOportunidades")
+    parser.add_argument("--base", default="Base.xlsx")
+    parser.add_argument("--tamanho-lote", type=int, default=100)
+    parser.add_argument("--concorrencia", type=int, default=4)
+    parser.add_argument("--tentativas", type=int, default=5)
+    parser.add_argument("--embedder", choices=["openai", "stub"], default=None)
+    parser.add_argument("--destino", choices=["weaviate", "memoria"], default="weaviate")
+    parser.add_argument(
+        "--completo", action="store_true",
+        help="Remove todos os objetos e grava a base inteira (o padrão é sincronizar só as diferenças)"
+    )
+    parser.add_argument(
+        "--cache-embeddings",
+        default=get_setting("EMBEDDING_CACHE_PATH", os.path.join(".cache", "embeddings.sqlite"))
+    )
+    args = parser.parse_args()
+
+    set_prioridade_padrao(INGESTAO)
+    df_base = carregar_base(args.base)
+    store = WeaviateStore() if args.destino == "weaviate" else MemoryStore()
+    cache_embeddings = EmbeddingCache(args.cache_embeddings)
+    opcoes = {
+        "tamanho_lote": args.tamanho_lote,
+        "concorrencia": args.concorrencia,
+        "tentativas": args.tentativas,
+    }
+    try:
+        embedder = get_embedder(args.embedder)
+        if args.completo:
+            store.remover(store.ids())
+        relatorio = sincronizar(df_base, embedder, store, cache_embeddings=cache_embeddings, **opcoes)
+    finally:
+        store.close()
+        cache_embeddings.close()
+
+    print(
+        f"{relatorio['novas']} linhas novas/alteradas, {relatorio['removidas']} removidas, "
+        f"{relatorio['inalteradas']} inalteradas; {relatorio['embeddings']} embeddings geradas."
+    )
+    print(
+        f"{relatorio['linhas']} linhas gravadas em {relatorio['duracao_s']:.1f}s "
+        f"({relatorio['linhas_por_s']:.1f} linhas/s, {relatorio['lotes_com_falha']} lotes com falha)."
+    )
 
-print("Dados processados e armazenados no Weaviate com sucesso.")
\ No newline at end of file
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,215 @@
+import argparse
+import hashlib
+import json
+import os
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import pandas as pd
+from tqdm import tqdm
+
+from excel_export import convert_df_to_excel
+from model_registry import get_model_registry
+from process import montar_prompt, run_agent_analysis, run_direcionadores_agrupados
+from rate_limiter import LOTE, set_prioridade_padrao
+from settings import get_setting
+
+CAMPOS = ["ramo_empresa", "direcionadores", "nome_processo", "atividade", "evento", "causa"]
+
+
+def ler_diagnosticos(caminho):
+    """Lê a planilha (CSV ou XLSX) de diagnósticos e valida as colunas obrigatórias."""
+    if caminho.lower().endswith(".csv"):
+        df = pd.read_csv(caminho, dtype=str)
+    else:
+        df = pd.read_excel(caminho, dtype=str)
+    df.columns = [str(coluna).strip().lower() for coluna in df.columns]
+    faltantes = [campo for campo in CAMPOS if campo not in df.columns]
+    if faltantes:
+        raise ValueError(f"Colunas obrigatórias ausentes em {caminho}: {', '.join(faltantes)}")
+    return df[CAMPOS].fillna("")
+
+
+def separar_direcionadores(valor):
+    """Uma célula pode trazer vários direcionadores separados por ';' ou por quebra de linha."""
+    return [direcao.strip() for direcao in re.split(r"[;\n]", valor) if direcao.strip()]
+
+
+def chave_diagnostico(diagnostico, modo="texto", versao_modelo=None, agrupado=False):
+    """
+    Hash do conteúdo da linha e das opções da execução.
+
+    O checkpoint só é reaproveitado se a linha não mudou e se o modo, o modelo compilado (hash do
+    JSON, ver model_registry) e o agrupamento forem os mesmos da execução que o gravou.
+    """
+    conteudo = json.dumps(
+        [[diagnostico[campo] for campo in CAMPOS], modo, versao_modelo, bool(agrupado)], ensure_ascii=False
+    )
+    return hashlib.sha256(conteudo.encode("utf-8")).hexdigest()
+
+
+def ler_checkpoint(caminho):
+    """Retorna {linha: entrada} das linhas já concluídas (a última entrada de cada linha prevalece)."""
+    concluidas = {}
+    if os.path.exists(caminho):
+        with open(caminho, encoding="utf-8") as f:
+            for linha in f:
+                if linha.strip():
+                    entrada = json.loads(linha)
+                    concluidas[entrada["linha"]] = entrada
+    return concluidas
+
+
+def analisar_diagnostico(diagnostico, modo=None, usar_cache=True, versao_modelo=None, agrupado=False):
+    """
+    Roda run_agent_analysis para cada direcionador da linha e devolve os registros com a coluna Direcionador.
+
+    Com agrupado=True, os direcionadores da linha compartilham a recuperação e são gerados juntos
+    (run_direcionadores_agrupados).
+    """
+    campos = {campo: diagnostico[campo] for campo in CAMPOS if campo != "direcionadores"}
+    registros = []
+    if agrupado:
+        direcionadores = separar_direcionadores(diagnostico["direcionadores"])
+        resultados = [None] * len(direcionadores)
+        for indice, direcao, analyst, erro in run_direcionadores_agrupados(
+            campos, direcionadores, usar_cache=usar_cache, versao_modelo=versao_modelo
+        ):
+            if erro is not None:
+                raise RuntimeError(f"Direcionador '{direcao}': {erro}")
+            analyst['Direcionador'] = direcao
+            resultados[indice] = analyst
+        for analyst in resultados:
+            registros.extend(analyst.fillna("").to_dict("records"))
+        return registros
+    for direcao in separar_direcionadores(diagnostico["direcionadores"]):
+        analyst = run_agent_analysis(
+            montar_prompt(direcao=direcao, **campos), modo=modo, usar_cache=usar_cache, versao_modelo=versao_modelo
+        )
+        if not isinstance(analyst, pd.DataFrame):
+            raise RuntimeError(f"Direcionador '{direcao}': {analyst}")
+        analyst['Direcionador'] = direcao
+        registros.extend(analyst.fillna("").to_dict("records"))
+    return registros
+
+
+def montar_planilha(concluidas):
+    """DataFrame final, na ordem das linhas de entrada e com as mesmas colunas da exportação do app."""
+    partes = []
+    for linha in sorted(concluidas):
+        entrada = concluidas[linha]
+        if entrada.get("registros"):
+            partes.append(pd.DataFrame(entrada["registros"]))
+    return pd.concat(partes, ignore_index=True) if partes else pd.DataFrame()
+
+
+def executar_lote(entrada, saida, concorrencia=4, modo=None, usar_cache=True, versao_modelo=None, agrupado=False,
+                  gravar_a_cada=None):
+    """
+    Executa todos os diagnósticos da planilha `entrada` e grava o resultado em `saida` (XLSX).
+
+    Cada diagnóstico concluído é registrado em `<saida>.checkpoint.jsonl`, então uma execução
+    interrompida retoma das linhas que faltam. A planilha de saída é regravada a cada
+    `gravar_a_cada` diagnósticos (padrão: configuração BATCH_GRAVAR_A_CADA, 10) e ao final.
+
+    Retorna:
+    dict: total de linhas, linhas concluídas nesta execução, puladas (checkpoint) e com erro.
+    """
+    diagnosticos = ler_diagnosticos(entrada)
+    caminho_checkpoint = f"{saida}.checkpoint.jsonl"
+    concluidas = ler_checkpoint(caminho_checkpoint)
+    gravar_a_cada = max(1, gravar_a_cada or get_setting("BATCH_GRAVAR_A_CADA", 10))
+    # O modo agrupado sempre gera texto; o modelo entra na chave pelo hash do JSON compilado
+    modo_efetivo = "texto" if agrupado else (modo or get_setting("OPORTUNE_MODO", "texto"))
+    modelo_hash, _ = get_model_registry().get(versao_modelo)
+
+    pendentes = []
+    for linha, diagnostico in diagnosticos.iterrows():
+        chave = chave_diagnostico(diagnostico, modo_efetivo, modelo_hash, agrupado)
+        anterior = concluidas.get(linha)
+        if anterior and anterior["chave"] == chave and not anterior.get("erro"):
+            continue
+        concluidas.pop(linha, None)
+        pendentes.append((linha, chave, diagnostico))
+
+    relatorio = {"linhas": len(diagnosticos), "puladas": len(diagnosticos) - len(pendentes), "concluidas": 0, "erros": 0}
+    lock = threading.Lock()
+    sem_gravar = 0
+
+    try:
+        with ThreadPoolExecutor(max_workers=concorrencia) as executor, \
+                open(caminho_checkpoint, "a", encoding="utf-8") as checkpoint, \
+                tqdm(total=len(pendentes), unit="diagnósticos") as barra:
+            futures = {
+                executor.submit(analisar_diagnostico, diagnostico, modo, usar_cache, versao_modelo, agrupado): (linha, chave)
+                for linha, chave, diagnostico in pendentes
+            }
+            for future in as_completed(futures):
+                linha, chave = futures[future]
+                registro_checkpoint = {"linha": int(linha), "chave": chave, "registros": [], "erro": None}
+                try:
+                    registro_checkpoint["registros"] = future.result()
+                    relatorio["concluidas"] += 1
+                except Exception as e:
+                    print(f"ERRO NO DIAGNÓSTICO DA LINHA {linha + 1}: {e}")
+                    registro_checkpoint["erro"] = str(e)
+                    relatorio["erros"] += 1
+                with lock:
+                    checkpoint.write(json.dumps(registro_checkpoint, ensure_ascii=False) + "\n")
+                    checkpoint.flush()
+                    concluidas[int(linha)] = registro_checkpoint
+                    sem_gravar += 1
+                    if sem_gravar >= gravar_a_cada:
+                        gravar_planilha(montar_planilha(concluidas), saida)
+                        sem_gravar = 0
+                barra.update(1)
+    finally:
+        # Também numa interrupção: a planilha reflete tudo o que está no checkpoint
+        gravar_planilha(montar_planilha(concluidas), saida)
+    return relatorio
+
+
+def gravar_planilha(df, saida):
+    if df.empty:
+        return
+    temporario = f"{saida}.tmp"
+    with open(temporario, "wb") as f:
+        f.write(convert_df_to_excel(df))
+    os.replace(temporario, saida)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Executa vários diagnósticos de oportunidades de melhoria a partir de uma planilha")
+    parser.add_argument("entrada", help="CSV/XLSX com as colunas " + ", ".join(CAMPOS))
+    parser.add_argument("--saida", default="oportunidade_melhoria_lote.xlsx")
+    parser.add_argument("--concorrencia", type=int, default=4, help="Diagnósticos executados em paralelo")
+    parser.add_argument("--modo", choices=["texto", "estruturado"], default=None)
+    parser.add_argument("--sem-cache", action="store_true", help="Ignora o cache de respostas")
+    parser.add_argument("--modelo", default=None, help="JSON do modelo compilado (padrão: OPORTUNE_MODELO)")
+    parser.add_argument("--agrupado", action="store_true",
+                        help="Gera os direcionadores de cada linha juntos, com uma única recuperação (modo texto)")
+    parser.add_argument("--gravar-a-cada", type=int, default=None,
+                        help="Diagnósticos entre gravações da planilha de saída (padrão: BATCH_GRAVAR_A_CADA ou 10)")
+    args = parser.parse_args()
+
+    # Chamadas do lote cedem a cota da OpenAI às análises interativas do app
+    set_prioridade_padrao(LOTE)
+    relatorio = executar_lote(
+        args.entrada,
+        args.saida,
+        concorrencia=args.concorrencia,
+        modo=args.modo,
+        usar_cache=not args.sem_cache,
+        versao_modelo=args.modelo,
+        agrupado=args.agrupado,
+        gravar_a_cada=args.gravar_a_cada,
+    )
+    print(
+        f"{relatorio['concluidas']} diagnósticos concluídos, {relatorio['puladas']} retomados do checkpoint, "
+        f"{relatorio['erros']} com erro (de {relatorio['linhas']}). Resultado em {args.saida}"
+    )
+
+
+if __name__ == "__main__":
+    main()
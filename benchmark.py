@@ -0,0 +1,423 @@
+import argparse
+import hashlib
+import json
+import os
+import re
+import subprocess
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime
+from types import SimpleNamespace
+
+import numpy as np
+import pandas as pd
+
+# O benchmark roda sem rede: nenhuma chamada usa a chave, mas os módulos do pipeline a exigem
+os.environ.setdefault("OPENAI_API_KEY", "sk-benchmark-offline")
+os.environ["RETRIEVER_BACKEND"] = "faiss"
+os.environ["ANSWER_CACHE_ENABLED"] = "0"
+
+try:
+    from dsp.modules.lm import LM
+except ImportError:  # dspy >= 2.6
+    from dspy.dsp.modules.lm import LM
+
+import transform_input_to_df as transformacao
+from base_loader import carregar_base
+from base_weaviate import MemoryStore, ingerir
+from client_pool import OportuneRAGClientPool, set_client_pool
+from embeddings import StubEmbedder
+from excel_export import convert_df_to_excel
+from faiss_rm import FaissRM, construir_indice
+from modeloDSpy import OportuneRAGClient
+from process import run_direcionadores, stream_direcionadores
+from transform_input_to_df import COLUNAS
+
+CAMPOS_BENCHMARK = {
+    "ramo_empresa": "Varejo",
+    "nome_processo": "Contas a pagar",
+    "atividade": "Conciliação de pagamentos",
+    "evento": "Pagamentos recusados sem baixa no sistema",
+    "causa": "Informações bancárias capturadas manualmente",
+}
+
+DIRECIONADORES_BENCHMARK = [
+    "Redução de custos", "Automação", "Qualidade", "Compliance",
+    "Experiência do cliente", "Produtividade", "Governança", "Escalabilidade",
+]
+
+
+class StubLM(LM):
+    """
+    Substituto determinístico do dspy.OpenAI: responde no formato da assinatura Oportune.
+
+    A latência simulada é `latencia` segundos mais o tempo de gerar a resposta a `tokens_por_s`
+    (0 = instantâneo). O conteúdo depende só do hash do prompt. Com estilo="livre", a resposta
+    vem sem os rótulos de campo, forçando o fallback para o agente em transform_input_to_df.
+    Prompts agrupados (montar_prompt_agrupado) recebem um bloco por direcionador listado e prompts
+    do modo estruturado (terminados no campo "Oportunidades:") recebem a lista em JSON.
+    """
+
+    def __init__(self, latencia=0.5, tokens_por_s=0, oportunidades=10, estilo="rotulado"):
+        super().__init__("stub-gpt-4o")
+        self.kwargs.update(max_tokens=2048, temperature=0.2)
+        self.provider = "openai"
+        self.latencia = latencia
+        self.tokens_por_s = tokens_por_s
+        self.oportunidades = oportunidades
+        self.estilo = estilo
+
+    def _resposta(self, prompt):
+        semente = hashlib.sha256(prompt.encode("utf-8")).hexdigest()[:8]
+        if prompt.rstrip().endswith("Oportunidades:"):
+            return json.dumps([
+                {"oportunidade_melhoria": f"Oportunidade {numero} ({semente})", "solucao": f"Integrar a etapa {numero}.",
+                 "backlog_atividades": f"- Mapear a etapa {numero}", "investimento": f"{40 * numero} horas",
+                 "ganhos": f"Menos retrabalho na etapa {numero}."}
+                for numero in range(1, self.oportunidades + 1)
+            ], ensure_ascii=False)
+        lista = re.search(r"Direcionadores a analisar: (.+)", prompt)
+        if lista:
+            direcionadores = re.findall(r'"([^"]+)"', lista.group(1))
+            return "produzir a resposta por direcionador.\n\nAnswer: " + "\n\n".join(
+                f"**Direcionador** : {direcao}\n\n{self._oportunidades(semente + direcao)}" for direcao in direcionadores
+            )
+        return "produzir a resposta. Analisei o contexto e as oportunidades da base.\n\nAnswer: " + self._oportunidades(semente)
+
+    def _oportunidades(self, semente):
+        blocos = []
+        for numero in range(1, self.oportunidades + 1):
+            campos = [
+                ("Oportunidade de Melhoria", f"Oportunidade {numero} ({semente}): automatizar a etapa {numero} do processo"),
+                ("Solução", f"Integrar os sistemas envolvidos na etapa {numero} e eliminar controles manuais."),
+                ("Backlog de Atividades", f"- Mapear a etapa {numero}\n- Especificar a integração\n- Homologar com a área"),
+                ("Investimento", f"{40 * numero} horas de desenvolvimento e implantação."),
+                ("Ganhos", f"Redução de retrabalho e de erros operacionais na etapa {numero}."),
+            ]
+            if self.estilo == "livre":
+                blocos.append(" ".join(valor for _, valor in campos))
+            else:
+                blocos.append("\n\n".join(f"**{rotulo}** : {valor}" for rotulo, valor in campos))
+        return "\n\n".join(blocos)
+
+    def basic_request(self, prompt, **kwargs):
+        texto = self._resposta(prompt)
+        espera = self.latencia
+        if self.tokens_por_s:
+            espera += len(texto.split()) / self.tokens_por_s
+        time.sleep(espera)
+        resposta = {"choices": [{"text": texto, "finish_reason": "stop"}]}
+        self.history.append({"prompt": prompt, "response": resposta, "kwargs": kwargs})
+        return resposta
+
+    def __call__(self, prompt, only_completed=True, return_sorted=False, **kwargs):
+        return [choice["text"] for choice in self.basic_request(prompt, **kwargs)["choices"]]
+
+
+class ChatStub:
+    """
+    Substituto do cliente OpenAI usado pelo run_model_stream: chat.completions.create(stream=True).
+
+    A resposta vem do StubLM para o prompt da mensagem do usuário (o mesmo template do OportuneRAG
+    compilado), em trechos de algumas palavras; a latência fixa precede o primeiro trecho e a
+    velocidade de geração (tokens_por_s) é distribuída entre eles.
+    """
+
+    def __init__(self, lm, palavras_por_trecho=8):
+        self.lm = lm
+        self.palavras_por_trecho = palavras_por_trecho
+        self.chat = self
+        self.completions = self
+
+    def create(self, messages, stream=False, **kwargs):
+        prompt = messages[-1]["content"]
+        texto = self.lm._resposta(prompt)
+        self.lm.history.append({"prompt": prompt, "response": {"choices": [{"text": texto}]}, "kwargs": kwargs})
+        return self._trechos(prompt, texto)
+
+    def _trechos(self, prompt, texto):
+        palavras = re.findall(r"\S+\s*", texto)
+        time.sleep(self.lm.latencia)
+        for inicio in range(0, len(palavras), self.palavras_por_trecho):
+            trecho = palavras[inicio:inicio + self.palavras_por_trecho]
+            if self.lm.tokens_por_s:
+                time.sleep(len(trecho) / self.lm.tokens_por_s)
+            yield SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content="".join(trecho)))], usage=None)
+        uso = SimpleNamespace(prompt_tokens=len(prompt.split()), completion_tokens=len(palavras))
+        uso.total_tokens = uso.prompt_tokens + uso.completion_tokens
+        yield SimpleNamespace(choices=[], usage=uso)
+
+
+class ClienteOffline(OportuneRAGClient):
+    """OportuneRAGClient com o StubLM (também no streaming) e o FaissRM sobre um índice gerado com StubEmbedder."""
+
+    def __init__(self, lm, pasta_indice, latencia_rm=0.0):
+        self._lm = lm
+        self._pasta_indice = pasta_indice
+        self._latencia_rm = latencia_rm
+        super().__init__()
+        self.client = ChatStub(lm)
+        self.cache = None
+
+    def setup_dspy_params(self):
+        return {"lm": self._lm, "rm": self.setup_retriever()}
+
+    def setup_retriever(self):
+        return FaissRM(self._pasta_indice, embedder=StubEmbedder(latencia=self._latencia_rm))
+
+
+@contextmanager
+def agente_stub(latencia):
+    """Troca o agente ReAct de transform_input_to_df por um que separa os parágrafos após `latencia` segundos."""
+    original = transformacao._transform_with_agent
+
+    def transformar(input_data):
+        time.sleep(latencia)
+        paragrafos = [paragrafo.strip() for paragrafo in str(input_data).split("\n\n") if paragrafo.strip()]
+        return pd.DataFrame([{coluna: paragrafo for coluna in COLUNAS} for paragrafo in paragrafos], columns=COLUNAS)
+
+    transformacao._transform_with_agent = transformar
+    try:
+        yield
+    finally:
+        transformacao._transform_with_agent = original
+
+
+def resumir(latencias, itens, duracao, unidade):
+    """Percentis de latência (ms) e vazão (`unidade` por segundo) de um cenário."""
+    latencias_ms = np.asarray(latencias) * 1000
+    return {
+        "amostras": len(latencias),
+        "p50_ms": float(np.percentile(latencias_ms, 50)),
+        "p95_ms": float(np.percentile(latencias_ms, 95)),
+        "p99_ms": float(np.percentile(latencias_ms, 99)),
+        "media_ms": float(latencias_ms.mean()),
+        "vazao": itens / duracao if duracao else 0.0,
+        "unidade": f"{unidade}/s",
+    }
+
+
+def _cronometrar(funcao, *args, **kwargs):
+    inicio = time.perf_counter()
+    resultado = funcao(*args, **kwargs)
+    return time.perf_counter() - inicio, resultado
+
+
+def _diagnostico(direcionadores, agrupado=False, modo=None):
+    """Roda um diagnóstico completo (todos os direcionadores) e falha se algum não produzir DataFrame."""
+    eventos = run_direcionadores(CAMPOS_BENCHMARK, direcionadores, usar_cache=False, agrupado=agrupado, modo=modo)
+    for _, direcao, resultado, erro in eventos:
+        if erro is not None or not isinstance(resultado, pd.DataFrame) or resultado.empty:
+            raise RuntimeError(f"Direcionador '{direcao}' sem resultado: {erro or resultado}")
+
+
+def cenario_analise(quantidade, repeticoes, agrupado=False, modo=None):
+    """Latência de um diagnóstico com `quantidade` direcionadores (em paralelo, ou agrupados em poucas gerações)."""
+    direcionadores = DIRECIONADORES_BENCHMARK[:quantidade]
+    latencias = []
+    inicio = time.perf_counter()
+    for _ in range(repeticoes):
+        duracao, _ = _cronometrar(_diagnostico, direcionadores, agrupado, modo)
+        latencias.append(duracao)
+    return resumir(latencias, quantidade * repeticoes, time.perf_counter() - inicio, "direcionadores")
+
+
+def _diagnostico_stream(direcionadores):
+    """
+    Diagnóstico pelo caminho do app (stream_direcionadores no modo texto).
+
+    Retorna:
+    float: segundos até a primeira oportunidade parcial chegar.
+    """
+    inicio = time.perf_counter()
+    primeira = None
+    for tipo, _, direcao, dado in stream_direcionadores(CAMPOS_BENCHMARK, direcionadores, modo="texto",
+                                                        usar_cache=False, agrupado=False):
+        if tipo == "oportunidade" and primeira is None:
+            primeira = time.perf_counter() - inicio
+        elif tipo == "erro" or (tipo == "resultado" and (not isinstance(dado, pd.DataFrame) or dado.empty)):
+            raise RuntimeError(f"Direcionador '{direcao}' sem resultado: {dado}")
+    if primeira is None:
+        raise RuntimeError("Nenhuma oportunidade parcial recebida no streaming")
+    return primeira
+
+
+def cenario_stream(quantidade, repeticoes):
+    """Latência do diagnóstico em streaming (caminho padrão do app) e até a primeira oportunidade parcial."""
+    direcionadores = DIRECIONADORES_BENCHMARK[:quantidade]
+    latencias, primeiras = [], []
+    inicio = time.perf_counter()
+    for _ in range(repeticoes):
+        duracao, primeira = _cronometrar(_diagnostico_stream, direcionadores)
+        latencias.append(duracao)
+        primeiras.append(primeira)
+    metricas = resumir(latencias, quantidade * repeticoes, time.perf_counter() - inicio, "direcionadores")
+    metricas["primeira_oportunidade_p50_ms"] = float(np.percentile(np.asarray(primeiras) * 1000, 50))
+    return metricas
+
+
+def cenario_sessoes(sessoes, direcionadores_por_sessao, repeticoes):
+    """Latência por sessão com `sessoes` diagnósticos simultâneos disputando o mesmo pool de clientes."""
+    direcionadores = DIRECIONADORES_BENCHMARK[:direcionadores_por_sessao]
+    latencias = []
+    lock = threading.Lock()
+
+    def sessao():
+        for _ in range(repeticoes):
+            duracao, _ = _cronometrar(_diagnostico, direcionadores)
+            with lock:
+                latencias.append(duracao)
+
+    inicio = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=sessoes) as executor:
+        for future in [executor.submit(sessao) for _ in range(sessoes)]:
+            future.result()
+    return resumir(latencias, len(latencias), time.perf_counter() - inicio, "sessões")
+
+
+def cenario_excel(linhas, repeticoes):
+    """Tempo do convert_df_to_excel para uma planilha sintética com `linhas` oportunidades."""
+    texto = "Integrar os sistemas envolvidos e eliminar controles manuais. " * 3
+    df = pd.DataFrame({coluna: [f"{coluna} {i}: {texto}" for i in range(linhas)] for coluna in COLUNAS + ["Direcionador"]})
+    latencias = []
+    inicio = time.perf_counter()
+    for _ in range(repeticoes):
+        duracao, _ = _cronometrar(convert_df_to_excel, df)
+        latencias.append(duracao)
+    return resumir(latencias, linhas * repeticoes, time.perf_counter() - inicio, "linhas")
+
+
+def cenario_ingestao(df_base, repeticoes, latencia_embedding, latencia_store, tamanho_lote, concorrencia):
+    """Ingestão completa da base com StubEmbedder e MemoryStore (latências simuladas por lote)."""
+    latencias = []
+    inicio = time.perf_counter()
+    for _ in range(repeticoes):
+        duracao, relatorio = _cronometrar(
+            ingerir, df_base, StubEmbedder(latencia=latencia_embedding), MemoryStore(latencia=latencia_store),
+            tamanho_lote=tamanho_lote, concorrencia=concorrencia, progresso=False,
+        )
+        if relatorio["lotes_com_falha"]:
+            raise RuntimeError(f"{relatorio['lotes_com_falha']} lotes falharam na ingestão")
+        latencias.append(duracao)
+    return resumir(latencias, len(df_base) * repeticoes, time.perf_counter() - inicio, "linhas")
+
+
+def _commit_atual():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except Exception:
+        return None
+
+
+def comparar(atual, anterior):
+    """Imprime a variação de p50 e vazão de cada cenário em relação a uma execução anterior."""
+    for nome, metricas in atual["cenarios"].items():
+        base = anterior.get("cenarios", {}).get(nome)
+        if not base:
+            continue
+        delta_p50 = (metricas["p50_ms"] / base["p50_ms"] - 1) * 100 if base["p50_ms"] else 0.0
+        delta_vazao = (metricas["vazao"] / base["vazao"] - 1) * 100 if base["vazao"] else 0.0
+        print(f"{nome:<32} p50 {delta_p50:+6.1f}%  vazão {delta_vazao:+6.1f}%")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark offline do pipeline (LM, retriever, agente e embeddings simulados)")
+    parser.add_argument("--cenarios", default="analise,stream,agrupado,estruturado,sessoes,agente,excel,ingestao")
+    parser.add_argument("--direcionadores", default="1,2,4,8", help="Tamanhos de diagnóstico a medir")
+    parser.add_argument("--sessoes", default="1,2,4", help="Quantidades de sessões simultâneas")
+    parser.add_argument("--direcionadores-por-sessao", type=int, default=3)
+    parser.add_argument("--repeticoes", type=int, default=5)
+    parser.add_argument("--pool", type=int, default=4, help="Tamanho do pool de clientes")
+    parser.add_argument("--latencia-lm", type=float, default=0.5, help="Latência fixa por chamada ao LM (s)")
+    parser.add_argument("--tokens-por-s", type=float, default=0, help="Velocidade de geração simulada (0 = instantânea)")
+    parser.add_argument("--oportunidades", type=int, default=10, help="Oportunidades por resposta do LM")
+    parser.add_argument("--latencia-rm", type=float, default=0.0, help="Latência da embedding da consulta (s)")
+    parser.add_argument("--latencia-agente", type=float, default=2.0, help="Latência do agente de transformação (s)")
+    parser.add_argument("--linhas-excel", type=int, default=2000)
+    parser.add_argument("--latencia-embedding", type=float, default=0.05, help="Latência por lote de embeddings (s)")
+    parser.add_argument("--latencia-store", type=float, default=0.02, help="Latência por inserção em lote (s)")
+    parser.add_argument("--tamanho-lote", type=int, default=100)
+    parser.add_argument("--concorrencia", type=int, default=4)
+    parser.add_argument("--base", default="Base.xlsx")
+    parser.add_argument("--saida", default=os.path.join(".cache", "benchmarks"), help="Pasta dos resultados JSON")
+    parser.add_argument("--comparar", default=None, help="JSON de uma execução anterior")
+    args = parser.parse_args()
+
+    cenarios = {nome.strip() for nome in args.cenarios.split(",")}
+    df_base = carregar_base(args.base)
+    resultados = {}
+
+    with tempfile.TemporaryDirectory() as pasta_indice:
+        if cenarios & {"analise", "stream", "agrupado", "estruturado", "sessoes", "agente"}:
+            construir_indice(df_base, StubEmbedder(), pasta_indice)
+
+            def usar_lm(lm):
+                set_client_pool(OportuneRAGClientPool(
+                    tamanho=args.pool, factory=lambda: ClienteOffline(lm, pasta_indice, args.latencia_rm)
+                ))
+                # Aquecimento: cria os clientes e carrega o modelo compilado fora da medição
+                _diagnostico(DIRECIONADORES_BENCHMARK[:args.pool])
+
+            lm = StubLM(args.latencia_lm, args.tokens_por_s, args.oportunidades)
+            if cenarios & {"analise", "stream", "agrupado", "estruturado", "sessoes"}:
+                usar_lm(lm)
+            if "analise" in cenarios:
+                for quantidade in [int(valor) for valor in args.direcionadores.split(",")]:
+                    resultados[f"analise_{quantidade}_direcionadores"] = cenario_analise(quantidade, args.repeticoes)
+            if "stream" in cenarios:
+                for quantidade in [int(valor) for valor in args.direcionadores.split(",")]:
+                    resultados[f"stream_{quantidade}_direcionadores"] = cenario_stream(quantidade, args.repeticoes)
+            if "estruturado" in cenarios:
+                resultados["estruturado_1_direcionador"] = cenario_analise(1, args.repeticoes, modo="estruturado")
+            if "agrupado" in cenarios:
+                for quantidade in [int(valor) for valor in args.direcionadores.split(",")]:
+                    resultados[f"agrupado_{quantidade}_direcionadores"] = cenario_analise(
+                        quantidade, args.repeticoes, agrupado=True
+                    )
+            if "sessoes" in cenarios:
+                for sessoes in [int(valor) for valor in args.sessoes.split(",")]:
+                    resultados[f"sessoes_{sessoes}_simultaneas"] = cenario_sessoes(
+                        sessoes, args.direcionadores_por_sessao, args.repeticoes
+                    )
+            if "agente" in cenarios:
+                with agente_stub(args.latencia_agente):
+                    usar_lm(StubLM(args.latencia_lm, args.tokens_por_s, args.oportunidades, estilo="livre"))
+                    resultados["analise_1_direcionador_agente"] = cenario_analise(1, args.repeticoes)
+            set_client_pool(None)
+
+    if "excel" in cenarios:
+        resultados[f"excel_{args.linhas_excel}_linhas"] = cenario_excel(args.linhas_excel, args.repeticoes)
+    if "ingestao" in cenarios:
+        resultados["ingestao"] = cenario_ingestao(
+            df_base, args.repeticoes, args.latencia_embedding, args.latencia_store, args.tamanho_lote, args.concorrencia
+        )
+
+    execucao = {
+        "data": datetime.now().isoformat(timespec="seconds"),
+        "commit": _commit_atual(),
+        "parametros": vars(args),
+        "cenarios": resultados,
+    }
+    os.makedirs(args.saida, exist_ok=True)
+    caminho = os.path.join(args.saida, f"benchmark_{datetime.now():%Y%m%d_%H%M%S}.json")
+    with open(caminho, "w", encoding="utf-8") as f:
+        json.dump(execucao, f, ensure_ascii=False, indent=2)
+
+    for nome, metricas in resultados.items():
+        print(
+            f"{nome:<32} p50 {metricas['p50_ms']:9.1f} ms  p95 {metricas['p95_ms']:9.1f} ms  "
+            f"p99 {metricas['p99_ms']:9.1f} ms  {metricas['vazao']:9.1f} {metricas['unidade']}"
+        )
+    if args.comparar:
+        with open(args.comparar, encoding="utf-8") as f:
+            comparar(execucao, json.load(f))
+    print(f"Resultados gravados em {caminho}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,200 @@
+import atexit
+import queue
+import threading
+import time
+from contextlib import contextmanager
+
+from modeloDSpy import OportuneRAGClient
+from settings import get_setting
+from tracing import span
+
+# Colocado na fila por close(): acorda quem espera por um cliente e é repassado aos demais
+_ENCERRADO = object()
+
+
+class OportuneRAGClientPool:
+    """
+    Pool thread-safe de OportuneRAGClient compartilhado por todo o processo do servidor.
+
+    Cada cliente (conexão Weaviate, LM do DSpy e modelo compilado) é criado sob demanda até
+    `tamanho` instâncias e reaproveitado entre requisições. Antes de ser entregue, o cliente
+    passa por um health check (periódico ou após falha) e é reconectado quando necessário.
+    """
+
+    def __init__(self, tamanho=4, factory=OportuneRAGClient, intervalo_health_check=60.0):
+        self._factory = factory
+        self._tamanho = max(1, int(tamanho))
+        self._intervalo_health_check = intervalo_health_check
+        self._disponiveis = queue.LifoQueue()
+        self._clientes = {}  # id(cliente) -> {"cliente", "ultimo_check", "suspeito"}
+        self._criando = 0
+        self._lock = threading.Lock()
+        self._fechado = False
+
+    @contextmanager
+    def lease(self, timeout=None):
+        """
+        Empresta um cliente saudável do pool durante o bloco `with`.
+
+        Exceções levantadas dentro do bloco marcam o cliente como suspeito, forçando um health
+        check (e reconexão, se preciso) no próximo empréstimo.
+        """
+        with span("cliente.aquisicao"):
+            cliente = self._acquire(timeout)
+        try:
+            yield cliente
+        except Exception:
+            self.report_failure(cliente)
+            raise
+        finally:
+            self._release(cliente)
+
+    def report_failure(self, cliente):
+        """Marca o cliente para ser verificado antes do próximo uso."""
+        with self._lock:
+            entrada = self._clientes.get(id(cliente))
+            if entrada:
+                entrada["suspeito"] = True
+
+    def stats(self):
+        with self._lock:
+            return {
+                "tamanho": self._tamanho,
+                "criados": len(self._clientes),
+                "disponiveis": self._disponiveis.qsize(),
+            }
+
+    def close(self):
+        """
+        Fecha as conexões dos clientes livres; os emprestados são fechados na devolução.
+
+        Cada cliente é fechado uma única vez e chamadas repetidas não têm efeito. Empréstimos
+        posteriores, e os que estavam esperando um cliente livre, levantam RuntimeError.
+        """
+        clientes = []
+        with self._lock:
+            if self._fechado:
+                return
+            self._fechado = True
+            while True:
+                try:
+                    cliente = self._disponiveis.get_nowait()
+                except queue.Empty:
+                    break
+                if self._clientes.pop(id(cliente), None) is not None:
+                    clientes.append(cliente)
+            self._disponiveis.put(_ENCERRADO)
+        for cliente in clientes:
+            cliente.close_weaviate_client()
+
+    def _acquire(self, timeout):
+        with self._lock:
+            if self._fechado:
+                raise RuntimeError("Pool de OportuneRAGClient encerrado")
+        try:
+            cliente = self._disponiveis.get_nowait()
+        except queue.Empty:
+            cliente = self._create_if_allowed()
+            if cliente is None:
+                try:
+                    cliente = self._disponiveis.get(timeout=timeout)
+                except queue.Empty:
+                    raise TimeoutError("Nenhum OportuneRAGClient disponível no pool") from None
+        if cliente is _ENCERRADO:
+            self._disponiveis.put(_ENCERRADO)
+            raise RuntimeError("Pool de OportuneRAGClient encerrado enquanto aguardava um cliente")
+        return self._ensure_healthy(cliente)
+
+    def _create_if_allowed(self):
+        with self._lock:
+            if len(self._clientes) + self._criando >= self._tamanho:
+                return None
+            # Reserva a vaga antes de criar para não ultrapassar o tamanho do pool
+            self._criando += 1
+        try:
+            with span("cliente.setup"):
+                cliente = self._factory()
+        finally:
+            with self._lock:
+                self._criando -= 1
+        with self._lock:
+            fechado = self._fechado
+            if not fechado:
+                self._clientes[id(cliente)] = {
+                    "cliente": cliente,
+                    "ultimo_check": time.monotonic(),
+                    "suspeito": False,
+                }
+        if fechado:
+            # O pool foi encerrado durante a criação: o cliente nunca chega a ser emprestado
+            cliente.close_weaviate_client()
+            raise RuntimeError("Pool de OportuneRAGClient encerrado")
+        return cliente
+
+    def _ensure_healthy(self, cliente):
+        with self._lock:
+            entrada = self._clientes.get(id(cliente))
+            if entrada is None:
+                return cliente
+            suspeito = entrada["suspeito"]
+            vencido = time.monotonic() - entrada["ultimo_check"] > self._intervalo_health_check
+        if suspeito or vencido:
+            # O health check (e a reconexão) roda fora do lock; só a atualização da entrada é protegida
+            with span("cliente.health_check", suspeito=suspeito):
+                if not cliente.is_healthy() and not cliente.reconnect():
+                    print("ERRO POOL: cliente continua indisponível após reconexão")
+            with self._lock:
+                entrada["suspeito"] = False
+                entrada["ultimo_check"] = time.monotonic()
+        return cliente
+
+    def _release(self, cliente):
+        with self._lock:
+            if not self._fechado:
+                self._disponiveis.put(cliente)
+                return
+            # Pool encerrado durante o empréstimo: fecha aqui, só se close() ainda não o fechou
+            fechar = self._clientes.pop(id(cliente), None) is not None
+        if fechar:
+            cliente.close_weaviate_client()
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_client_pool():
+    """Retorna o pool de clientes do processo, criando-o na primeira chamada."""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = OportuneRAGClientPool(
+                tamanho=get_setting("RAG_POOL_SIZE", 4),
+                intervalo_health_check=get_setting("RAG_POOL_HEALTH_CHECK_SECONDS", 60.0),
+            )
+            atexit.register(shutdown_client_pool)
+        return _pool
+
+
+def set_client_pool(pool):
+    """
+    Substitui o pool do processo (ex.: benchmark com clientes locais) e encerra o anterior.
+
+    Retorna:
+    OportuneRAGClientPool ou None: O pool que estava em uso.
+    """
+    global _pool
+    with _pool_lock:
+        anterior, _pool = _pool, pool
+    if anterior is not None:
+        anterior.close()
+    return anterior
+
+
+def shutdown_client_pool():
+    """Encerra o pool do processo (chamado automaticamente na saída do interpretador)."""
+    global _pool
+    with _pool_lock:
+        pool, _pool = _pool, None
+    if pool is not None:
+        pool.close()
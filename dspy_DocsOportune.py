@@ -1,15 +1,19 @@
 import os
 import sys
+import threading
+from typing import List
 from dotenv import load_dotenv
+from pydantic import BaseModel, Field
 import dspy
 from openai import OpenAI
 import weaviate
 from dspy.retrieve.weaviate_rm import WeaviateRM
 import streamlit as st
+from settings import get_setting
 
 # Carrega o .env para configurar a chave OPENAI_API_KEY
 load_dotenv()
-api_key = st.secrets["OPENAI_API_KEY"]
+api_key = get_setting("OPENAI_API_KEY")
 
 # Verifica se a chave foi carregada corretamente
 if not api_key:
@@ -75,16 +79,78 @@ try:
                                       RESPONDA em Português do Brasil.
                             """)
 
+    class OportunidadeMelhoria(BaseModel):
+        """Uma oportunidade de melhoria com os cinco campos da planilha."""
+        oportunidade_melhoria: str = Field(description="Descrição clara da oportunidade de melhoria")
+        solucao: str = Field(description="Solução recomendada")
+        backlog_atividades: str = Field(description="Atividades sugeridas para implementação, em tópicos")
+        investimento: str = Field(description="Investimento necessário")
+        ganhos: str = Field(description="Ganhos esperados para a empresa")
+
+        def to_registro(self):
+            # Mesmas colunas geradas por transform_input_to_df
+            return {
+                "Oportunidade de Melhoria": self.oportunidade_melhoria,
+                "Solução": self.solucao,
+                "Backlog de Atividades": self.backlog_atividades,
+                "Investimento": self.investimento,
+                "Ganhos": self.ganhos,
+            }
+
+    class OportuneEstruturado(dspy.Signature):
+        # MESMAS INSTRUÇÕES DO Oportune, MAS A SAÍDA JÁ VEM TIPADA (SEM A ETAPA DE TRANSFORMAÇÃO)
+        __doc__ = Oportune.__doc__
+
+        question = dspy.InputField()
+        context = dspy.InputField(desc="traga as oportunidades mais relevantes para o cenário do cliente em questão.")
+
+        oportunidades: List[OportunidadeMelhoria] = dspy.OutputField(
+            desc="As **10** melhores oportunidades, cada uma com solução, backlog de atividades em tópicos, "
+                 "investimento necessário e ganhos para a empresa. RESPONDA em Português do Brasil."
+        )
+
+    MODOS = ("texto", "estruturado")
+    _lock_estruturado = threading.Lock()
+
     class OportuneRAG(dspy.Module):
         def __init__(self, num_passages=5): 
             super().__init__()
         
             self.retrieve = dspy.Retrieve(k=num_passages)
             self.generate_answer = dspy.ChainOfThought(Oportune) # Step by Step Cadeia de pensamento...
-
-        def forward(self, question):
-            context = self.retrieve(question).passages
-            prediction = self.generate_answer(context=context, question=question)        
+            # generate_structured é criado sob demanda (depois do load) para o JSON compilado
+            # continuar carregando sem alterações
+            self.generate_structured = None
+
+        def gerador_estruturado(self):
+            """Preditor tipado que reaproveita os demos já carregados em generate_answer."""
+            with _lock_estruturado:
+                if self.generate_structured is None:
+                    preditor = dspy.TypedPredictor(OportuneEstruturado)
+                    preditor.predictor.demos = list(self.generate_answer.demos)
+                    self.generate_structured = preditor
+                return self.generate_structured
+
+        def forward(self, question, modo="texto", context=None, demos=None, config=None):
+            if modo not in MODOS:
+                raise ValueError(f"Modo desconhecido: {modo}. Use um de {MODOS}")
+            # context pode vir pronto quando a recuperação já foi feita (ex.: para montar a chave do cache);
+            # demos substitui os demos compilados nesta chamada (seleção do prompt_budget) e config
+            # sobrescreve parâmetros do LM (ex.: max_tokens maior na geração agrupada)
+            if context is None:
+                context = self.retrieve(question).passages
+            extras = {}
+            if demos is not None:
+                extras["demos"] = demos
+            if config:
+                extras["config"] = config
+            if modo == "estruturado":
+                # O TypedPredictor valida as entradas pelo tipo (str): as passagens vão numeradas em um só texto
+                passagens = "\n".join(f"[{i}] «{passagem}»" for i, passagem in enumerate(context, start=1))
+                prediction = self.gerador_estruturado()(context=passagens, question=question, **extras)
+                registros = [oportunidade.to_registro() for oportunidade in prediction.oportunidades]
+                return dspy.Prediction(context=context, answer=None, oportunidades=registros)
+            prediction = self.generate_answer(context=context, question=question, **extras)
             return dspy.Prediction(context=context, answer=prediction.answer)   
 
 except Exception as e:
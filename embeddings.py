@@ -0,0 +1,123 @@
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+import time
+
+import numpy as np
+
+from rate_limiter import get_rate_limiter
+from settings import get_setting
+from tracing import contar_tokens
+
+
+class OpenAIEmbedder:
+    """Gera embeddings com a API da OpenAI (várias entradas por requisição)."""
+
+    def __init__(self, model="text-embedding-ada-002", api_key=None):
+        from openai import OpenAI
+
+        self.model = model
+        self.nome = f"openai:{model}"
+        self.client = OpenAI(api_key=api_key or get_setting("OPENAI_API_KEY"))
+
+    def embed(self, textos):
+        """Retorna uma matriz float32 (len(textos), dim), na mesma ordem de `textos`."""
+        # A API rejeita strings vazias
+        entradas = [texto if texto and texto.strip() else " " for texto in textos]
+        response = get_rate_limiter().executar(
+            self.model, self.client.embeddings.create, model=self.model, input=entradas,
+            tokens=sum(contar_tokens(entrada, self.model) for entrada in entradas),
+            tokens_usados=lambda resposta: resposta.usage.total_tokens,
+        )
+        dados = sorted(response.data, key=lambda item: item.index)
+        return np.asarray([item.embedding for item in dados], dtype="float32")
+
+
+class StubEmbedder:
+    """
+    Embedder determinístico e local (hashing de palavras), para testes e benchmarks offline.
+
+    Textos com palavras em comum ficam próximos, então a recuperação continua fazendo sentido
+    sem acesso à rede. `latencia` simula o tempo de uma requisição por chamada.
+    """
+
+    def __init__(self, dim=256, latencia=0.0):
+        self.dim = dim
+        self.latencia = latencia
+        self.nome = f"stub:{dim}"
+
+    def embed(self, textos):
+        if self.latencia:
+            time.sleep(self.latencia)
+        vetores = np.zeros((len(textos), self.dim), dtype="float32")
+        for i, texto in enumerate(textos):
+            for palavra in re.findall(r"\w+", (texto or "").lower()):
+                digest = hashlib.md5(palavra.encode("utf-8")).digest()
+                vetores[i, int.from_bytes(digest[:4], "little") % self.dim] += 1.0
+        normas = np.linalg.norm(vetores, axis=1, keepdims=True)
+        return vetores / np.where(normas == 0, 1.0, normas)
+
+
+def get_embedder(nome=None):
+    """Cria o embedder configurado em EMBEDDER ("openai" ou "stub")."""
+    nome = nome or get_setting("EMBEDDER", "openai")
+    if nome == "stub":
+        return StubEmbedder()
+    if nome == "openai":
+        return OpenAIEmbedder()
+    raise ValueError(f"Embedder desconhecido: {nome}")
+
+
+class EmbeddingCache:
+    """
+    Cache local (SQLite) de embeddings, indexado pelo hash de conteúdo da linha e pelo embedder.
+
+    Permite que uma nova ingestão reaproveite os vetores de linhas que não mudaram.
+    """
+
+    def __init__(self, caminho):
+        pasta = os.path.dirname(caminho)
+        if pasta:
+            os.makedirs(pasta, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(caminho, check_same_thread=False)
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS embeddings (
+                hash TEXT NOT NULL,
+                embedder TEXT NOT NULL,
+                vetor BLOB NOT NULL,
+                PRIMARY KEY (hash, embedder)
+            )"""
+        )
+        self._conn.commit()
+
+    def get_many(self, hashes, embedder_nome):
+        """Retorna {hash: vetor} para os hashes já presentes no cache."""
+        encontrados = {}
+        hashes = list(hashes)
+        with self._lock:
+            # Consultas em blocos para respeitar o limite de parâmetros do SQLite
+            for inicio in range(0, len(hashes), 500):
+                bloco = hashes[inicio:inicio + 500]
+                marcadores = ",".join("?" * len(bloco))
+                for chave, vetor in self._conn.execute(
+                    f"SELECT hash, vetor FROM embeddings WHERE embedder = ? AND hash IN ({marcadores})",
+                    (embedder_nome, *bloco),
+                ):
+                    encontrados[chave] = np.frombuffer(vetor, dtype="float32")
+        return encontrados
+
+    def put_many(self, itens, embedder_nome):
+        """Grava os pares (hash, vetor)."""
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (hash, embedder, vetor) VALUES (?, ?, ?)",
+                [(chave, embedder_nome, np.asarray(vetor, dtype="float32").tobytes()) for chave, vetor in itens],
+            )
+            self._conn.commit()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,38 @@
+import pandas as pd
+from io import BytesIO
+from openpyxl import Workbook
+from openpyxl.utils import get_column_letter
+
+from tracing import span
+
+NOME_ABA = 'Oportunidade de melhorias'
+
+def larguras_colunas(df):
+    """Largura de cada coluna (maior texto entre cabeçalho e valores), calculada numa passada vetorizada."""
+    if df.empty:
+        return [len(str(coluna)) for coluna in df.columns]
+    comprimentos = df.astype(str).apply(lambda coluna: coluna.str.len()).max()
+    return [max(int(comprimento), len(str(coluna))) for coluna, comprimento in zip(df.columns, comprimentos)]
+
+def _valor_celula(valor):
+    return None if pd.isna(valor) else valor
+
+def convert_df_to_excel(df):
+    """
+    Gera o XLSX com a aba de oportunidades usando o modo write-only do openpyxl, que grava as
+    linhas em streaming em vez de montar a planilha inteira em memória.
+    """
+    with span("exportacao_excel", linhas=len(df), colunas=len(df.columns)) as etapa:
+        workbook = Workbook(write_only=True)
+        sheet = workbook.create_sheet(NOME_ABA)
+        # No modo write-only as larguras precisam ser definidas antes das linhas
+        for col_idx, largura in enumerate(larguras_colunas(df), start=1):
+            sheet.column_dimensions[get_column_letter(col_idx)].width = largura + 2
+        sheet.append([str(coluna) for coluna in df.columns])
+        for linha in df.itertuples(index=False, name=None):
+            sheet.append([_valor_celula(valor) for valor in linha])
+
+        output = BytesIO()
+        workbook.save(output)
+        etapa.set(bytes=output.tell())
+        return output.getvalue()
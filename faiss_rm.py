@@ -0,0 +1,172 @@
+import argparse
+import json
+import os
+from collections import defaultdict
+
+import faiss
+import numpy as np
+import dspy
+
+try:
+    from dsp.utils import dotdict
+except ImportError:  # dspy >= 2.6
+    from dspy.dsp.utils import dotdict
+
+from base_loader import COLUNAS_BASE, carregar_base, texto_combinado
+from embeddings import get_embedder
+from filtered_rm import CAMPOS_FILTRO, buscar_em_etapas, termos
+from settings import get_setting
+
+ARQUIVO_INDICE = "index.faiss"
+ARQUIVO_PASSAGENS = "passagens.jsonl"
+ARQUIVO_META = "meta.json"
+
+# Rótulos usados no texto das passagens entregues ao Oportune
+_ROTULOS_PASSAGEM = {
+    "SEGMENTO_MERCADO": "Segmento",
+    "PROCESSO": "Processo",
+    "ATIVIDADE_RELACIONADA": "Atividade",
+    "MELHORIA_SUGERIDA": "Tipo de melhoria",
+    "GAPS": "Gap",
+    "CAUSA": "Causa",
+    "SOLUCAO": "Solução",
+    "GANHOS": "Ganhos",
+}
+
+
+def ler_indice_mapeado(caminho):
+    """
+    Abre o índice com os vetores mapeados do arquivo (sem cópia na memória do processo).
+
+    IO_FLAG_MMAP não mapeia um IndexFlat (os códigos são copiados); IO_FLAG_MMAP_IFC (faiss >= 1.9)
+    mapeia. Em versões sem essa flag, o índice é lido inteiro para a memória.
+
+    Retorna:
+    tuple: (índice, True se os vetores estão de fato mapeados do arquivo).
+    """
+    flag = getattr(faiss, "IO_FLAG_MMAP_IFC", None)
+    index = faiss.read_index(caminho, flag) if flag is not None else faiss.read_index(caminho)
+    return index, indice_mapeado(index)
+
+
+def indice_mapeado(index):
+    """True se os códigos do índice flat são uma view do arquivo, e não uma cópia do processo."""
+    codes = getattr(index, "codes", None)
+    return codes is not None and hasattr(codes, "is_owned") and not codes.is_owned
+
+
+def formatar_passagem(registro):
+    """Texto de uma linha da base no formato entregue como contexto ao Oportune."""
+    partes = [f"{rotulo}: {registro[coluna]}" for coluna, rotulo in _ROTULOS_PASSAGEM.items() if registro.get(coluna)]
+    return " | ".join(partes)
+
+
+def construir_indice(df_base, embedder, pasta, tamanho_lote=256):
+    """
+    Gera o índice FAISS (produto interno sobre vetores normalizados) a partir das linhas da base.
+
+    Grava em `pasta` o índice, as passagens com os metadados de cada linha e um meta.json com o
+    embedder usado, que precisa ser o mesmo na hora da consulta.
+    """
+    registros = df_base[COLUNAS_BASE].fillna("").astype(str).to_dict("records")
+    textos = [texto_combinado(registro) for registro in registros]
+    vetores = np.vstack([
+        embedder.embed(textos[inicio:inicio + tamanho_lote])
+        for inicio in range(0, len(textos), tamanho_lote)
+    ]).astype("float32")
+    faiss.normalize_L2(vetores)
+
+    index = faiss.IndexFlatIP(vetores.shape[1])
+    index.add(vetores)
+
+    os.makedirs(pasta, exist_ok=True)
+    faiss.write_index(index, os.path.join(pasta, ARQUIVO_INDICE))
+    with open(os.path.join(pasta, ARQUIVO_PASSAGENS), "w", encoding="utf-8") as f:
+        for registro in registros:
+            f.write(json.dumps({"texto": formatar_passagem(registro), **registro}, ensure_ascii=False) + "\n")
+    with open(os.path.join(pasta, ARQUIVO_META), "w", encoding="utf-8") as f:
+        json.dump({"embedder": embedder.nome, "dim": int(vetores.shape[1]), "linhas": len(registros)}, f)
+    return index.ntotal
+
+
+class FaissRM(dspy.Retrieve):
+    """
+    Retriever local sobre o índice FAISS gerado por construir_indice, com o mesmo contrato do WeaviateRM.
+
+    Os vetores do índice são mapeados do arquivo (ler_indice_mapeado), então várias instâncias (ex.: os
+    clientes do pool) compartilham as páginas do arquivo em vez de carregar cópias na memória; o
+    atributo `mapeado` indica se isso de fato aconteceu. Um índice invertido dos termos de
+    SEGMENTO_MERCADO e PROCESSO restringe a busca às linhas do ramo/processo da consulta, com
+    fallback para a base toda (ver filtered_rm.buscar_em_etapas).
+    """
+
+    def __init__(self, pasta, embedder=None, k=3):
+        with open(os.path.join(pasta, ARQUIVO_META), encoding="utf-8") as f:
+            meta = json.load(f)
+        self._embedder = embedder or get_embedder()
+        if self._embedder.nome != meta["embedder"]:
+            raise ValueError(
+                f"Índice em {pasta} foi gerado com {meta['embedder']}, mas o embedder atual é {self._embedder.nome}"
+            )
+        self._index, self.mapeado = ler_indice_mapeado(os.path.join(pasta, ARQUIVO_INDICE))
+        if not self.mapeado:
+            print(f"AVISO FAISS: índice em {pasta} carregado na memória do processo (sem memory-map)")
+        with open(os.path.join(pasta, ARQUIVO_PASSAGENS), encoding="utf-8") as f:
+            self._passagens = [json.loads(linha) for linha in f]
+        self._invertido = {propriedade: defaultdict(set) for propriedade in CAMPOS_FILTRO.values()}
+        for idx, passagem in enumerate(self._passagens):
+            for propriedade, termos_ids in self._invertido.items():
+                for termo in termos(passagem.get(propriedade)):
+                    termos_ids[termo].add(idx)
+        super().__init__(k=k)
+
+    def candidatos(self, filtro):
+        """Linhas que têm algum termo de cada propriedade do filtro ({propriedade: termos})."""
+        linhas = None
+        for propriedade, palavras in filtro.items():
+            encontradas = set().union(*(self._invertido[propriedade].get(palavra, ()) for palavra in palavras))
+            linhas = encontradas if linhas is None else linhas & encontradas
+        return linhas or set()
+
+    def forward(self, query_or_queries, k=None, **kwargs):
+        k = k if k is not None else self.k
+        queries = [query_or_queries] if isinstance(query_or_queries, str) else query_or_queries
+        queries = [q for q in queries if q]
+        if not queries:
+            return []
+        vetores = np.asarray(self._embedder.embed(queries), dtype="float32")
+        faiss.normalize_L2(vetores)
+
+        passages = []
+        for query, vetor in zip(queries, vetores):
+
+            def buscar(filtro, limite, vetor=vetor):
+                parametros = None
+                if filtro is not None:
+                    linhas = self.candidatos(filtro)
+                    if not linhas:
+                        return []
+                    parametros = faiss.SearchParameters(sel=faiss.IDSelectorBatch(np.fromiter(linhas, dtype="int64")))
+                scores, ids = self._index.search(vetor[None, :], limite, params=parametros)
+                return [
+                    dotdict({"long_text": self._passagens[idx]["texto"], "score": float(score), "prob": float(score)})
+                    for score, idx in zip(scores[0], ids[0]) if idx >= 0
+                ]
+
+            passages.extend(buscar_em_etapas(buscar, query, k))
+        return passages
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Gera o índice FAISS local a partir da Base.xlsx")
+    parser.add_argument("--base", default="Base.xlsx")
+    parser.add_argument("--pasta", default=get_setting("FAISS_INDEX_DIR", os.path.join(".cache", "faiss")))
+    parser.add_argument("--embedder", choices=["openai", "stub"], default=None)
+    args = parser.parse_args()
+
+    total = construir_indice(carregar_base(args.base), get_embedder(args.embedder), args.pasta)
+    print(f"Índice FAISS com {total} passagens gravado em {args.pasta}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+import re
+import unicodedata
+
+from dspy.retrieve.weaviate_rm import WeaviateRM
+
+from settings import get_setting
+from tracing import span_atual
+
+# Campos do prompt de diagnóstico (process.montar_prompt) e as propriedades da base que eles filtram
+CAMPOS_FILTRO = {"ramo_empresa": "SEGMENTO_MERCADO", "nome_do_processo": "PROCESSO"}
+
+_RE_CAMPO = re.compile(r"\b(ramo_empresa|nome_do_processo):\s*([^,\n]+)", re.IGNORECASE)
+_RE_PALAVRA = re.compile(r"\w+")
+_STOPWORDS = {"das", "dos", "nas", "nos", "para", "com", "por", "pela", "pelo", "uma", "que", "processo", "processos"}
+
+
+def termos(texto, sem_acentos=True):
+    """Palavras relevantes de `texto` (minúsculas, 3+ letras, sem stopwords) usadas para filtrar."""
+    texto = str(texto or "").casefold()
+    if sem_acentos:
+        texto = unicodedata.normalize("NFKD", texto).encode("ascii", "ignore").decode()
+    return sorted({palavra for palavra in _RE_PALAVRA.findall(texto) if len(palavra) > 2 and palavra not in _STOPWORDS})
+
+
+def extrair_filtros(consulta, sem_acentos=True):
+    """
+    Termos de filtro por propriedade a partir de uma consulta no formato de montar_prompt/montar_consulta.
+
+    Retorna:
+    dict: propriedade da base (SEGMENTO_MERCADO, PROCESSO) -> lista de termos; vazio se a consulta
+    não tiver os campos do formulário.
+    """
+    filtros = {}
+    for campo, valor in _RE_CAMPO.findall(consulta or ""):
+        palavras = termos(valor, sem_acentos)
+        if palavras:
+            filtros[CAMPOS_FILTRO[campo.lower()]] = palavras
+    return filtros
+
+
+def etapas_filtro(filtros):
+    """
+    Filtros tentados em ordem, do mais restrito ao mais amplo: segmento e processo, depois só o segmento.
+
+    Retorna:
+    list[tuple]: (nome da etapa, {propriedade: termos}); a busca global vem depois de todas.
+    """
+    etapas = []
+    if len(filtros) > 1:
+        etapas.append(("segmento+processo", filtros))
+    if "SEGMENTO_MERCADO" in filtros:
+        etapas.append(("segmento", {"SEGMENTO_MERCADO": filtros["SEGMENTO_MERCADO"]}))
+    elif filtros:
+        etapas.append(("processo", filtros))
+    return etapas
+
+
+def buscar_em_etapas(buscar, consulta, k, min_resultados=None, sem_acentos=True):
+    """
+    Busca com filtros de metadados, alargando o filtro até haver `min_resultados` passagens.
+
+    `buscar(filtro, k)` faz a busca vetorial restrita ao filtro ({propriedade: termos}, ou None para a
+    base toda) e devolve a lista de passagens (dotdict com long_text), da mais para a menos similar.
+    Passagens de etapas mais restritas vêm primeiro; as etapas seguintes só completam o que faltar.
+    A etapa usada é registrada no span atual (atributo `filtro`).
+    """
+    if min_resultados is None:
+        min_resultados = get_setting("RETRIEVAL_MIN_HITS", k)
+    min_resultados = min(min_resultados, k)
+    etapas = etapas_filtro(extrair_filtros(consulta, sem_acentos)) if get_setting("RETRIEVAL_FILTERS", True) else []
+
+    passagens, vistos, etapa_usada = [], set(), "global"
+    for nome, filtro in etapas + [("global", None)]:
+        for passagem in buscar(filtro, k):
+            if passagem["long_text"] not in vistos and len(passagens) < k:
+                vistos.add(passagem["long_text"])
+                passagens.append(passagem)
+        etapa_usada = nome
+        if len(passagens) >= min_resultados:
+            break
+
+    etapa = span_atual()
+    if etapa is not None:
+        etapa.set(filtro=etapa_usada)
+    return passagens
+
+
+class FilteredWeaviateRM(WeaviateRM):
+    """
+    WeaviateRM que restringe a busca pelas propriedades SEGMENTO_MERCADO e PROCESSO da coleção.
+
+    Os termos vêm do ramo_empresa e do nome_do_processo da consulta. Com poucos resultados
+    (configuração RETRIEVAL_MIN_HITS, padrão k), o filtro é alargado até a busca global, que é o
+    comportamento do WeaviateRM original.
+    """
+
+    def forward(self, query_or_queries, k=None, **kwargs):
+        k = k if k is not None else self.k
+        queries = [query_or_queries] if isinstance(query_or_queries, str) else query_or_queries
+        passages = []
+        for query in (q for q in queries if q):
+
+            def buscar(filtro, limite, query=query):
+                if filtro is None:
+                    return super(FilteredWeaviateRM, self).forward(query, k=limite, **kwargs)
+                return super(FilteredWeaviateRM, self).forward(
+                    query, k=limite, filters=self._filtro_weaviate(filtro), **kwargs
+                )
+
+            # A tokenização "word" do Weaviate preserva acentos: os termos seguem como digitados
+            passages.extend(buscar_em_etapas(buscar, query, k, sem_acentos=False))
+        return passages
+
+    @staticmethod
+    def _filtro_weaviate(filtro):
+        from weaviate.classes.query import Filter
+
+        condicoes = [Filter.by_property(propriedade).contains_any(palavras) for propriedade, palavras in filtro.items()]
+        return condicoes[0] if len(condicoes) == 1 else Filter.all_of(condicoes)
@@ -0,0 +1,221 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+import pandas as pd
+
+from settings import get_setting
+
+PENDENTE = "pendente"
+EXECUTANDO = "executando"
+CONCLUIDO = "concluido"
+ERRO = "erro"
+
+
+class JobQueue:
+    """
+    Fila persistente de análises (SQLite) com threads de trabalho próprias.
+
+    A interface só enfileira o job e consulta status/progresso/resultado pelo ID, então a análise
+    sobrevive a reruns, navegação e desconexões do navegador. Jobs que estavam em execução quando
+    o processo caiu voltam para a fila na próxima inicialização.
+    O progresso reportado pelo handler é gravado no máximo a cada `intervalo_progresso` segundos (a
+    interface consulta a cada segundo) e sempre ao fim do job. Jobs concluídos ou com erro há mais de
+    `ttl_segundos` são apagados na inicialização e periodicamente pelas threads de trabalho.
+    """
+
+    def __init__(self, caminho, handlers, workers=2, intervalo_poll=0.5, intervalo_progresso=1.0,
+                 ttl_segundos=24 * 3600):
+        self.caminho = caminho
+        self.handlers = handlers
+        self.workers = workers
+        self.intervalo_poll = intervalo_poll
+        self.intervalo_progresso = intervalo_progresso
+        self.ttl_segundos = ttl_segundos
+        self._ultima_limpeza = 0.0
+        self._lock = threading.Lock()
+        self._novo_job = threading.Event()
+        self._parar = threading.Event()
+        self._threads = []
+        pasta = os.path.dirname(caminho)
+        if pasta:
+            os.makedirs(pasta, exist_ok=True)
+        self._conn = sqlite3.connect(caminho, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                tipo TEXT NOT NULL,
+                status TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                progresso TEXT,
+                resultado TEXT,
+                erro TEXT,
+                criado REAL NOT NULL,
+                atualizado REAL NOT NULL
+            )"""
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs (status, criado)")
+
+    def start(self):
+        """Devolve à fila os jobs interrompidos, apaga os expirados e inicia as threads de trabalho."""
+        with self._lock:
+            self._conn.execute(
+                "UPDATE jobs SET status = ?, atualizado = ? WHERE status = ?", (PENDENTE, time.time(), EXECUTANDO)
+            )
+        self.limpar()
+        for numero in range(self.workers):
+            thread = threading.Thread(target=self._trabalhar, name=f"job-worker-{numero}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self, timeout=5):
+        self._parar.set()
+        self._novo_job.set()
+        for thread in self._threads:
+            thread.join(timeout)
+
+    def submit(self, tipo, payload):
+        """Enfileira um job e retorna seu ID."""
+        if tipo not in self.handlers:
+            raise ValueError(f"Tipo de job desconhecido: {tipo}")
+        job_id = uuid.uuid4().hex
+        agora = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO jobs (id, tipo, status, payload, criado, atualizado) VALUES (?, ?, ?, ?, ?, ?)",
+                (job_id, tipo, PENDENTE, json.dumps(payload, ensure_ascii=False), agora, agora),
+            )
+        self._novo_job.set()
+        return job_id
+
+    def get(self, job_id):
+        """
+        Estado do job: dict com status, progresso (dict do handler), resultado (DataFrame ou None),
+        erro e posição na fila; None se o ID não existir.
+        """
+        with self._lock:
+            linha = self._conn.execute(
+                "SELECT status, progresso, resultado, erro, criado FROM jobs WHERE id = ?", (job_id,)
+            ).fetchone()
+            if linha is None:
+                return None
+            posicao = None
+            if linha[0] == PENDENTE:
+                posicao = self._conn.execute(
+                    "SELECT COUNT(*) FROM jobs WHERE status = ? AND criado < ?", (PENDENTE, linha[4])
+                ).fetchone()[0] + 1
+        status, progresso, resultado, erro, _ = linha
+        return {
+            "status": status,
+            "progresso": json.loads(progresso) if progresso else {},
+            "resultado": pd.DataFrame(json.loads(resultado)) if resultado else None,
+            "erro": erro,
+            "posicao": posicao,
+        }
+
+    def limpar(self):
+        """
+        Apaga os jobs concluídos ou com erro cuja última atualização tem mais de `ttl_segundos`.
+
+        Retorna:
+        int: Quantidade de jobs apagados.
+        """
+        agora = time.time()
+        with self._lock:
+            self._ultima_limpeza = agora
+            return self._conn.execute(
+                "DELETE FROM jobs WHERE status IN (?, ?) AND atualizado < ?", (CONCLUIDO, ERRO, agora - self.ttl_segundos)
+            ).rowcount
+
+    def _claim(self):
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                linha = self._conn.execute(
+                    "SELECT id, tipo, payload FROM jobs WHERE status = ? ORDER BY criado LIMIT 1", (PENDENTE,)
+                ).fetchone()
+                if linha is not None:
+                    self._conn.execute(
+                        "UPDATE jobs SET status = ?, atualizado = ? WHERE id = ?", (EXECUTANDO, time.time(), linha[0])
+                    )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return linha
+
+    def _atualizar(self, job_id, **campos):
+        campos["atualizado"] = time.time()
+        atribuicoes = ", ".join(f"{nome} = ?" for nome in campos)
+        with self._lock:
+            self._conn.execute(f"UPDATE jobs SET {atribuicoes} WHERE id = ?", (*campos.values(), job_id))
+
+    def _trabalhar(self):
+        espera_erro = self.intervalo_poll
+        while not self._parar.is_set():
+            try:
+                job = self._claim()
+                if job is None and time.time() - self._ultima_limpeza > min(self.ttl_segundos, 3600):
+                    self.limpar()
+            except Exception as e:
+                # Banco bloqueado ou indisponível: o worker não pode morrer, tenta de novo com espera crescente
+                print(f"ERRO AO BUSCAR JOB NA FILA: {e}")
+                self._parar.wait(espera_erro)
+                espera_erro = min(espera_erro * 2, 30.0)
+                continue
+            espera_erro = self.intervalo_poll
+            if job is None:
+                self._novo_job.wait(self.intervalo_poll)
+                self._novo_job.clear()
+                continue
+            job_id, tipo, payload = job
+            # O handler reporta a cada evento; só o último progresso de cada intervalo é gravado
+            ultimo = {"gravado": 0.0, "pendente": None}
+
+            def reportar(progresso, job_id=job_id, ultimo=ultimo):
+                agora = time.monotonic()
+                if agora - ultimo["gravado"] < self.intervalo_progresso:
+                    ultimo["pendente"] = progresso
+                    return
+                ultimo.update(gravado=agora, pendente=None)
+                self._atualizar(job_id, progresso=self._serializar(progresso))
+
+            try:
+                resultado = self.handlers[tipo](json.loads(payload), reportar)
+                registros = resultado.fillna("").to_dict("records") if resultado is not None else []
+                campos = {"status": CONCLUIDO, "resultado": json.dumps(registros, ensure_ascii=False)}
+            except Exception as e:
+                print(f"ERRO NO JOB {job_id}: {e}")
+                campos = {"status": ERRO, "erro": str(e)}
+            if ultimo["pendente"] is not None:
+                campos["progresso"] = self._serializar(ultimo["pendente"])
+            self._atualizar(job_id, **campos)
+
+    @staticmethod
+    def _serializar(progresso):
+        return json.dumps(progresso, ensure_ascii=False, default=str)
+
+
+_fila = None
+_fila_lock = threading.Lock()
+
+
+def get_job_queue():
+    """Retorna a fila de jobs do processo, iniciando as threads de trabalho na primeira chamada."""
+    global _fila
+    with _fila_lock:
+        if _fila is None:
+            from process import executar_diagnostico
+
+            _fila = JobQueue(
+                get_setting("JOB_QUEUE_PATH", os.path.join(".cache", "jobs.sqlite")),
+                handlers={"diagnostico": executar_diagnostico},
+                workers=get_setting("JOB_WORKERS", 2),
+                ttl_segundos=get_setting("JOB_TTL_SEGUNDOS", 24 * 3600),
+            )
+            _fila.start()
+        return _fila
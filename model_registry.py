@@ -0,0 +1,94 @@
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+
+from dspy_DocsOportune import OportuneRAG
+from settings import get_setting
+
+MODELO_PADRAO = "modelo_oportune_08112024.json"
+
+
+class ModelRegistry:
+    """
+    Programas OportuneRAG compilados, carregados uma vez por processo e guardados pelo hash do arquivo.
+
+    A cada pedido o mtime/tamanho do arquivo é conferido: se mudou e o conteúdo é outro, a nova versão
+    é carregada sem reiniciar o processo; se a nova versão não carregar, a anterior segue em uso até o
+    arquivo mudar outra vez. Versões diferentes (arquivos diferentes, ou o mesmo arquivo antes e
+    depois de uma alteração) convivem no registro até `max_versoes`, descartando a menos usada.
+    """
+
+    def __init__(self, caminho_padrao=MODELO_PADRAO, max_versoes=4):
+        self.caminho_padrao = caminho_padrao
+        self.max_versoes = max_versoes
+        self._modelos = OrderedDict()
+        self._arquivos = {}
+        self._lock = threading.Lock()
+
+    def get(self, versao=None):
+        """
+        Retorna o programa compilado de uma versão.
+
+        Parâmetros:
+        versao (str, opcional): Caminho do JSON compilado (padrão: caminho_padrao).
+
+        Retorna:
+        tuple: (hash do arquivo, OportuneRAG). O programa é compartilhado entre threads e não deve ser alterado.
+        """
+        caminho = versao or self.caminho_padrao
+        stat = os.stat(caminho)
+        with self._lock:
+            conhecido = self._arquivos.get(caminho)
+            if conhecido and conhecido["assinatura"] == (stat.st_mtime_ns, stat.st_size) \
+                    and conhecido["hash"] in self._modelos:
+                return self._usar(conhecido["hash"])
+
+            with open(caminho, "rb") as f:
+                conteudo = f.read()
+            modelo_hash = hashlib.sha256(conteudo).hexdigest()
+            if modelo_hash not in self._modelos:
+                try:
+                    modelo = OportuneRAG()
+                    modelo.load_state(json.loads(conteudo), use_legacy_loading=True)
+                except Exception as e:
+                    print(f"ERRO CARREGANDO MODELO {caminho}: {e}")
+                    if conhecido and conhecido["hash"] in self._modelos:
+                        # Arquivo novo inválido (ex.: ainda sendo copiado): segue com a versão anterior
+                        # até o arquivo mudar de novo, sem reler nem registrar o erro a cada pedido
+                        self._arquivos[caminho] = {
+                            "assinatura": (stat.st_mtime_ns, stat.st_size), "hash": conhecido["hash"]
+                        }
+                        return self._usar(conhecido["hash"])
+                    raise
+                self._modelos[modelo_hash] = modelo
+                while len(self._modelos) > self.max_versoes:
+                    self._modelos.popitem(last=False)
+            self._arquivos[caminho] = {"assinatura": (stat.st_mtime_ns, stat.st_size), "hash": modelo_hash}
+            return self._usar(modelo_hash)
+
+    def versoes(self):
+        """Hashes das versões carregadas, da menos para a mais recentemente usada."""
+        with self._lock:
+            return list(self._modelos)
+
+    def _usar(self, modelo_hash):
+        self._modelos.move_to_end(modelo_hash)
+        return modelo_hash, self._modelos[modelo_hash]
+
+
+_registro = None
+_registro_lock = threading.Lock()
+
+
+def get_model_registry():
+    """Retorna o registro de modelos do processo (modelo padrão: configuração OPORTUNE_MODELO)."""
+    global _registro
+    with _registro_lock:
+        if _registro is None:
+            _registro = ModelRegistry(
+                get_setting("OPORTUNE_MODELO", MODELO_PADRAO),
+                max_versoes=get_setting("OPORTUNE_MAX_VERSOES_MODELO", 4),
+            )
+        return _registro
@@ -2,10 +2,17 @@ import os
 import sys
 from dotenv import load_dotenv
 import weaviate
-from dspy.retrieve.weaviate_rm import WeaviateRM
+import dsp
 import dspy
+from dspy.signatures.signature import signature_to_template
 from openai import OpenAI
-from dspy_DocsOportune import OportuneRAG
+from model_registry import get_model_registry
+from answer_cache import AnswerCache, get_answer_cache
+from filtered_rm import FilteredWeaviateRM
+from settings import get_setting
+from prompt_budget import ajustar_prompt
+from rate_limiter import get_rate_limiter, lm_openai
+from tracing import contar_tokens, span
 from weaviate.auth import AuthApiKey
 import streamlit as st
 class OportuneRAGClient:
@@ -13,25 +20,33 @@ class OportuneRAGClient:
         # Explicitly load .env file and print debug information
         load_dotenv()
        
+        # "weaviate" (Weaviate Cloud) ou "faiss" (índice local gerado por faiss_rm.py)
+        self.retriever_backend = get_setting("RETRIEVER_BACKEND", "weaviate")
+
         # Debug print environment variables
-        print("OPENAI_API_KEY:", "SET" if st.secrets["OPENAI_API_KEY"] else "NOT SET")
-        print("WEAVIATE_CLUSTER_URL:", st.secrets["WEAVIATE_URL"])
-        print("WEAVIATE_API_KEY:", "SET" if st.secrets["WEAVIATE_API_KEY"] else "NOT SET")
+        print("OPENAI_API_KEY:", "SET" if get_setting("OPENAI_API_KEY") else "NOT SET")
+        print("RETRIEVER_BACKEND:", self.retriever_backend)
         # Retrieve environment variables
-        self.secretk = st.secrets["OPENAI_API_KEY"]
-        print("self.secretk:",self.secretk)
-        self.weaviate_cluster_url = st.secrets["WEAVIATE_URL"]
-        self.weaviate_api_key = st.secrets["WEAVIATE_API_KEY"]
-        # Validate environment variables
-        if not all([self.secretk, self.weaviate_cluster_url, self.weaviate_api_key]):
+        self.secretk = get_setting("OPENAI_API_KEY")
+        if self.retriever_backend == "weaviate":
+            print("WEAVIATE_CLUSTER_URL:", st.secrets["WEAVIATE_URL"])
+            print("WEAVIATE_API_KEY:", "SET" if st.secrets["WEAVIATE_API_KEY"] else "NOT SET")
+            self.weaviate_cluster_url = st.secrets["WEAVIATE_URL"]
+            self.weaviate_api_key = st.secrets["WEAVIATE_API_KEY"]
+            # Validate environment variables
+            if not all([self.secretk, self.weaviate_cluster_url, self.weaviate_api_key]):
+                print("Error: Missing required environment variables")
+                sys.exit(1)
+        elif not self.secretk:
             print("Error: Missing required environment variables")
             sys.exit(1)
 
         self.client = OpenAI(api_key=self.secretk)
-        self.weaviate_client = self.setup_weaviate_client()
+        self.weaviate_client = self.setup_weaviate_client() if self.retriever_backend == "weaviate" else None
         self.params4o = self.setup_dspy_params()
-        self.modelo = OportuneRAG()
+        self.registro = get_model_registry()
         self.load_modelo()
+        self.cache = get_answer_cache()
 
             
 
@@ -57,37 +72,250 @@ class OportuneRAGClient:
 
     def setup_dspy_params(self):
         try:
-            if self.weaviate_client is None:
-                raise ValueError("Weaviate client is not initialized")
             return {
-                "lm": dspy.OpenAI(model='gpt-4o', max_tokens=2048, temperature=0.2),
-                "rm": WeaviateRM("DocsOportunidades", weaviate_client=self.weaviate_client,
-                                weaviate_collection_text_key="oportunidade_melhoria")
+                # Requisições ao LM passam pelo escalonador de cota do processo (rate_limiter.py)
+                "lm": lm_openai('gpt-4o', max_tokens=2048, temperature=0.2),
+                "rm": self.setup_retriever()
             }
         except Exception as e:
             print(f"ERRO DSpy.settings: {e}")
             return None
 
+    def setup_retriever(self):
+        if self.retriever_backend == "faiss":
+            from faiss_rm import FaissRM
+            return FaissRM(get_setting("FAISS_INDEX_DIR", os.path.join(".cache", "faiss")))
+        if self.weaviate_client is None:
+            raise ValueError("Weaviate client is not initialized")
+        # Filtra por SEGMENTO_MERCADO/PROCESSO antes da busca vetorial, com fallback para a coleção toda
+        return FilteredWeaviateRM("DocsOportunidades", weaviate_client=self.weaviate_client,
+                                  weaviate_collection_text_key="oportunidade_melhoria")
+
     def load_modelo(self):
+        """Carrega (ou reaproveita do registro) o modelo compilado padrão já na criação do cliente."""
         try:
-            caminho = r"modelo_oportune_08112024.json"
-            # Added use_legacy_loading=True to the load method
-            self.modelo.load(path=caminho, use_legacy_loading=True)
+            self.registro.get()
         except Exception as e:
             print(f"ERRO CARREGANDO MODELO: {e}")
 
-    def run_model(self, prompt):
+    def recuperar(self, consulta, versao=None):
+        """Passagens recuperadas para `consulta` com o retriever do modelo `versao` (lista de str)."""
+        if self.params4o is None:
+            raise ValueError("DSpy parameters not properly initialized")
+        _, modelo = self.registro.get(versao)
+        with dspy.context(**self.params4o), span("recuperacao", backend=self.retriever_backend) as etapa:
+            context = modelo.retrieve(consulta).passages
+            etapa.set(passagens=len(context))
+        return context
+
+    def run_model(self, prompt, modo="texto", usar_cache=True, versao=None, context=None, max_tokens=None):
+        """
+        Executa o OportuneRAG para o prompt.
+
+        modo="texto" retorna a resposta em markdown (str); modo="estruturado" retorna
+        diretamente a lista de oportunidades (list[dict]) com as cinco colunas da planilha.
+        Com usar_cache=True, respostas já geradas para o mesmo prompt, LM e modelo compilado (e as
+        mesmas passagens, quando `context` é informado) são lidas do cache em disco antes da
+        recuperação, sem chamar o retriever nem o LM.
+        `versao` escolhe o JSON compilado no registro de modelos (padrão: OPORTUNE_MODELO).
+        `context` reaproveita passagens já recuperadas (ex.: uma recuperação para vários direcionadores)
+        e `max_tokens` sobrescreve o limite de saída do LM nesta chamada.
+        """
         try:
             # Check if params are properly set
             if self.params4o is None:
                 raise ValueError("DSpy parameters not properly initialized")
-            dspy.settings.configure(**self.params4o)
-            resposta = self.modelo(question=prompt)
-            return resposta.answer
+            modelo_hash, modelo = self.registro.get(versao)
+            lm = self.params4o["lm"]
+            chave = self._chave_cache(prompt, context, modo, modelo_hash, max_tokens) if usar_cache else None
+            if chave is not None:
+                em_cache = self.cache.get(chave)
+                if em_cache is not None:
+                    with span("geracao", modo=modo, versao_modelo=modelo_hash[:12]) as etapa:
+                        etapa.set(cache="hit")
+                    return em_cache
+            # dspy.context é local à thread: o cliente pode ser usado a partir do pool compartilhado
+            if context is None:
+                context = self.recuperar(prompt, versao)
+            with dspy.context(**self.params4o):
+                ajustado = self._ajustar_prompt(modelo, prompt, context)
+                context = ajustado.context
+                with span("geracao", modo=modo, versao_modelo=modelo_hash[:12], **ajustado.relatorio) as etapa:
+                    chamadas_antes = len(lm.history)
+                    resposta = modelo(
+                        question=prompt, modo=modo, context=context, demos=ajustado.demos,
+                        config={"max_tokens": max_tokens} if max_tokens else None,
+                    )
+                    self._registrar_tokens(etapa, lm.history[chamadas_antes:])
+            resultado = resposta.oportunidades if modo == "estruturado" else resposta.answer
+            if chave is not None and resultado:
+                self.cache.put(chave, resultado)
+            return resultado
         except Exception as e:
             print(f"ERRO AO RODAR O MODELO: {e}")
             return None
 
+    def run_model_stream(self, prompt, usar_cache=True, versao=None):
+        """
+        Versão em streaming do run_model (modo texto): gera os trechos da resposta à medida
+        que o LM os produz, para a interface mostrar resultados parciais.
+
+        O prompt é o mesmo que o OportuneRAG compilado envia ao LM (template do ChainOfThought com as
+        demos do modelo, ver _prompt_compilado), chamando a API de chat da OpenAI com stream=True.
+        O raciocínio ("Reasoning: ...") não é repassado: os trechos começam depois do prefixo "Answer:".
+        A chave do cache é separada da do run_model (modo "texto-stream"), já que a geração não passa
+        pelas retentativas do dsp quando a resposta vem incompleta.
+        Em caso de acerto no cache, a resposta inteira é entregue em um único trecho.
+        """
+        if self.params4o is None:
+            raise ValueError("DSpy parameters not properly initialized")
+        modelo_hash, modelo = self.registro.get(versao)
+        chave = self._chave_cache(prompt, None, "texto-stream", modelo_hash) if usar_cache else None
+        if chave is not None:
+            em_cache = self.cache.get(chave)
+            if em_cache is not None:
+                yield em_cache
+                return
+        context = self.recuperar(prompt, versao)
+        ajustado = self._ajustar_prompt(modelo, prompt, context)
+        context = ajustado.context
+
+        lm_kwargs = self.params4o["lm"].kwargs
+        template, exemplo, texto_prompt = self._prompt_compilado(modelo, prompt, context, ajustado.demos)
+        prefixo = template.fields[-1].name
+        partes = []
+        inicio = None
+        uso = None
+        limiter = get_rate_limiter()
+        tokens_prompt = contar_tokens(texto_prompt, lm_kwargs["model"])
+        tokens_reservados = tokens_prompt + limiter.saida_esperada(lm_kwargs["model"], lm_kwargs.get("max_tokens", 2048))
+        with span("geracao", modo="texto", stream=True, versao_modelo=modelo_hash[:12], **ajustado.relatorio) as etapa:
+            stream = limiter.executar(
+                lm_kwargs["model"], self.client.chat.completions.create,
+                tokens=tokens_reservados,
+                model=lm_kwargs["model"],
+                temperature=lm_kwargs.get("temperature", 0.2),
+                max_tokens=lm_kwargs.get("max_tokens", 2048),
+                # Mesmo formato do dsp.GPT3 para modelos de chat: o prompt inteiro numa mensagem do usuário
+                messages=[{"role": "user", "content": texto_prompt}],
+                stream=True,
+                stream_options={"include_usage": True},
+            )
+            for chunk in stream:
+                if getattr(chunk, "usage", None):
+                    uso = chunk.usage
+                if not chunk.choices:
+                    continue
+                trecho = chunk.choices[0].delta.content
+                if not trecho:
+                    continue
+                partes.append(trecho)
+                if inicio is None:
+                    # Segura o raciocínio até o prefixo do campo answer aparecer
+                    texto = "".join(partes)
+                    posicao = texto.find(prefixo)
+                    if posicao < 0:
+                        continue
+                    inicio = posicao + len(prefixo)
+                    trecho = texto[inicio:].lstrip()
+                    if not trecho:
+                        continue
+                yield trecho
+            if uso is not None:
+                etapa.registrar_tokens(lm_kwargs["model"], uso.prompt_tokens, uso.completion_tokens)
+                limiter.ajustar(lm_kwargs["model"], tokens_reservados, uso.total_tokens)
+                limiter.registrar_saida(lm_kwargs["model"], uso.completion_tokens)
+            else:
+                etapa.registrar_tokens(lm_kwargs["model"], tokens_prompt, contar_tokens("".join(partes), lm_kwargs["model"]))
+        resposta = template.extract(exemplo, "".join(partes)).get("answer") if partes else None
+        if inicio is None and partes:
+            # Sem o prefixo "Answer:", a resposta é o que o template conseguir extrair (ou o texto todo)
+            resposta = resposta or "".join(partes)
+            yield resposta
+        if chave is not None and resposta:
+            self.cache.put(chave, resposta)
+
+    def _prompt_compilado(self, modelo, prompt, context, demos):
+        """
+        Prompt que o generate_answer do modelo compilado enviaria ao LM.
+
+        `demos` são os escolhidos por _ajustar_prompt; None usa as demos compiladas do preditor, como o Predict.
+
+        Retorna:
+        tuple: (template do dsp, exemplo com question/context/demos, texto do prompt).
+        """
+        template = signature_to_template(modelo.generate_answer.extended_signature)
+        demos = modelo.generate_answer.demos if demos is None else demos
+        exemplo = dsp.Example(demos=demos, question=prompt, context=context)
+        return template, exemplo, template(exemplo)
+
+    def _ajustar_prompt(self, modelo, prompt, context):
+        """Passagens e demos dentro do orçamento de tokens de entrada (ver prompt_budget.py)."""
+        return ajustar_prompt(
+            modelo.generate_answer.extended_signature,
+            modelo.generate_answer.demos,
+            prompt,
+            context,
+            modelo=self.params4o["lm"].kwargs.get("model", "gpt-4o"),
+        )
+
+    def _registrar_tokens(self, etapa, chamadas):
+        """Soma no span os tokens das chamadas registradas no histórico do LM (usage da API ou tiktoken)."""
+        modelo_lm = self.params4o["lm"].kwargs.get("model", "gpt-4o")
+        for chamada in chamadas:
+            resposta = chamada.get("response") or {}
+            uso = resposta.get("usage") if isinstance(resposta, dict) else None
+            if uso:
+                etapa.registrar_tokens(modelo_lm, uso.get("prompt_tokens", 0), uso.get("completion_tokens", 0))
+                continue
+            escolhas = resposta.get("choices", []) if isinstance(resposta, dict) else []
+            completion = "".join(
+                escolha.get("text") or (escolha.get("message") or {}).get("content") or "" for escolha in escolhas
+            )
+            etapa.registrar_tokens(
+                modelo_lm, contar_tokens(chamada.get("prompt", ""), modelo_lm), contar_tokens(completion, modelo_lm)
+            )
+
+    def _chave_cache(self, prompt, context, modo, modelo_hash, max_tokens=None):
+        """
+        Chave do cache de respostas, ou None se o cache estiver desabilitado.
+
+        Com `context` None a chave não depende das passagens, e pode ser consultada antes da
+        recuperação: o resultado do retriever é determinado pelo prompt e pelo modelo compilado.
+        """
+        if self.cache is None:
+            return None
+        lm = self.params4o["lm"]
+        return AnswerCache.make_key(
+            prompt=prompt,
+            passagens=context,
+            lm=type(lm).__name__,
+            lm_kwargs={**lm.kwargs, "max_tokens": max_tokens} if max_tokens else lm.kwargs,
+            modelo=modelo_hash,
+            modo=modo,
+        )
+
+    def is_healthy(self):
+        """Verifica se a conexão com o Weaviate e os parâmetros do DSpy continuam válidos."""
+        if self.params4o is None:
+            return False
+        if self.retriever_backend != "weaviate":
+            # Índice local: não há conexão a verificar
+            return True
+        try:
+            return self.weaviate_client is not None and self.weaviate_client.is_ready()
+        except Exception as e:
+            print(f"ERRO HEALTH CHECK WEAVIATE: {e}")
+            return False
+
+    def reconnect(self):
+        """Reabre a conexão com o Weaviate e reconstrói o retriever, mantendo o modelo já carregado."""
+        if self.retriever_backend == "weaviate":
+            self.close_weaviate_client()
+            self.weaviate_client = self.setup_weaviate_client()
+        self.params4o = self.setup_dspy_params()
+        return self.is_healthy()
+
     def close_weaviate_client(self):
         try:
             if self.weaviate_client:
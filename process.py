@@ -1,18 +1,342 @@
-from modeloDSpy import OportuneRAGClient
-from transform_input_to_df import transform_input_to_df
+import queue
+import re
+import unicodedata
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
-def run_agent_analysis(prompt):
+import pandas as pd
+
+from client_pool import get_client_pool
+from settings import get_setting
+from tracing import propagar, span
+from transform_input_to_df import COLUNAS, CONFIANCA_MINIMA, OportuneStreamParser, parse_oportune_answer, transform_input_to_df
+
+# Rótulo que abre o bloco de cada direcionador na resposta agrupada, ex.: "**Direcionador** : Automação"
+_RE_DIRECIONADOR = re.compile(
+    r"^[ \t>#*\-•]*direcionador(?:es)?[ \t*]*:[ \t*]*(.+?)[ \t*:]*$", re.IGNORECASE | re.MULTILINE
+)
+
+def montar_prompt(ramo_empresa, direcao, nome_processo, atividade, evento, causa):
+    """Monta o prompt de diagnóstico enviado ao OportuneRAGClient para um direcionador."""
+    return f"""ramo_empresa: {ramo_empresa}, direcionadores: {direcao}, nome_do_processo: {nome_processo}, atividade: {atividade}, evento: {evento}, causa: {causa}"""
+
+def montar_consulta(ramo_empresa, nome_processo, atividade, evento, causa):
+    """Consulta de recuperação com os campos comuns a todos os direcionadores do diagnóstico."""
+    return f"""ramo_empresa: {ramo_empresa}, nome_do_processo: {nome_processo}, atividade: {atividade}, evento: {evento}, causa: {causa}"""
+
+def montar_prompt_agrupado(direcionadores, ramo_empresa, nome_processo, atividade, evento, causa, oportunidades=10):
+    """
+    Prompt que pede as oportunidades de vários direcionadores em uma única geração.
+
+    A resposta deve trazer um bloco por direcionador, aberto pela linha "**Direcionador** : <nome>",
+    que dividir_por_direcionador usa para separar os resultados.
+    """
+    # Em uma linha só: o template do DSPy junta as linhas da pergunta
+    lista = "; ".join(f'"{direcao}"' for direcao in direcionadores)
+    return (
+        montar_prompt(ramo_empresa, "; ".join(direcionadores), nome_processo, atividade, evento, causa)
+        + f"\n\nAnalise cada direcionador abaixo separadamente, com as {oportunidades} melhores oportunidades para cada um. "
+        "Abra o bloco de cada direcionador com a linha **Direcionador** : <nome>, escrito exatamente como na lista, "
+        f"e siga o modelo de resposta dentro de cada bloco. Direcionadores a analisar: {lista}."
+    )
+
+def _normalizar(texto):
+    texto = unicodedata.normalize("NFKD", texto).encode("ascii", "ignore").decode()
+    return " ".join(re.sub(r"[^\w\s]", " ", texto).casefold().split())
+
+def dividir_por_direcionador(texto, direcionadores):
+    """
+    Separa a resposta agrupada nos blocos de cada direcionador.
+
+    Os rótulos são associados aos direcionadores pelo nome normalizado (sem acentos, pontuação
+    e caixa); blocos com rótulo irreconhecível são descartados, e não atribuídos por posição, para
+    que o direcionador fique ausente e seja analisado à parte. Sem nenhum rótulo, a resposta inteira só é atribuída quando há um único direcionador.
+
+    Retorna:
+    dict: direcionador -> trecho da resposta (direcionadores sem bloco ficam de fora).
+    """
+    rotulos = list(_RE_DIRECIONADOR.finditer(texto or ""))
+    if not rotulos:
+        return {direcionadores[0]: texto} if len(direcionadores) == 1 and texto else {}
+    nomes = {_normalizar(direcao): direcao for direcao in direcionadores}
+    blocos = {}
+    for i, match in enumerate(rotulos):
+        fim = rotulos[i + 1].start() if i + 1 < len(rotulos) else len(texto)
+        bloco = texto[match.end():fim].strip()
+        direcao = nomes.get(_normalizar(match.group(1)))
+        if direcao is not None and bloco:
+            blocos[direcao] = (blocos.get(direcao, "") + "\n\n" + bloco).strip()
+    return blocos
+
+def _transformar_bloco(bloco):
+    # Parser local primeiro; o agente só entra quando a confiança é baixa (como no streaming)
+    registros, confianca = parse_oportune_answer(bloco)
+    if registros and confianca >= CONFIANCA_MINIMA:
+        return pd.DataFrame(registros, columns=COLUNAS)
+    return transform_input_to_df(bloco)
+
+def run_agent_analysis(prompt, modo=None, usar_cache=True, versao_modelo=None):
     """
     Executa a análise utilizando os agentes OportuneRAGClient e transform_input_to_df.
+
+    O OportuneRAGClient é emprestado do pool compartilhado pelo processo, evitando refazer a
+    conexão com o Weaviate e o carregamento do modelo a cada direcionador.
     
     Parâmetros:
     prompt (str): Prompt a ser enviado para o agente OportuneRAGClient.
+    modo (str, opcional): "texto" (resposta em markdown + transform_input_to_df) ou
+        "estruturado" (oportunidades tipadas, sem etapa de transformação). Padrão: configuração
+        OPORTUNE_MODO ou "texto".
+    usar_cache (bool): Se False, ignora o cache de respostas e chama o LM novamente.
+    versao_modelo (str, opcional): JSON compilado a usar (ver model_registry); padrão OPORTUNE_MODELO.
     
     Retorna:
     pandas.DataFrame: Resultado da análise.
     """
-    client = OportuneRAGClient()
-    answer = client.run_model(prompt)
-    df = transform_input_to_df(answer)
-    client.close_weaviate_client()
-    return df
\ No newline at end of file
+    modo = modo or get_setting("OPORTUNE_MODO", "texto")
+    pool = get_client_pool()
+    with span("analise", modo=modo):
+        with pool.lease() as client:
+            answer = client.run_model(prompt, modo=modo, usar_cache=usar_cache, versao=versao_modelo)
+            if answer is None:
+                # run_model engole a exceção; força um health check antes do próximo uso
+                pool.report_failure(client)
+        with span("transformacao", modo=modo) as etapa:
+            if modo == "estruturado" and answer is not None:
+                return pd.DataFrame(answer, columns=COLUNAS)
+            df = transform_input_to_df(answer)
+            etapa.set(linhas=len(df) if isinstance(df, pd.DataFrame) else 0)
+        return df
+
+def run_agent_analysis_stream(prompt, usar_cache=True, versao_modelo=None):
+    """
+    Versão em streaming de run_agent_analysis (modo texto).
+
+    Gera eventos ("oportunidade", dict) assim que cada oportunidade da resposta fica completa e,
+    ao final, ("resultado", pandas.DataFrame) com todas elas. Se o parser local não tiver confiança
+    suficiente na resposta completa, o resultado final passa pelo transform_input_to_df (agente).
+    """
+    pool = get_client_pool()
+    parser = OportuneStreamParser()
+    with pool.lease() as client:
+        for trecho in client.run_model_stream(prompt, usar_cache=usar_cache, versao=versao_modelo):
+            for registro in parser.feed(trecho):
+                yield "oportunidade", registro
+    for registro in parser.close():
+        yield "oportunidade", registro
+
+    with span("transformacao", modo="texto") as etapa:
+        registros, confianca = parse_oportune_answer(parser.texto)
+        etapa.set(confianca=confianca)
+        if registros and confianca >= CONFIANCA_MINIMA:
+            resultado = pd.DataFrame(registros, columns=COLUNAS)
+        else:
+            resultado = transform_input_to_df(parser.texto)
+    yield "resultado", resultado
+
+def run_direcionadores_agrupados(campos, direcionadores, max_workers=None, usar_cache=True, versao_modelo=None,
+                                 por_chamada=None):
+    """
+    Gera as oportunidades de vários direcionadores com uma recuperação e poucas gerações (modo texto).
+
+    As passagens são recuperadas uma vez com os campos comuns do diagnóstico (montar_consulta) e os
+    direcionadores são enviados em grupos de `por_chamada` (padrão: configuração
+    DIRECIONADORES_POR_CHAMADA), cada grupo em uma chamada com limite de saída proporcional
+    (TOKENS_POR_DIRECIONADOR por direcionador). A resposta de cada grupo é dividida de volta por
+    direcionador; um direcionador sem bloco reconhecível na resposta é analisado sozinho, com
+    run_agent_analysis.
+
+    Retorna:
+    Gerador de tuplas (indice, direcionador, resultado, erro), como run_direcionadores.
+    """
+    por_chamada = por_chamada or get_setting("DIRECIONADORES_POR_CHAMADA", 4)
+    max_workers = max_workers or get_setting("MAX_CONCURRENT_DIRECIONADORES", 4)
+    tokens_por_direcionador = get_setting("TOKENS_POR_DIRECIONADOR", 2048)
+    pool = get_client_pool()
+    grupos = [list(enumerate(direcionadores))[i:i + por_chamada] for i in range(0, len(direcionadores), por_chamada)]
+
+    with pool.lease() as client:
+        context = client.recuperar(montar_consulta(**campos), versao_modelo)
+
+    def analisar_grupo(grupo):
+        nomes = [direcao for _, direcao in grupo]
+        with span("analise", modo="agrupado", direcionadores=len(nomes)):
+            with pool.lease() as client:
+                answer = client.run_model(
+                    montar_prompt_agrupado(nomes, **campos), modo="texto", usar_cache=usar_cache,
+                    versao=versao_modelo, context=context, max_tokens=min(16384, tokens_por_direcionador * len(nomes)),
+                )
+                if answer is None:
+                    pool.report_failure(client)
+                    raise RuntimeError("O modelo não retornou resposta para o grupo de direcionadores")
+            with span("transformacao", modo="agrupado") as etapa:
+                blocos = dividir_por_direcionador(answer, nomes)
+                etapa.set(blocos=len(blocos))
+                resultados = {direcao: _transformar_bloco(bloco) for direcao, bloco in blocos.items()}
+        for direcao in nomes:
+            if direcao in resultados:
+                continue
+            print(f"AVISO: direcionador '{direcao}' ausente da resposta agrupada; analisando separadamente")
+            try:
+                resultados[direcao] = run_agent_analysis(
+                    montar_prompt(direcao=direcao, **campos), "texto", usar_cache, versao_modelo
+                )
+            except Exception as e:
+                print(f"ERRO NA ANÁLISE DO DIRECIONADOR '{direcao}': {e}")
+                resultados[direcao] = e
+        return resultados
+
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(grupos))) as executor:
+        futures = {executor.submit(propagar(analisar_grupo), grupo): grupo for grupo in grupos}
+        for future in as_completed(futures):
+            grupo = futures[future]
+            try:
+                resultados = future.result()
+            except Exception as e:
+                print(f"ERRO NA ANÁLISE AGRUPADA DE {[direcao for _, direcao in grupo]}: {e}")
+                for indice, direcao in grupo:
+                    yield indice, direcao, None, e
+                continue
+            for indice, direcao in grupo:
+                if isinstance(resultados[direcao], Exception):
+                    yield indice, direcao, None, resultados[direcao]
+                else:
+                    yield indice, direcao, resultados[direcao], None
+
+def run_direcionadores(campos, direcionadores, max_workers=None, modo=None, usar_cache=True, versao_modelo=None,
+                       agrupado=None):
+    """
+    Executa run_agent_analysis para todos os direcionadores em paralelo, com concorrência limitada.
+
+    Parâmetros:
+    campos (dict): ramo_empresa, nome_processo, atividade, evento e causa do diagnóstico.
+    direcionadores (list): Direcionadores a analisar.
+    max_workers (int, opcional): Máximo de análises simultâneas
+        (padrão: configuração MAX_CONCURRENT_DIRECIONADORES).
+    modo (str, opcional): Modo de geração repassado para run_agent_analysis.
+    usar_cache (bool): Repassado para run_agent_analysis.
+    versao_modelo (str, opcional): Repassado para run_agent_analysis.
+    agrupado (bool, opcional): Usa run_direcionadores_agrupados (recuperação única e uma geração por
+        grupo de direcionadores, sempre em modo texto). Padrão: configuração DIRECIONADORES_AGRUPADOS.
+
+    Retorna:
+    Gerador de tuplas (indice, direcionador, resultado, erro) na ordem em que as análises
+    terminam; `indice` é a posição do direcionador na lista de entrada.
+    """
+    if isinstance(direcionadores, str):
+        direcionadores = [direcionadores]
+    if not direcionadores:
+        return
+    if get_setting("DIRECIONADORES_AGRUPADOS", False) if agrupado is None else agrupado:
+        yield from run_direcionadores_agrupados(campos, direcionadores, max_workers, usar_cache, versao_modelo)
+        return
+    max_workers = max_workers or get_setting("MAX_CONCURRENT_DIRECIONADORES", 4)
+
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(direcionadores))) as executor:
+        futures = {
+            executor.submit(
+                propagar(run_agent_analysis), montar_prompt(direcao=direcao, **campos), modo, usar_cache, versao_modelo
+            ): (indice, direcao)
+            for indice, direcao in enumerate(direcionadores)
+        }
+        for future in as_completed(futures):
+            indice, direcao = futures[future]
+            try:
+                yield indice, direcao, future.result(), None
+            except Exception as e:
+                print(f"ERRO NA ANÁLISE DO DIRECIONADOR '{direcao}': {e}")
+                yield indice, direcao, None, e
+
+def stream_direcionadores(campos, direcionadores, max_workers=None, modo=None, usar_cache=True, versao_modelo=None,
+                          agrupado=None):
+    """
+    Como run_direcionadores, mas repassa também os resultados parciais de cada direcionador.
+
+    No modo agrupado não há oportunidades parciais: cada grupo entrega seus resultados ao terminar.
+
+    Retorna:
+    Gerador de eventos (tipo, indice, direcionador, dado), consumido na thread que chama:
+    - ("oportunidade", i, d, dict): oportunidade completa já recebida do streaming (modo texto);
+    - ("resultado", i, d, DataFrame ou str): resultado final do direcionador;
+    - ("erro", i, d, Exception): a análise do direcionador falhou.
+    """
+    if isinstance(direcionadores, str):
+        direcionadores = [direcionadores]
+    if not direcionadores:
+        return
+    if get_setting("DIRECIONADORES_AGRUPADOS", False) if agrupado is None else agrupado:
+        for indice, direcao, resultado, erro in run_direcionadores_agrupados(
+            campos, direcionadores, max_workers, usar_cache, versao_modelo
+        ):
+            yield ("erro", indice, direcao, erro) if erro is not None else ("resultado", indice, direcao, resultado)
+        return
+    modo = modo or get_setting("OPORTUNE_MODO", "texto")
+    max_workers = max_workers or get_setting("MAX_CONCURRENT_DIRECIONADORES", 4)
+    eventos = queue.Queue()
+
+    def analisar(indice, direcao):
+        prompt = montar_prompt(direcao=direcao, **campos)
+        try:
+            with span("direcionador", direcionador=direcao):
+                if modo == "texto":
+                    for tipo, dado in run_agent_analysis_stream(prompt, usar_cache=usar_cache, versao_modelo=versao_modelo):
+                        eventos.put((tipo, indice, direcao, dado))
+                else:
+                    eventos.put(("resultado", indice, direcao, run_agent_analysis(prompt, modo, usar_cache, versao_modelo)))
+        except Exception as e:
+            print(f"ERRO NA ANÁLISE DO DIRECIONADOR '{direcao}': {e}")
+            eventos.put(("erro", indice, direcao, e))
+
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(direcionadores))) as executor:
+        for indice, direcao in enumerate(direcionadores):
+            executor.submit(propagar(analisar), indice, direcao)
+        pendentes = len(direcionadores)
+        while pendentes:
+            evento = eventos.get()
+            if evento[0] in ("resultado", "erro"):
+                pendentes -= 1
+            yield evento
+
+def executar_diagnostico(payload, reportar):
+    """
+    Handler dos jobs "diagnostico" da fila (job_queue): roda todos os direcionadores e reporta o
+    progresso de cada um (status e oportunidades já recebidas) a cada evento.
+
+    Parâmetros:
+    payload (dict): campos, direcionadores, modo (opcional), usar_cache, versao_modelo (opcional) e
+        agrupado (opcional, ver run_direcionadores).
+    reportar (callable): Recebe o dict de progresso atualizado.
+
+    Retorna:
+    pandas.DataFrame ou None: Resultados concatenados na ordem dos direcionadores, com a coluna Direcionador.
+    """
+    direcionadores = payload["direcionadores"]
+    with span("diagnostico", direcionadores=len(direcionadores)) as raiz:
+        progresso = {
+            "trace_id": raiz.trace_id,
+            "direcionadores": [
+                {"direcionador": direcao, "status": "executando", "oportunidades": [], "total": 0, "erro": None}
+                for direcao in direcionadores
+            ]
+        }
+        reportar(progresso)
+        resultados_ordenados = [None] * len(direcionadores)
+
+        eventos = stream_direcionadores(
+            payload["campos"], direcionadores, modo=payload.get("modo"), usar_cache=payload.get("usar_cache", True),
+            versao_modelo=payload.get("versao_modelo"), agrupado=payload.get("agrupado")
+        )
+        for tipo, indice, direcao, dado in eventos:
+            item = progresso["direcionadores"][indice]
+            if tipo == "oportunidade":
+                item["oportunidades"].append(dado)
+            elif tipo == "resultado" and isinstance(dado, pd.DataFrame):
+                dado['Direcionador'] = direcao
+                resultados_ordenados[indice] = dado
+                item.update(status="concluido", total=len(dado))
+            else:
+                item.update(status="erro", erro=str(dado))
+            reportar(progresso)
+
+        with span("montagem_dataframe"):
+            partes = [analyst for analyst in resultados_ordenados if analyst is not None]
+            return pd.concat(partes, ignore_index=True) if partes else None
@@ -1,11 +1,21 @@
 import os
 import sys
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from dotenv import load_dotenv
 import dspy
 from dspy.primitives.prediction import Prediction
 from dspy.teleprompt import BootstrapFewShot
 import re
 import streamlit as st
+from answer_cache import AnswerCache
+from rate_limiter import lm_openai
+from settings import get_setting
+from tracing import propagar, span
+
+# Bootstrapped demos per compiled program (also part of the cache key)
+MAX_BOOTSTRAPPED_DEMOS = 4
 
 class QuestionAnswerSignature(dspy.Signature):
     """Extract precise answers from given context"""
@@ -21,6 +31,96 @@ class QuestionAnswerModule(dspy.Module):
     def forward(self, context, question):
         return self.predictor(context=context, question=question)
 
+class CompiledProgramCache:
+    """
+    Compiled QuestionAnswerModule programs, kept in memory (LRU) and persisted as JSON state on disk.
+
+    Programs are addressed by a content hash (see ProcessImprovementQA._compile_key), so any
+    instance or process compiling the same training set, context and model configuration reuses
+    the same program. Concurrent requests for the same key compile only once.
+    """
+
+    def __init__(self, directory, max_programs=32):
+        self.directory = directory
+        self.max_programs = max_programs
+        self.hits = 0
+        self.misses = 0
+        self._programs = OrderedDict()
+        self._lock = threading.Lock()
+        self._key_locks = {}
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def get_or_compile(self, key, compile_fn):
+        """Return the program stored under `key`, calling `compile_fn()` only on a memory and disk miss."""
+        with self._lock:
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+        with key_lock:
+            with self._lock:
+                if key in self._programs:
+                    self._programs.move_to_end(key)
+                    self.hits += 1
+                    return self._programs[key]
+            program = self._load(key)
+            if program is None:
+                program = compile_fn()
+                self._save(key, program)
+                self.misses += 1
+            else:
+                self.hits += 1
+            with self._lock:
+                self._programs[key] = program
+                while len(self._programs) > self.max_programs:
+                    self._programs.popitem(last=False)
+                self._key_locks.pop(key, None)
+            return program
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.json")
+
+    def _load(self, key):
+        if not self.directory or not os.path.exists(self._path(key)):
+            return None
+        try:
+            program = QuestionAnswerModule()
+            program.load(self._path(key))
+            return program
+        except Exception as e:
+            print(f"ERRO AO CARREGAR PROGRAMA COMPILADO {key}: {e}")
+            return None
+
+    def _save(self, key, program):
+        if not self.directory:
+            return
+        temporary = f"{self._path(key)}.{threading.get_ident()}.tmp"
+        try:
+            # Written to a temporary file first: other processes never read a partial program
+            program.save(temporary)
+            os.replace(temporary, self._path(key))
+        except Exception as e:
+            print(f"ERRO AO GRAVAR PROGRAMA COMPILADO {key}: {e}")
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "programas": len(self._programs)}
+
+
+_compiled_cache = None
+_compiled_cache_lock = threading.Lock()
+
+
+def get_compiled_cache():
+    """Return the process-wide compiled program cache (directory: COMPILED_CACHE_DIR, empty = memory only)."""
+    global _compiled_cache
+    with _compiled_cache_lock:
+        if _compiled_cache is None:
+            _compiled_cache = CompiledProgramCache(
+                get_setting("COMPILED_CACHE_DIR", os.path.join(".cache", "compilados")),
+                max_programs=get_setting("COMPILED_CACHE_MAX_PROGRAMS", 32),
+            )
+        return _compiled_cache
+
+
 class ProcessImprovementQA:
     def __init__(self, api_key=None, model='gpt-4o-mini', max_tokens=2048, temperature=0.2):
         """
@@ -42,9 +142,14 @@ class ProcessImprovementQA:
         self.configure_model(model, max_tokens, temperature)
         
     def configure_model(self, model, max_tokens, temperature):
-        """Configure the OpenAI model for DSPy."""
-        openai_model = dspy.OpenAI(model=model, max_tokens=max_tokens, temperature=temperature)
-        dspy.settings.configure(lm=openai_model)
+        """
+        Configure the OpenAI model for DSPy.
+
+        The LM is kept on the instance and applied with dspy.context around each compile/prediction,
+        so instances with different models can be used from several threads.
+        """
+        self.lm = lm_openai(model, max_tokens=max_tokens, temperature=temperature)
+        self.model_config = {"model": model, "max_tokens": max_tokens, "temperature": temperature}
         
     def _create_context(self, ramo_empresa, direcao, nome_processo, atividade, evento, causa):
         """Create the context string from the given parameters."""
@@ -72,12 +177,13 @@ class ProcessImprovementQA:
         """
 
     def _create_train_examples(self, new_resultados, context, direcao):
-        """Create training examples from the provided data."""
+        """Create training examples from the provided data (direcao=None uses each row's Direcionador)."""
         train_examples = []
         for resultado in new_resultados:
+            direcao_exemplo = direcao if direcao is not None else resultado.get('Direcionador', '')
             example = dspy.Example(
                 context=context,
-                question=f"Oportunidade de Melhoria: {resultado['Oportunidade de Melhoria']}, Direcionadores: {direcao}",
+                question=f"Oportunidade de Melhoria: {resultado['Oportunidade de Melhoria']}, Direcionadores: {direcao_exemplo}",
                 answer=f"Solução: {resultado['Solução']} | Backlog de Atividades: {resultado['Backlog de Atividades']} | Investimento: {resultado['Investimento']} | Ganhos: {resultado['Ganhos']}"
             ).with_inputs('context', 'question')
             train_examples.append(example)
@@ -112,6 +218,36 @@ class ProcessImprovementQA:
         
         return result
 
+    def _compile_key(self, train_examples, context):
+        """Content hash of everything that determines the compiled program."""
+        return AnswerCache.make_key(
+            trainset=[example.toDict() for example in train_examples],
+            context=context,
+            model=self.model_config,
+            max_bootstrapped_demos=MAX_BOOTSTRAPPED_DEMOS,
+            signature=QuestionAnswerSignature.instructions,
+        )
+
+    def compile_module(self, new_resultados, context, direcao):
+        """
+        Return the BootstrapFewShot-compiled module for these results, compiling only on a cache miss.
+
+        Refining several opportunities of the same diagnosis shares one compiled program.
+        """
+        train_examples = self._create_train_examples(new_resultados, context, direcao)
+        key = self._compile_key(train_examples, context)
+
+        def compile_fn():
+            with span("compilacao_bootstrap", exemplos=len(train_examples)):
+                teleprompter = BootstrapFewShot(
+                    metric=self._validate_answer,
+                    max_bootstrapped_demos=MAX_BOOTSTRAPPED_DEMOS
+                )
+                with dspy.context(lm=self.lm):
+                    return teleprompter.compile(QuestionAnswerModule(), trainset=train_examples)
+
+        return get_compiled_cache().get_or_compile(key, compile_fn)
+
     def get_improvement_suggestion(self, new_resultados, oportunidade_melhoria, ramo_empresa, 
                                  direcao, nome_processo, atividade, evento, causa):
         """
@@ -134,20 +270,79 @@ class ProcessImprovementQA:
         context = self._create_context(ramo_empresa, direcao, nome_processo, 
                                      atividade, evento, causa)
         
-        # Create and compile QA module
-        train_examples = self._create_train_examples(new_resultados, context, direcao)
-        teleprompter = BootstrapFewShot(
-            metric=self._validate_answer,
-            max_bootstrapped_demos=4
-        )
-        compiled_module = teleprompter.compile(
-            QuestionAnswerModule(), 
-            trainset=train_examples
-        )
+        # Compiled QA module (reused across calls with the same results, context and model)
+        compiled_module = self.compile_module(new_resultados, context, direcao)
         
         # Generate answer
         question = f"Oportunidade de Melhoria: {oportunidade_melhoria}, Direcionadores: {direcao}"
-        prediction = compiled_module(context=context, question=question)
+        with dspy.context(lm=self.lm):
+            prediction = compiled_module(context=context, question=question)
         
         # Transform and return the answer
-        return self._transform_answer(prediction.answer)
\ No newline at end of file
+        return self._transform_answer(prediction.answer)
+
+    def refine_dataframe(self, df, ramo_empresa, nome_processo, atividade, evento, causa, max_workers=None):
+        """
+        Refine every opportunity of a results sheet with one shared compiled module.
+
+        The module is compiled once (or reused from the cache) with all rows as the training set,
+        each row using its own Direcionador, and the predictions run in parallel with at most
+        `max_workers` in flight (default: REFINEMENT_MAX_CONCURRENCY). Errors never propagate:
+        each row reports its own status.
+
+        Args:
+            df (pandas.DataFrame): Planilha Final rows (Oportunidade de Melhoria, Solução, Backlog de
+                Atividades, Investimento, Ganhos and, optionally, Direcionador)
+            ramo_empresa, nome_processo, atividade, evento, causa (str): Diagnosis fields
+
+        Returns:
+            pandas.DataFrame: Copy of `df` (same index and row order) with the refined fields
+            replaced, plus "Status" ("ok", "sem_resposta" or "erro") and "Erro" columns
+        """
+        max_workers = max_workers or get_setting("REFINEMENT_MAX_CONCURRENCY", 8)
+        refined = df.copy()
+        refined['Status'] = 'ok'
+        refined['Erro'] = None
+        if df.empty:
+            return refined
+
+        context = self._create_context(ramo_empresa, None, nome_processo, atividade, evento, causa)
+        rows = df.fillna('').astype(str).to_dict('records')
+        with span("refinamento", linhas=len(rows)) as etapa:
+            try:
+                compiled_module = self.compile_module(rows, context, direcao=None)
+            except Exception as e:
+                print(f"ERRO AO COMPILAR O REFINAMENTO: {e}")
+                refined['Status'] = 'erro'
+                refined['Erro'] = f"Compilação: {e}"
+                return refined
+
+            def refine(row):
+                question = f"Oportunidade de Melhoria: {row['Oportunidade de Melhoria']}, Direcionadores: {row.get('Direcionador', '')}"
+                with dspy.context(lm=self.lm):
+                    prediction = compiled_module(context=context, question=question)
+                return self._transform_answer(prediction.answer)
+
+            def set_value(position, column, value):
+                # Positional: the sheet index may repeat labels (e.g. concatenated results)
+                if column not in refined.columns:
+                    refined[column] = None
+                refined.iat[position, refined.columns.get_loc(column)] = value
+
+            with ThreadPoolExecutor(max_workers=min(max_workers, len(rows))) as executor:
+                futures = {executor.submit(propagar(refine), row): position for position, row in enumerate(rows)}
+                for future in as_completed(futures):
+                    position = futures[future]
+                    try:
+                        fields = future.result()
+                    except Exception as e:
+                        set_value(position, 'Status', 'erro')
+                        set_value(position, 'Erro', str(e))
+                        continue
+                    if not fields:
+                        set_value(position, 'Status', 'sem_resposta')
+                        continue
+                    for key, value in fields.items():
+                        set_value(position, key, value)
+            etapa.set(erros=int((refined['Status'] != 'ok').sum()))
+        return refined
@@ -0,0 +1,140 @@
+import logging
+import re
+from functools import lru_cache
+
+from settings import get_setting
+from tracing import contar_tokens, encoding_do_modelo
+
+# Menor fatia por passagem antes de começar a descartar as menos relevantes
+MIN_TOKENS_PASSAGEM = 64
+
+_RE_RAMO = re.compile(r"ramo_empresa:\s*([^,\n]+)", re.IGNORECASE)
+_RE_PALAVRA = re.compile(r"\w+")
+
+logger = logging.getLogger(__name__)
+
+
+def _ramo(texto):
+    match = _RE_RAMO.search(texto or "")
+    return match.group(1).strip().casefold() if match else None
+
+
+def _palavras(texto):
+    return {palavra.casefold() for palavra in _RE_PALAVRA.findall(texto or "") if len(palavra) > 2}
+
+
+def similaridade(pergunta, outra):
+    """Mesmo ramo_empresa vale 1 ponto, somado à sobreposição (Jaccard) das palavras das perguntas."""
+    palavras, outras = _palavras(pergunta), _palavras(outra)
+    jaccard = len(palavras & outras) / len(palavras | outras) if palavras | outras else 0.0
+    ramo = _ramo(pergunta)
+    return (1.0 if ramo and ramo == _ramo(outra) else 0.0) + jaccard
+
+
+def truncar(texto, max_tokens, modelo="gpt-4o"):
+    """Corta `texto` em `max_tokens` tokens, marcando o corte com reticências."""
+    encoding = encoding_do_modelo(modelo)
+    tokens = encoding.encode(texto, disallowed_special=())
+    if len(tokens) <= max_tokens:
+        return texto
+    # Reserva um token para as reticências
+    return encoding.decode(tokens[:max_tokens - 1]).rstrip() + "…"
+
+
+@lru_cache(maxsize=16)
+def _tokens_fixos(signature, modelo):
+    # Instruções e descrições dos campos, repetidas em toda chamada
+    partes = [signature.instructions or ""]
+    for campo in {**signature.input_fields, **signature.output_fields}.values():
+        extra = campo.json_schema_extra or {}
+        partes.append(f"{extra.get('prefix', '')} {extra.get('desc', '')}")
+    return contar_tokens("\n".join(partes), modelo)
+
+
+class PromptAjustado:
+    """Passagens e demos escolhidos para caber no orçamento, com o relatório dos tamanhos."""
+
+    def __init__(self, context, demos, relatorio):
+        self.context = context
+        self.demos = demos
+        self.relatorio = relatorio
+
+
+def ajustar_prompt(signature, demos, question, context, limite_tokens=None, max_demos=None, modelo="gpt-4o"):
+    """
+    Monta a entrada do Oportune dentro de um orçamento de tokens de entrada.
+
+    Os tokens são contados com tiktoken antes da chamada: instruções e descrições da assinatura e a
+    pergunta são fixas; do que sobra, os demos compatíveis com a assinatura (que têm question e
+    answer) entram por ordem de similaridade com a pergunta (mesmo ramo_empresa primeiro) até
+    `max_demos`, e as passagens recebem fatias iguais, truncadas, descartando as últimas (menos
+    relevantes) se nem o mínimo por passagem couber.
+
+    Parâmetros:
+    signature: Assinatura DSPy usada na geração.
+    demos (list): Demos do preditor compilado.
+    question (str): Prompt do diagnóstico.
+    context (list[str]): Passagens recuperadas, da mais para a menos relevante.
+    limite_tokens (int, opcional): Orçamento (padrão: PROMPT_BUDGET_TOKENS; 0, o padrão, desliga o
+        ajuste e o programa compilado recebe todas as suas demos e passagens).
+    max_demos (int, opcional): Máximo de demos (padrão: PROMPT_MAX_DEMOS, ou todas as demos compiladas).
+
+    Retorna:
+    PromptAjustado: context, demos (None quando não há ajuste) e relatorio com os tamanhos estimados.
+    Demos ou passagens cortadas pelo orçamento são registradas no log.
+    """
+    limite_tokens = get_setting("PROMPT_BUDGET_TOKENS", 0) if limite_tokens is None else limite_tokens
+    max_demos = get_setting("PROMPT_MAX_DEMOS", len(demos)) if max_demos is None else max_demos
+    context = [str(passagem) for passagem in context]
+
+    fixos = _tokens_fixos(signature, modelo) + contar_tokens(question, modelo)
+    tokens_passagens = [contar_tokens(passagem, modelo) for passagem in context]
+    compativeis = [demo for demo in demos if demo.get("question") and demo.get("answer")]
+    relatorio = {
+        "orcamento": limite_tokens,
+        "tokens_fixos": fixos,
+        "tokens_originais": fixos + sum(tokens_passagens),
+        "demos_incompativeis": len(demos) - len(compativeis),
+    }
+    if not limite_tokens:
+        relatorio.update(tokens_estimados=relatorio["tokens_originais"], demos=None, passagens=len(context))
+        return PromptAjustado(context, None, relatorio)
+
+    disponivel = limite_tokens - fixos
+
+    escolhidos, tokens_demos = [], 0
+    for demo in sorted(compativeis, key=lambda demo: similaridade(question, demo["question"]), reverse=True):
+        if len(escolhidos) >= max_demos:
+            break
+        tamanho = contar_tokens(f"{demo['question']}\n{demo.get('context', '')}\n{demo['answer']}", modelo)
+        # Demos nunca ocupam mais da metade do que sobra: as passagens têm prioridade
+        if tokens_demos + tamanho > disponivel // 2:
+            continue
+        escolhidos.append(demo)
+        tokens_demos += tamanho
+    disponivel -= tokens_demos
+
+    passagens = list(context)
+    while passagens and disponivel // len(passagens) < MIN_TOKENS_PASSAGEM and len(passagens) > 1:
+        passagens.pop()
+    if passagens and sum(tokens_passagens[:len(passagens)]) > disponivel:
+        fatia = max(MIN_TOKENS_PASSAGEM, disponivel // len(passagens))
+        passagens = [truncar(passagem, fatia, modelo) for passagem in passagens]
+
+    tokens_estimados = fixos + tokens_demos + sum(contar_tokens(passagem, modelo) for passagem in passagens)
+    relatorio.update(
+        tokens_estimados=tokens_estimados,
+        tokens_demos=tokens_demos,
+        demos=len(escolhidos),
+        passagens=len(passagens),
+        passagens_truncadas=sum(
+            1 for original, ajustada in zip(context, passagens) if original != ajustada
+        ),
+    )
+    if len(escolhidos) < len(compativeis) or len(passagens) < len(context) or relatorio["passagens_truncadas"]:
+        logger.info(
+            "Orçamento de %d tokens: %d de %d demos, %d de %d passagens (%d truncadas)",
+            limite_tokens, len(escolhidos), len(compativeis), len(passagens), len(context),
+            relatorio["passagens_truncadas"],
+        )
+    return PromptAjustado(passagens, escolhidos, relatorio)
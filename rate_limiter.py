@@ -0,0 +1,525 @@
+import contextvars
+import heapq
+import itertools
+import json
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+from tenacity import Retrying, retry_if_exception, stop_after_attempt, wait_exponential_jitter
+
+from settings import get_setting
+from tracing import contar_tokens
+
+# Faixas de prioridade: com a cota disputada, a menor faixa é atendida primeiro
+INTERATIVO = 0
+LOTE = 1
+INGESTAO = 2
+
+# Limites por minuto de referência (requisições e tokens). Só os modelos listados na configuração
+# RATE_LIMITS têm cota controlada; estes valores completam as chaves que a configuração não trouxer.
+LIMITES_PADRAO = {
+    "gpt-4o": {"rpm": 500, "tpm": 30000},
+    "gpt-4o-mini": {"rpm": 500, "tpm": 200000},
+    "text-embedding-ada-002": {"rpm": 3000, "tpm": 1000000},
+}
+
+# Dimensão sem limite conhecido (ex.: só "tpm" configurado para um modelo fora de LIMITES_PADRAO)
+SEM_LIMITE = 1e12
+
+_prioridade = contextvars.ContextVar("prioridade", default=None)
+_prioridade_padrao = INTERATIVO
+
+
+def set_prioridade_padrao(nivel):
+    """
+    Prioridade das chamadas do processo sem `prioridade()` explícita (ex.: LOTE no batch_cli).
+
+    Com limites em RATE_LIMITS e a cota compartilhada (RATE_LIMITS_COMPARTILHADO), a faixa também vale
+    entre processos: o lote espera enquanto o app tiver uma chamada INTERATIVO aguardando cota do
+    mesmo modelo.
+    """
+    global _prioridade_padrao
+    _prioridade_padrao = nivel
+
+
+def prioridade_atual():
+    nivel = _prioridade.get()
+    return _prioridade_padrao if nivel is None else nivel
+
+
+@contextmanager
+def prioridade(nivel):
+    """Define a faixa de prioridade das chamadas feitas dentro do bloco (nesta thread/contexto)."""
+    token = _prioridade.set(nivel)
+    try:
+        yield
+    finally:
+        _prioridade.reset(token)
+
+
+class _Balde:
+    """Token bucket com capacidade por minuto, reabastecido continuamente."""
+
+    def __init__(self, por_minuto, disponivel=None, atualizado=None):
+        self.capacidade = float(por_minuto)
+        self.disponivel = self.capacidade if disponivel is None else min(self.capacidade, disponivel)
+        self.taxa = self.capacidade / 60.0
+        self.atualizado = time.monotonic() if atualizado is None else atualizado
+
+    def _recarregar(self, agora):
+        self.disponivel = min(self.capacidade, self.disponivel + (agora - self.atualizado) * self.taxa)
+        self.atualizado = agora
+
+    def espera(self, quantidade, agora):
+        """Segundos até haver `quantidade` disponível (pedidos maiores que a capacidade esperam o balde cheio)."""
+        self._recarregar(agora)
+        falta = min(quantidade, self.capacidade) - self.disponivel
+        return max(0.0, falta / self.taxa)
+
+    def consumir(self, quantidade):
+        self.disponivel -= min(quantidade, self.capacidade)
+
+    def devolver(self, quantidade):
+        self.disponivel = min(self.capacidade, self.disponivel + quantidade)
+
+    def esvaziar(self):
+        self.disponivel = min(self.disponivel, 0.0)
+
+
+def _status_http(erro):
+    status = getattr(erro, "status_code", None)
+    if status is None:
+        status = getattr(getattr(erro, "response", None), "status_code", None)
+    return status
+
+
+def erro_transitorio(erro):
+    """429 (exceto cota esgotada), 5xx, timeout e falha de conexão valem nova tentativa."""
+    if getattr(erro, "code", None) == "insufficient_quota":
+        return False
+    status = _status_http(erro)
+    if status is not None:
+        return status == 429 or status >= 500
+    try:
+        import openai
+    except ImportError:
+        return False
+    return isinstance(erro, (openai.APIConnectionError, openai.APITimeoutError))
+
+
+def _retry_after(erro):
+    cabecalhos = getattr(getattr(erro, "response", None), "headers", None) or {}
+    try:
+        return float(cabecalhos.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+
+class CotaCompartilhada:
+    """
+    Buckets e esperas em SQLite, compartilhados pelos processos da máquina (app, batch_cli, ingestão).
+
+    Os buckets usam o relógio de parede para que todos os processos recarreguem a mesma cota. Cada
+    processo registra a chamada que está na frente da sua fila (modelo e faixa) e renova o registro
+    enquanto espera; uma chamada só consome cota se nenhum outro processo tiver uma de faixa menor
+    esperando pelo mesmo modelo. Registros não renovados em `validade` segundos (processo que caiu)
+    são ignorados.
+    """
+
+    def __init__(self, caminho, validade=5.0, intervalo=0.25):
+        self.caminho = caminho
+        self.validade = validade
+        self.intervalo = intervalo
+        pasta = os.path.dirname(caminho)
+        if pasta:
+            os.makedirs(pasta, exist_ok=True)
+        self._conn = sqlite3.connect(caminho, check_same_thread=False, isolation_level=None, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS baldes (nome TEXT PRIMARY KEY, disponivel REAL NOT NULL, atualizado REAL NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS esperas (id TEXT PRIMARY KEY, modelo TEXT NOT NULL, nivel INTEGER NOT NULL, "
+            "visto REAL NOT NULL)"
+        )
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def _transacao(self):
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield self._conn
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")
+
+    @staticmethod
+    def _ler(conn, modelo, limites, agora):
+        baldes = []
+        for tipo in ("rpm", "tpm"):
+            linha = conn.execute("SELECT disponivel, atualizado FROM baldes WHERE nome = ?", (f"{modelo}:{tipo}",)).fetchone()
+            baldes.append(_Balde(limites[tipo], *(linha or (None, agora))))
+        return baldes
+
+    @staticmethod
+    def _gravar(conn, modelo, baldes):
+        for tipo, balde in zip(("rpm", "tpm"), baldes):
+            conn.execute(
+                "INSERT OR REPLACE INTO baldes (nome, disponivel, atualizado) VALUES (?, ?, ?)",
+                (f"{modelo}:{tipo}", balde.disponivel, balde.atualizado),
+            )
+
+    def reservar(self, id_espera, modelo, limites, tokens, nivel):
+        """
+        Tenta consumir 1 requisição e `tokens` tokens da cota de `modelo`.
+
+        Retorna:
+        float: 0 se a cota foi consumida; senão, segundos até tentar de novo (no máximo `intervalo`,
+        para renovar o registro de espera e enxergar as outras faixas).
+        """
+        agora = time.time()
+        with self._transacao() as conn:
+            conn.execute("DELETE FROM esperas WHERE visto < ?", (agora - self.validade,))
+            conn.execute(
+                "INSERT OR REPLACE INTO esperas (id, modelo, nivel, visto) VALUES (?, ?, ?, ?)",
+                (id_espera, modelo, nivel, agora),
+            )
+            prioritaria = conn.execute(
+                "SELECT MIN(nivel) FROM esperas WHERE modelo = ? AND id != ?", (modelo, id_espera)
+            ).fetchone()[0]
+            if prioritaria is not None and prioritaria < nivel:
+                return self.intervalo
+            requisicoes, tokens_balde = self._ler(conn, modelo, limites, agora)
+            espera = max(requisicoes.espera(1, agora), tokens_balde.espera(tokens, agora))
+            if espera == 0:
+                requisicoes.consumir(1)
+                tokens_balde.consumir(tokens)
+                conn.execute("DELETE FROM esperas WHERE id = ?", (id_espera,))
+            self._gravar(conn, modelo, (requisicoes, tokens_balde))
+        return min(espera, self.intervalo)
+
+    def desistir(self, id_espera):
+        with self._transacao() as conn:
+            conn.execute("DELETE FROM esperas WHERE id = ?", (id_espera,))
+
+    def ajustar(self, modelo, limites, diferenca):
+        """Devolve (diferenca > 0) ou cobra (diferenca < 0) tokens do bucket de tokens de `modelo`."""
+        agora = time.time()
+        with self._transacao() as conn:
+            baldes = self._ler(conn, modelo, limites, agora)
+            baldes[1]._recarregar(agora)
+            if diferenca > 0:
+                baldes[1].devolver(diferenca)
+            else:
+                baldes[1].consumir(-diferenca)
+            self._gravar(conn, modelo, baldes)
+
+    def esvaziar(self, modelo, limites):
+        agora = time.time()
+        with self._transacao() as conn:
+            baldes = self._ler(conn, modelo, limites, agora)
+            for balde in baldes:
+                balde._recarregar(agora)
+                balde.esvaziar()
+            self._gravar(conn, modelo, baldes)
+
+
+class RateLimiter:
+    """
+    Escalonador de chamadas à OpenAI.
+
+    Cada modelo tem dois token buckets (requisições e tokens por minuto). As chamadas reservam a
+    estimativa de tokens antes de sair e esperam em fila por prioridade (INTERATIVO antes de LOTE e
+    INGESTAO); depois da resposta, a reserva é ajustada ao uso real. Um 429 esvazia os buckets do
+    modelo, segurando todas as chamadas até a cota se recompor, e a chamada é repetida com backoff
+    exponencial com jitter (respeitando o Retry-After).
+    Sem `compartilhada`, os buckets e a fila valem só para o processo; com uma CotaCompartilhada, a
+    fila do processo decide qual chamada tenta primeiro e os buckets e as faixas de prioridade são
+    os mesmos para todos os processos que usam o mesmo arquivo.
+    """
+
+    def __init__(self, limites=None, tentativas=6, espera_maxima=60.0, compartilhada=None):
+        self.limites = mesclar_limites(limites)
+        self.tentativas = tentativas
+        self.espera_maxima = espera_maxima
+        self.compartilhada = compartilhada
+        self._baldes = {}
+        self._fila = []
+        self._sequencia = itertools.count()
+        self._cond = threading.Condition()
+        self._prefixo_espera = f"{os.getpid()}:{id(self)}"
+        self._saida_media = {}
+
+    def _nome_limite(self, modelo):
+        # Prefixo mais longo: "gpt-4o-mini-2024-07-18" usa os limites de "gpt-4o-mini"
+        return next((nome for nome in sorted(self.limites, key=len, reverse=True)
+                     if modelo and modelo.startswith(nome)), None)
+
+    def saida_esperada(self, modelo, maxima):
+        """
+        Tokens de saída a reservar para uma chamada com limite `maxima`.
+
+        Usa a média móvel das saídas já observadas no modelo (com 25% de folga) em vez do máximo; antes
+        da primeira observação, metade do máximo. O ajustar corrige a diferença após a resposta.
+        """
+        media = self._saida_media.get(self._nome_limite(modelo))
+        if media is None:
+            return maxima // 2
+        return min(maxima, int(media * 1.25) + 1)
+
+    def registrar_saida(self, modelo, tokens_saida):
+        """Atualiza a média móvel de tokens de saída do modelo (ver saida_esperada)."""
+        nome = self._nome_limite(modelo)
+        if nome is None or tokens_saida is None:
+            return
+        with self._cond:
+            media = self._saida_media.get(nome)
+            self._saida_media[nome] = tokens_saida if media is None else 0.8 * media + 0.2 * tokens_saida
+
+    def _baldes_do_modelo(self, modelo):
+        nome = self._nome_limite(modelo)
+        if nome is None:
+            return None
+        if nome not in self._baldes:
+            self._baldes[nome] = (_Balde(self.limites[nome]["rpm"]), _Balde(self.limites[nome]["tpm"]))
+        return self._baldes[nome]
+
+    def _reservar(self, modelo, tokens, nivel, id_espera):
+        """Segundos até a próxima tentativa da chamada da frente da fila (0 = cota consumida)."""
+        if self.compartilhada is not None:
+            nome = self._nome_limite(modelo)
+            return self.compartilhada.reservar(id_espera, nome, self.limites[nome], tokens, nivel)
+        requisicoes, tokens_balde = self._baldes_do_modelo(modelo)
+        agora = time.monotonic()
+        espera = max(requisicoes.espera(1, agora), tokens_balde.espera(tokens, agora))
+        if espera == 0:
+            requisicoes.consumir(1)
+            tokens_balde.consumir(tokens)
+        return espera
+
+    def acquire(self, modelo, tokens, nivel=None):
+        """Bloqueia até o modelo ter cota para uma requisição de `tokens` tokens (modelos sem limite passam direto)."""
+        nivel = prioridade_atual() if nivel is None else nivel
+        with self._cond:
+            if self._nome_limite(modelo) is None:
+                return
+            entrada = (nivel, next(self._sequencia), modelo)
+            id_espera = f"{self._prefixo_espera}:{entrada[1]}"
+            heapq.heappush(self._fila, entrada)
+            espera = None
+            try:
+                while True:
+                    primeiro = min(item for item in self._fila if item[2] == modelo)
+                    espera = None
+                    if primeiro is entrada:
+                        espera = self._reservar(modelo, tokens, nivel, id_espera)
+                        if espera == 0:
+                            return
+                    self._cond.wait(timeout=espera)
+            finally:
+                self._fila.remove(entrada)
+                heapq.heapify(self._fila)
+                self._cond.notify_all()
+                if self.compartilhada is not None and espera != 0:
+                    self.compartilhada.desistir(id_espera)
+
+    def ajustar(self, modelo, reservados, usados):
+        """Devolve (ou cobra) a diferença entre os tokens reservados e os realmente usados."""
+        with self._cond:
+            if self.compartilhada is not None:
+                nome = self._nome_limite(modelo)
+                if nome is not None:
+                    self.compartilhada.ajustar(nome, self.limites[nome], reservados - usados)
+                self._cond.notify_all()
+                return
+            baldes = self._baldes_do_modelo(modelo)
+            if baldes is None:
+                return
+            if usados < reservados:
+                baldes[1].devolver(reservados - usados)
+            else:
+                baldes[1].consumir(usados - reservados)
+            self._cond.notify_all()
+
+    def penalizar(self, modelo):
+        """Após um 429, zera a cota do modelo para que as próximas chamadas esperem a recomposição."""
+        with self._cond:
+            if self.compartilhada is not None:
+                nome = self._nome_limite(modelo)
+                if nome is not None:
+                    self.compartilhada.esvaziar(nome, self.limites[nome])
+                return
+            baldes = self._baldes_do_modelo(modelo)
+            if baldes is not None:
+                for balde in baldes:
+                    balde.esvaziar()
+
+    def _espera_retry(self, estado):
+        espera = wait_exponential_jitter(initial=1, max=self.espera_maxima)(estado)
+        return max(espera, _retry_after(estado.outcome.exception()) or 0.0)
+
+    def executar(self, modelo, funcao, *args, tokens=0, saida_maxima=0, nivel=None, tokens_usados=None, **kwargs):
+        """
+        Chama `funcao(*args, **kwargs)` respeitando a cota do `modelo`, com novas tentativas em erros transitórios.
+
+        Parâmetros:
+        modelo (str): Modelo da OpenAI (define os buckets usados).
+        tokens (int): Tokens de entrada da chamada (ou a estimativa total, com saida_maxima=0).
+        saida_maxima (int): Limite de tokens de saída; a reserva soma só a saída esperada (saida_esperada).
+        nivel (int, opcional): Faixa de prioridade (padrão: prioridade_atual()).
+        tokens_usados (callable, opcional): Extrai do resultado o total de tokens realmente usado.
+        """
+        entrada = tokens
+        tokens = entrada + (self.saida_esperada(modelo, saida_maxima) if saida_maxima else 0)
+        for tentativa in Retrying(
+            retry=retry_if_exception(erro_transitorio),
+            wait=self._espera_retry,
+            stop=stop_after_attempt(self.tentativas),
+            reraise=True,
+        ):
+            with tentativa:
+                self.acquire(modelo, tokens, nivel)
+                try:
+                    resultado = funcao(*args, **kwargs)
+                except Exception as e:
+                    if _status_http(e) == 429:
+                        self.penalizar(modelo)
+                    raise
+                usados = tokens_usados(resultado) if tokens_usados else None
+                if usados is not None:
+                    self.ajustar(modelo, tokens, usados)
+                    if saida_maxima:
+                        self.registrar_saida(modelo, usados - entrada)
+                return resultado
+
+
+def mesclar_limites(limites=None):
+    """
+    Limites dos modelos de `limites`, com cada chave aplicada sobre LIMITES_PADRAO.
+
+    Uma configuração parcial como {"gpt-4o": {"tpm": 100000}} mantém o rpm padrão do modelo; num
+    modelo sem padrão, a dimensão não configurada fica sem limite. Modelos fora de `limites` não
+    têm cota controlada (só as novas tentativas em erros transitórios).
+    """
+    return {
+        nome: {"rpm": SEM_LIMITE, "tpm": SEM_LIMITE, **LIMITES_PADRAO.get(nome, {}), **valores}
+        for nome, valores in (limites or {}).items()
+    }
+
+
+class _SemLimite:
+    """Substituto quando RATE_LIMITS_ENABLED está desligado: chama a função diretamente."""
+
+    def acquire(self, modelo, tokens, nivel=None):
+        return None
+
+    def ajustar(self, modelo, reservados, usados):
+        return None
+
+    def saida_esperada(self, modelo, maxima):
+        return maxima
+
+    def registrar_saida(self, modelo, tokens_saida):
+        return None
+
+    def executar(self, modelo, funcao, *args, tokens=0, saida_maxima=0, nivel=None, tokens_usados=None, **kwargs):
+        return funcao(*args, **kwargs)
+
+
+_limiter = None
+_limiter_lock = threading.Lock()
+
+
+def _cota_compartilhada():
+    """CotaCompartilhada em RATE_LIMITS_DB, ou None se RATE_LIMITS_COMPARTILHADO estiver desligado ou o arquivo falhar."""
+    if not get_setting("RATE_LIMITS_COMPARTILHADO", True):
+        return None
+    try:
+        return CotaCompartilhada(get_setting("RATE_LIMITS_DB", os.path.join(".cache", "rate_limits.sqlite")))
+    except Exception as e:
+        print(f"ERRO ABRINDO COTA COMPARTILHADA (seguindo com a cota do processo): {e}")
+        return None
+
+
+def get_rate_limiter():
+    """
+    Retorna o escalonador do processo (limites da configuração RATE_LIMITS, em dict ou JSON).
+
+    Sem RATE_LIMITS, nenhum modelo tem cota controlada: as chamadas saem direto e só os erros
+    transitórios são repetidos. Com limites configurados, a cota fica em RATE_LIMITS_DB e é dividida
+    com os outros processos (app, batch_cli e ingestão) em vez de cada um supor a cota inteira da conta.
+    """
+    global _limiter
+    with _limiter_lock:
+        if _limiter is None:
+            if not get_setting("RATE_LIMITS_ENABLED", True):
+                _limiter = _SemLimite()
+            else:
+                limites = get_setting("RATE_LIMITS")
+                if isinstance(limites, str):
+                    limites = json.loads(limites)
+                _limiter = RateLimiter(
+                    {nome: dict(valores) for nome, valores in (limites or {}).items()},
+                    tentativas=get_setting("RATE_LIMIT_TENTATIVAS", 6),
+                    compartilhada=_cota_compartilhada() if limites else None,
+                )
+        return _limiter
+
+
+def _total_usage(resposta):
+    uso = resposta.get("usage") if isinstance(resposta, dict) else getattr(resposta, "usage", None)
+    if not uso:
+        return None
+    return uso.get("total_tokens") if isinstance(uso, dict) else getattr(uso, "total_tokens", None)
+
+
+def lm_openai(model, **kwargs):
+    """
+    dspy.OpenAI cujas requisições passam pelo escalonador.
+
+    Substitui o `request` da instância (que no dsp já tem backoff próprio) para que novas tentativas
+    e esperas fiquem só a cargo do RateLimiter.
+    """
+    import dspy
+
+    lm = dspy.OpenAI(model=model, **kwargs)
+
+    def request(prompt, **parametros):
+        parametros.pop("model_type", None)
+        max_tokens = parametros.get("max_tokens", lm.kwargs.get("max_tokens", 0))
+        return get_rate_limiter().executar(
+            model, lm.basic_request, prompt,
+            tokens=contar_tokens(prompt, model),
+            saida_maxima=max_tokens,
+            tokens_usados=_total_usage,
+            **parametros,
+        )
+
+    lm.request = request
+    return lm
+
+
+def rate_limiter_langchain(modelo, tokens_por_chamada=4000):
+    """Adaptador para o `rate_limiter` dos chat models do LangChain (cada chamada reserva `tokens_por_chamada`)."""
+    import asyncio
+
+    from langchain_core.rate_limiters import BaseRateLimiter
+
+    class _Adaptador(BaseRateLimiter):
+        def __init__(self, nivel):
+            self.nivel = nivel
+
+        def acquire(self, *, blocking=True):
+            get_rate_limiter().acquire(modelo, tokens_por_chamada, self.nivel)
+            return True
+
+        async def aacquire(self, *, blocking=True):
+            return await asyncio.to_thread(self.acquire, blocking=blocking)
+
+    # O agente roda em threads próprias do LangChain: a prioridade é fixada na criação
+    return _Adaptador(prioridade_atual())
@@ -0,0 +1,116 @@
+import sys
+import threading
+
+import pandas as pd
+
+
+class ResultStore:
+    """
+    Armazena os resultados de uma sessão em colunas (uma lista de valores por coluna), só por acréscimo.
+
+    O ID de cada linha é a sua posição de inserção e nunca é reaproveitado: edições sobrescrevem o
+    valor na própria coluna e exclusões só marcam a linha como removida. Cada alteração incrementa
+    `versao`, que serve de chave para os caches da interface (DataFrame completo, Excel).
+    """
+
+    def __init__(self):
+        self._colunas = {}
+        self._vivas = []
+        self._total = 0
+        self._posicoes = []
+        self._lock = threading.Lock()
+        self._cache = {}
+        self.versao = 0
+
+    def __len__(self):
+        return len(self._posicoes)
+
+    def append(self, df):
+        """
+        Acrescenta as linhas de `df` (colunas novas são preenchidas com "" nas linhas anteriores).
+
+        Retorna:
+        list: IDs atribuídos às novas linhas.
+        """
+        registros = df.fillna("").astype(str)
+        with self._lock:
+            for coluna in registros.columns:
+                if coluna not in self._colunas:
+                    self._colunas[coluna] = [""] * self._total
+            quantidade = len(registros)
+            for coluna, valores in self._colunas.items():
+                if coluna in registros.columns:
+                    valores.extend(registros[coluna].tolist())
+                else:
+                    valores.extend([""] * quantidade)
+            ids = list(range(self._total, self._total + quantidade))
+            self._total += quantidade
+            self._vivas.extend([True] * quantidade)
+            self._posicoes.extend(ids)
+            self._alterado()
+        return ids
+
+    def aplicar(self, editadas, excluidas):
+        """
+        Aplica em lote edições e exclusões endereçadas pelo ID da linha; o custo depende só das linhas alteradas.
+
+        Parâmetros:
+        editadas (dict): {id: {coluna: valor}}.
+        excluidas (set): IDs das linhas a remover.
+        """
+        with self._lock:
+            for row_id, campos in editadas.items():
+                if row_id in excluidas or not self._vivas[row_id]:
+                    continue
+                for coluna, valor in campos.items():
+                    self._colunas[coluna][row_id] = "" if valor is None else str(valor)
+            if excluidas:
+                for row_id in excluidas:
+                    self._vivas[row_id] = False
+                self._posicoes = [posicao for posicao in self._posicoes if self._vivas[posicao]]
+            self._alterado()
+
+    def pagina(self, inicio, tamanho):
+        """DataFrame só com as linhas ativas de `inicio` a `inicio + tamanho`, indexado pelos IDs."""
+        with self._lock:
+            ids = self._posicoes[inicio:inicio + tamanho]
+            return pd.DataFrame(
+                {coluna: [valores[row_id] for row_id in ids] for coluna, valores in self._colunas.items()},
+                index=ids,
+            )
+
+    def to_frame(self):
+        """DataFrame com todas as linhas ativas (montado uma vez por versão)."""
+        with self._lock:
+            if "frame" not in self._cache:
+                ids = self._posicoes
+                self._cache["frame"] = pd.DataFrame(
+                    {coluna: [valores[row_id] for row_id in ids] for coluna, valores in self._colunas.items()},
+                    index=ids,
+                )
+            return self._cache["frame"]
+
+    def stats(self):
+        """
+        Uso de memória aproximado (listas e strings armazenadas), calculado uma vez por versão.
+
+        Retorna:
+        dict: linhas ativas, linhas excluídas, colunas, bytes e versão.
+        """
+        with self._lock:
+            if "stats" not in self._cache:
+                tamanho = sys.getsizeof(self._vivas) + sys.getsizeof(self._posicoes)
+                for valores in self._colunas.values():
+                    tamanho += sys.getsizeof(valores) + sum(sys.getsizeof(valor) for valor in valores)
+                self._cache["stats"] = {
+                    "linhas": len(self._posicoes),
+                    "linhas_excluidas": self._total - len(self._posicoes),
+                    "colunas": len(self._colunas),
+                    "bytes": tamanho,
+                    "versao": self.versao,
+                }
+            return dict(self._cache["stats"])
+
+    def _alterado(self):
+        self.versao += 1
+        self._cache = {}
@@ -0,0 +1,35 @@
+import os
+from dotenv import load_dotenv
+import streamlit as st
+
+load_dotenv()
+
+
+def get_setting(nome, padrao=None):
+    """
+    Lê uma configuração opcional, priorizando variáveis de ambiente e depois o st.secrets.
+
+    Parâmetros:
+    nome (str): Nome da configuração.
+    padrao: Valor retornado quando a configuração não existe.
+
+    Retorna:
+    O valor encontrado (convertido para o tipo de `padrao` quando possível) ou `padrao`.
+    """
+    valor = os.environ.get(nome)
+    if valor is None:
+        try:
+            valor = st.secrets.get(nome)
+        except Exception:
+            # Sem secrets.toml (execução offline / linha de comando)
+            valor = None
+    if valor is None:
+        return padrao
+    if isinstance(padrao, bool) and isinstance(valor, str):
+        return valor.strip().lower() in ("1", "true", "sim", "yes", "on")
+    if isinstance(padrao, (int, float)) and not isinstance(padrao, bool) and isinstance(valor, str):
+        try:
+            return type(padrao)(valor)
+        except ValueError:
+            return padrao
+    return valor
@@ -0,0 +1,40 @@
+import os
+import sys
+
+# Os testes rodam sem rede: a chave só precisa existir para os módulos do pipeline importarem
+os.environ.setdefault("OPENAI_API_KEY", "sk-testes-offline")
+os.environ["RETRIEVER_BACKEND"] = "faiss"
+os.environ["ANSWER_CACHE_ENABLED"] = "0"
+os.environ["TRACING_EXPORTER"] = "none"
+os.environ["RATE_LIMITS_ENABLED"] = "0"
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pandas as pd
+import pytest
+
+import benchmark
+from base_loader import COLUNAS_BASE
+from client_pool import OportuneRAGClientPool, set_client_pool
+from embeddings import StubEmbedder
+from faiss_rm import construir_indice
+
+
+@pytest.fixture
+def indice_offline(tmp_path):
+    """Pasta com um índice FAISS de 12 linhas sintéticas da base, gerado com o StubEmbedder."""
+    base = pd.DataFrame([
+        {coluna: f"{coluna} {linha}" for coluna in COLUNAS_BASE} for linha in range(12)
+    ])
+    pasta = str(tmp_path / "indice")
+    construir_indice(base, StubEmbedder(), pasta)
+    return pasta
+
+
+@pytest.fixture
+def pool_offline(indice_offline):
+    """Pool do processo com um ClienteOffline sobre o índice de testes; retorna o StubLM usado."""
+    lm = benchmark.StubLM(latencia=0, oportunidades=3)
+    set_client_pool(OportuneRAGClientPool(tamanho=1, factory=lambda: benchmark.ClienteOffline(lm, indice_offline)))
+    yield lm
+    set_client_pool(None)
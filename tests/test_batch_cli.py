@@ -0,0 +1,53 @@
+import pandas as pd
+import pytest
+
+import batch_cli
+import benchmark
+from transform_input_to_df import COLUNAS
+
+
+@pytest.fixture
+def entrada(tmp_path):
+    caminho = tmp_path / "diagnosticos.csv"
+    pd.DataFrame([
+        {**benchmark.CAMPOS_BENCHMARK, "direcionadores": direcao}
+        for direcao in ["Automação", "Qualidade", "Compliance"]
+    ]).to_csv(caminho, index=False)
+    return str(caminho)
+
+
+def test_checkpoint_nao_e_reaproveitado_com_outro_modo(pool_offline, entrada, tmp_path):
+    saida = str(tmp_path / "saida.xlsx")
+
+    primeira = batch_cli.executar_lote(entrada, saida, concorrencia=1, modo="texto", usar_cache=False)
+    mesma = batch_cli.executar_lote(entrada, saida, concorrencia=1, modo="texto", usar_cache=False)
+    outro_modo = batch_cli.executar_lote(entrada, saida, concorrencia=1, modo="estruturado", usar_cache=False)
+
+    assert primeira["concluidas"] == 3
+    assert mesma["puladas"] == 3
+    assert outro_modo["puladas"] == 0 and outro_modo["concluidas"] == 3
+
+
+def test_planilha_gravada_a_cada_n_diagnosticos(pool_offline, entrada, tmp_path, monkeypatch):
+    gravacoes = []
+    original = batch_cli.gravar_planilha
+
+    def gravar(df, saida):
+        gravacoes.append(len(df))
+        original(df, saida)
+
+    monkeypatch.setattr(batch_cli, "gravar_planilha", gravar)
+    saida = str(tmp_path / "saida.xlsx")
+
+    batch_cli.executar_lote(entrada, saida, concorrencia=1, modo="texto", usar_cache=False, gravar_a_cada=2)
+
+    assert len(gravacoes) == 2
+    assert len(pd.read_excel(saida)) == 9
+
+
+def test_planilha_com_as_colunas_da_exportacao_do_app(pool_offline, entrada, tmp_path):
+    saida = str(tmp_path / "saida.xlsx")
+
+    batch_cli.executar_lote(entrada, saida, concorrencia=1, modo="texto", usar_cache=False)
+
+    assert list(pd.read_excel(saida).columns) == COLUNAS + ["Direcionador"]
@@ -0,0 +1,36 @@
+import threading
+
+import pytest
+
+from client_pool import OportuneRAGClientPool
+
+
+class ClienteFalso:
+    def close_weaviate_client(self):
+        pass
+
+
+def test_close_acorda_quem_espera_um_cliente():
+    pool = OportuneRAGClientPool(tamanho=1, factory=ClienteFalso)
+    erros = []
+
+    def esperar():
+        try:
+            with pool.lease():
+                pass
+        except RuntimeError as e:
+            erros.append(e)
+
+    with pool.lease():
+        esperando = [threading.Thread(target=esperar) for _ in range(2)]
+        for thread in esperando:
+            thread.start()
+        pool.close()
+        for thread in esperando:
+            thread.join(timeout=2)
+
+    assert not any(thread.is_alive() for thread in esperando)
+    assert len(erros) == 2
+    with pytest.raises(RuntimeError):
+        with pool.lease():
+            pass
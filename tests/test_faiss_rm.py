@@ -0,0 +1,9 @@
+from embeddings import StubEmbedder
+from faiss_rm import FaissRM
+
+
+def test_indice_e_mapeado_do_arquivo(indice_offline):
+    rm = FaissRM(indice_offline, embedder=StubEmbedder(), k=3)
+
+    assert rm.mapeado
+    assert len(rm("ramo_empresa: SEGMENTO_MERCADO 1")) == 3
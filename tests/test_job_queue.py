@@ -0,0 +1,69 @@
+import sqlite3
+import time
+
+import pandas as pd
+
+from job_queue import CONCLUIDO, JobQueue
+
+
+def esperar(fila, job_id, timeout=5):
+    limite = time.monotonic() + timeout
+    while time.monotonic() < limite:
+        job = fila.get(job_id)
+        if job["status"] == CONCLUIDO:
+            return job
+        time.sleep(0.02)
+    raise AssertionError(f"Job {job_id} não terminou")
+
+
+def test_progresso_gravado_por_intervalo_e_ao_fim(tmp_path, monkeypatch):
+    def handler(payload, reportar):
+        progresso = {"eventos": 0}
+        for _ in range(50):
+            progresso["eventos"] += 1
+            reportar(progresso)
+        return pd.DataFrame([{"Direcionador": "Automação"}])
+
+    fila = JobQueue(str(tmp_path / "jobs.sqlite"), {"diagnostico": handler}, workers=1, intervalo_poll=0.01,
+                    intervalo_progresso=60)
+    gravacoes = []
+    atualizar = fila._atualizar
+    monkeypatch.setattr(fila, "_atualizar", lambda job_id, **campos: gravacoes.append(campos) or atualizar(job_id, **campos))
+    fila.start()
+    try:
+        job = esperar(fila, fila.submit("diagnostico", {}))
+    finally:
+        fila.stop()
+
+    assert sum("progresso" in campos for campos in gravacoes) == 2
+    assert job["progresso"] == {"eventos": 50}
+
+
+def test_jobs_terminados_expiram(tmp_path):
+    fila = JobQueue(str(tmp_path / "jobs.sqlite"), {"diagnostico": lambda payload, reportar: None}, workers=1,
+                    intervalo_poll=0.01, ttl_segundos=0.2)
+    fila.start()
+    try:
+        job_id = fila.submit("diagnostico", {})
+        esperar(fila, job_id)
+        # A thread de trabalho ociosa faz a limpeza periódica
+        time.sleep(0.5)
+
+        assert fila.get(job_id) is None
+    finally:
+        fila.stop()
+
+
+def test_worker_sobrevive_a_erro_ao_buscar_job(tmp_path, monkeypatch):
+    fila = JobQueue(str(tmp_path / "jobs.sqlite"), {"diagnostico": lambda payload, reportar: None}, workers=1,
+                    intervalo_poll=0.01)
+    falhas = [sqlite3.OperationalError("database is locked")] * 2
+    claim = fila._claim
+    monkeypatch.setattr(fila, "_claim", lambda: (_ for _ in ()).throw(falhas.pop()) if falhas else claim())
+    fila.start()
+    try:
+        job = esperar(fila, fila.submit("diagnostico", {}))
+    finally:
+        fila.stop()
+
+    assert not falhas and job["status"] == CONCLUIDO
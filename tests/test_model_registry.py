@@ -0,0 +1,25 @@
+import os
+import shutil
+
+from model_registry import MODELO_PADRAO, ModelRegistry
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_arquivo_invalido_nao_e_relido_ate_mudar(tmp_path, monkeypatch, capsys):
+    caminho = str(tmp_path / "modelo.json")
+    shutil.copy(os.path.join(RAIZ, MODELO_PADRAO), caminho)
+    registro = ModelRegistry(caminho)
+    hash_anterior, modelo_anterior = registro.get()
+
+    with open(caminho, "w", encoding="utf-8") as f:
+        f.write("{ json incompleto")
+    leituras = []
+    abrir = open
+    monkeypatch.setattr("builtins.open", lambda *args, **kwargs: leituras.append(args[0]) or abrir(*args, **kwargs))
+
+    for _ in range(3):
+        assert registro.get() == (hash_anterior, modelo_anterior)
+
+    assert leituras.count(caminho) == 1
+    assert capsys.readouterr().out.count("ERRO CARREGANDO MODELO") == 1
@@ -0,0 +1,27 @@
+import pandas as pd
+
+import benchmark
+from process import montar_prompt, run_agent_analysis
+from transform_input_to_df import COLUNAS
+
+
+def test_modo_estruturado_de_ponta_a_ponta(pool_offline):
+    prompt = montar_prompt(direcao="Automação", **benchmark.CAMPOS_BENCHMARK)
+
+    resultado = run_agent_analysis(prompt, modo="estruturado", usar_cache=False)
+
+    assert isinstance(resultado, pd.DataFrame)
+    assert list(resultado.columns) == COLUNAS
+    assert len(resultado) == 3
+    assert resultado["Oportunidade de Melhoria"].str.startswith("Oportunidade").all()
+    # As passagens recuperadas chegam ao prompt como texto numerado
+    assert "[1] «" in pool_offline.history[-1]["prompt"]
+
+
+def test_modo_estruturado_respeita_max_tokens(pool_offline, indice_offline):
+    cliente = benchmark.ClienteOffline(pool_offline, indice_offline)
+
+    registros = cliente.run_model("ramo_empresa: Varejo", modo="estruturado", usar_cache=False, max_tokens=512)
+
+    assert len(registros) == 3
+    assert pool_offline.history[-1]["kwargs"]["max_tokens"] == 512
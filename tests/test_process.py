@@ -0,0 +1,13 @@
+from process import dividir_por_direcionador
+
+
+def test_rotulo_desconhecido_nao_fica_com_o_proximo_direcionador():
+    texto = (
+        "**Direcionador** : Automação\nOportunidade A\n\n"
+        "**Direcionador** : Sustentabilidade\nOportunidade B\n\n"
+        "**Direcionador** : qualidade\nOportunidade C"
+    )
+
+    blocos = dividir_por_direcionador(texto, ["Automação", "Compliance", "Qualidade"])
+
+    assert blocos == {"Automação": "Oportunidade A", "Qualidade": "Oportunidade C"}
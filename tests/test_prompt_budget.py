@@ -0,0 +1,30 @@
+import logging
+
+from dspy_DocsOportune import OportuneRAG
+from prompt_budget import ajustar_prompt
+
+DEMOS = [
+    {"question": f"ramo_empresa: Varejo, direcionadores: Automação {i}", "context": ["c"], "answer": "resposta " * 50}
+    for i in range(5)
+]
+PASSAGENS = ["passagem longa " * 400 for _ in range(5)]
+
+
+def test_sem_orcamento_mantem_demos_e_passagens_do_programa_compilado(monkeypatch):
+    monkeypatch.delenv("PROMPT_BUDGET_TOKENS", raising=False)
+    signature = OportuneRAG().generate_answer.extended_signature
+
+    ajustado = ajustar_prompt(signature, DEMOS, "ramo_empresa: Varejo", PASSAGENS)
+
+    assert ajustado.demos is None
+    assert ajustado.context == PASSAGENS
+
+
+def test_corte_pelo_orcamento_e_registrado(caplog):
+    signature = OportuneRAG().generate_answer.extended_signature
+
+    with caplog.at_level(logging.INFO, logger="prompt_budget"):
+        ajustado = ajustar_prompt(signature, DEMOS, "ramo_empresa: Varejo", PASSAGENS, limite_tokens=3000)
+
+    assert ajustado.relatorio["passagens_truncadas"] or len(ajustado.context) < len(PASSAGENS)
+    assert "Orçamento de 3000 tokens" in caplog.text
@@ -0,0 +1,83 @@
+import threading
+import time
+
+from rate_limiter import INTERATIVO, LOTE, CotaCompartilhada, RateLimiter
+
+LIMITES = {"gpt-4o": {"rpm": 10000, "tpm": 60000}}
+
+
+def processos(tmp_path, quantidade):
+    """Escalonadores independentes sobre o mesmo arquivo, como os do app e do batch_cli."""
+    caminho = str(tmp_path / "rate_limits.sqlite")
+    return [RateLimiter(LIMITES, compartilhada=CotaCompartilhada(caminho)) for _ in range(quantidade)]
+
+
+def test_cota_dividida_entre_processos(tmp_path):
+    app, lote = processos(tmp_path, 2)
+    app.acquire("gpt-4o", 60000)
+
+    inicio = time.monotonic()
+    lote.acquire("gpt-4o", 300)
+
+    # 300 tokens a 1000 tokens/s: o lote espera a cota que o app consumiu
+    assert time.monotonic() - inicio >= 0.2
+
+
+def test_lote_cede_a_vez_ao_interativo_de_outro_processo(tmp_path):
+    app, lote = processos(tmp_path, 2)
+    app.acquire("gpt-4o", 60000)
+    concluidas = []
+
+    def chamar(limiter, tokens, nivel):
+        limiter.acquire("gpt-4o", tokens, nivel)
+        concluidas.append(nivel)
+
+    interativo = threading.Thread(target=chamar, args=(app, 300, INTERATIVO))
+    interativo.start()
+    time.sleep(0.05)
+    chamar(lote, 10, LOTE)
+    interativo.join()
+
+    assert concluidas == [INTERATIVO, LOTE]
+
+
+def test_limites_parciais_mantem_os_padroes_do_modelo():
+    limiter = RateLimiter({"gpt-4o": {"tpm": 100000}, "gpt-4-turbo": {"rpm": 100}})
+
+    limiter.acquire("gpt-4o", 10)
+    limiter.acquire("gpt-4-turbo", 10)
+
+    assert limiter.limites["gpt-4o"] == {"rpm": 500, "tpm": 100000}
+
+
+def test_limites_parciais_com_cota_compartilhada(tmp_path):
+    limiter = RateLimiter({"gpt-4o": {"tpm": 100000}},
+                          compartilhada=CotaCompartilhada(str(tmp_path / "rate_limits.sqlite")))
+
+    limiter.acquire("gpt-4o", 10)
+    limiter.ajustar("gpt-4o", 10, 5)
+
+
+def test_sem_rate_limits_nenhum_modelo_tem_cota():
+    limiter = RateLimiter()
+
+    inicio = time.monotonic()
+    for _ in range(5):
+        limiter.acquire("gpt-4o", 100000)
+
+    assert limiter.limites == {}
+    assert time.monotonic() - inicio < 0.5
+
+
+def test_reserva_a_saida_esperada_e_nao_o_maximo():
+    limiter = RateLimiter(LIMITES)
+    reservas = []
+    limiter.ajustar = lambda modelo, reservados, usados: reservas.append(reservados)
+
+    for _ in range(3):
+        limiter.executar("gpt-4o", lambda: {"usage": {"total_tokens": 1200}}, tokens=1000, saida_maxima=2048,
+                         tokens_usados=lambda resposta: resposta["usage"]["total_tokens"])
+
+    # Antes de observar: metade do máximo; depois: a média observada (200) com folga
+    assert reservas[0] == 1000 + 1024
+    assert reservas[-1] == 1000 + 251
@@ -0,0 +1,49 @@
+import pytest
+
+import benchmark
+from answer_cache import AnswerCache
+from process import montar_prompt
+
+
+@pytest.fixture
+def cliente(indice_offline, tmp_path):
+    cliente = benchmark.ClienteOffline(benchmark.StubLM(latencia=0, oportunidades=3), indice_offline)
+    cliente.cache = AnswerCache(str(tmp_path / "respostas.sqlite"))
+    return cliente
+
+
+def test_stream_envia_o_prompt_do_modelo_compilado(cliente):
+    prompt = montar_prompt(direcao="Automação", **benchmark.CAMPOS_BENCHMARK)
+
+    resposta = cliente.run_model(prompt, usar_cache=False)
+    prompt_compilado = cliente._lm.history[-1]["prompt"]
+    trechos = list(cliente.run_model_stream(prompt, usar_cache=False))
+
+    assert cliente._lm.history[-1]["prompt"] == prompt_compilado
+    assert "Reasoning: Let's think step by step" in prompt_compilado
+    # O raciocínio fica de fora: o stream entrega só o campo answer, igual ao run_model
+    assert "".join(trechos).strip() == resposta
+
+
+def test_stream_e_run_model_nao_dividem_a_chave_do_cache(cliente):
+    prompt = montar_prompt(direcao="Automação", **benchmark.CAMPOS_BENCHMARK)
+
+    em_stream = "".join(cliente.run_model_stream(prompt))
+    chamadas = len(cliente._lm.history)
+    resposta = cliente.run_model(prompt)
+
+    assert len(cliente._lm.history) == chamadas + 1
+    assert resposta == em_stream.strip()
+    assert list(cliente.run_model_stream(prompt)) == [em_stream.strip()]
+
+
+def test_acerto_no_cache_nao_chama_o_retriever(cliente, monkeypatch):
+    prompt = montar_prompt(direcao="Automação", **benchmark.CAMPOS_BENCHMARK)
+    resposta = cliente.run_model(prompt)
+    em_stream = "".join(cliente.run_model_stream(prompt))
+    recuperacoes = []
+    monkeypatch.setattr(cliente, "recuperar", lambda *args: recuperacoes.append(args) or [])
+
+    assert cliente.run_model(prompt) == resposta
+    assert list(cliente.run_model_stream(prompt)) == [em_stream.strip()]
+    assert recuperacoes == []
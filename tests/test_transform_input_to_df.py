@@ -0,0 +1,32 @@
+from transform_input_to_df import COLUNAS, OportuneStreamParser, parse_oportune_answer
+
+
+def _oportunidade(numero):
+    return (
+        f"**Oportunidade de Melhoria** : Oportunidade {numero}\n\n"
+        f"**Solução** : Solução {numero}\n\n"
+        f"**Backlog de Atividades:** - Atividade {numero}\n\n"
+        f"**Investimento** : {numero * 10} horas\n\n"
+        f"**Ganhos:** Ganho {numero}\n\n"
+    )
+
+
+def test_titulo_de_secao_nao_gera_registro_vazio():
+    resposta = "**Oportunidades de Melhoria:**\n\n" + "".join(_oportunidade(i) for i in range(1, 11))
+
+    registros, confianca = parse_oportune_answer(resposta)
+
+    assert len(registros) == 10
+    assert confianca == 1.0
+    assert registros[0]["Oportunidade de Melhoria"] == "Oportunidade 1"
+    assert all(all(registro[coluna] for coluna in COLUNAS) for registro in registros)
+
+
+def test_stream_ignora_titulo_de_secao():
+    parser = OportuneStreamParser()
+    emitidos = []
+    for trecho in ["**Oportunidades de Melhoria:**\n\n", _oportunidade(1), _oportunidade(2)]:
+        emitidos.extend(parser.feed(trecho))
+    emitidos.extend(parser.close())
+
+    assert [registro["Oportunidade de Melhoria"] for registro in emitidos] == ["Oportunidade 1", "Oportunidade 2"]
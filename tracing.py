@@ -0,0 +1,231 @@
+import contextvars
+import json
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import lru_cache
+
+from settings import get_setting
+
+# Preço em US$ por 1M de tokens (entrada, saída); modelos fora da tabela ficam sem custo estimado
+PRECOS_POR_MILHAO = {
+    "gpt-4o": (2.50, 10.00),
+    "gpt-4o-mini": (0.15, 0.60),
+    "text-embedding-ada-002": (0.10, 0.0),
+    "text-embedding-3-small": (0.02, 0.0),
+}
+
+_span_atual = contextvars.ContextVar("span_atual", default=None)
+
+
+@lru_cache(maxsize=8)
+def encoding_do_modelo(modelo):
+    """Tokenizer tiktoken do modelo (o200k_base para modelos desconhecidos)."""
+    import tiktoken
+
+    try:
+        return tiktoken.encoding_for_model(modelo)
+    except KeyError:
+        return tiktoken.get_encoding("o200k_base")
+
+
+def contar_tokens(texto, modelo="gpt-4o"):
+    """Quantidade de tokens de `texto` segundo o tokenizer do `modelo` (tiktoken)."""
+    if not texto:
+        return 0
+    return len(encoding_do_modelo(modelo).encode(texto, disallowed_special=()))
+
+
+def estimar_custo(modelo, tokens_prompt, tokens_completion):
+    """Custo estimado em US$, ou None se o modelo não estiver em PRECOS_POR_MILHAO."""
+    precos = next((PRECOS_POR_MILHAO[nome] for nome in sorted(PRECOS_POR_MILHAO, key=len, reverse=True)
+                   if modelo and modelo.startswith(nome)), None)
+    if precos is None:
+        return None
+    return (tokens_prompt * precos[0] + tokens_completion * precos[1]) / 1_000_000
+
+
+class Span:
+    """Uma etapa medida do pipeline: duração, atributos, tokens e custo estimado."""
+
+    def __init__(self, nome, trace_id, parent_id=None, atributos=None):
+        self.nome = nome
+        self.trace_id = trace_id
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent_id
+        self.atributos = dict(atributos or {})
+        self.tokens_prompt = 0
+        self.tokens_completion = 0
+        self.custo_usd = None
+        self.erro = None
+        self.inicio = time.time()
+        self._inicio_perf = time.perf_counter()
+        self.duracao_ms = None
+
+    def set(self, **atributos):
+        self.atributos.update(atributos)
+
+    def registrar_tokens(self, modelo, tokens_prompt, tokens_completion):
+        """Acumula tokens de uma chamada ao modelo e soma o custo estimado."""
+        self.tokens_prompt += tokens_prompt
+        self.tokens_completion += tokens_completion
+        custo = estimar_custo(modelo, tokens_prompt, tokens_completion)
+        if custo is not None:
+            self.custo_usd = (self.custo_usd or 0.0) + custo
+        self.atributos.setdefault("modelo", modelo)
+
+    def to_dict(self):
+        return {
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "nome": self.nome,
+            "inicio": self.inicio,
+            "duracao_ms": self.duracao_ms,
+            "tokens_prompt": self.tokens_prompt,
+            "tokens_completion": self.tokens_completion,
+            "custo_usd": self.custo_usd,
+            "erro": self.erro,
+            "atributos": self.atributos,
+        }
+
+
+class JsonlExporter:
+    """Grava cada span finalizado como uma linha JSON (exportador padrão)."""
+
+    def __init__(self, caminho):
+        self.caminho = caminho
+        self._lock = threading.Lock()
+        pasta = os.path.dirname(caminho)
+        if pasta:
+            os.makedirs(pasta, exist_ok=True)
+
+    def export(self, span):
+        linha = json.dumps(span, ensure_ascii=False, default=str)
+        with self._lock, open(self.caminho, "a", encoding="utf-8") as f:
+            f.write(linha + "\n")
+
+
+class MemoryExporter:
+    """Mantém os spans dos últimos `max_traces` traces em memória, para o painel de diagnóstico."""
+
+    def __init__(self, max_traces=50):
+        self.max_traces = max_traces
+        self._traces = OrderedDict()
+        self._lock = threading.Lock()
+
+    def export(self, span):
+        with self._lock:
+            self._traces.setdefault(span["trace_id"], []).append(span)
+            self._traces.move_to_end(span["trace_id"])
+            while len(self._traces) > self.max_traces:
+                self._traces.popitem(last=False)
+
+    def spans(self, trace_id):
+        with self._lock:
+            return list(self._traces.get(trace_id, []))
+
+
+_exporters = None
+_memoria = MemoryExporter()
+_exporters_lock = threading.Lock()
+
+
+def get_exporters():
+    """Exportadores ativos: JSONL (configuração TRACE_PATH; TRACING_EXPORTER=none desliga) e memória."""
+    global _exporters
+    with _exporters_lock:
+        if _exporters is None:
+            _exporters = [_memoria]
+            if get_setting("TRACING_EXPORTER", "jsonl") == "jsonl":
+                _exporters.append(JsonlExporter(get_setting("TRACE_PATH", os.path.join(".cache", "traces.jsonl"))))
+        return list(_exporters)
+
+
+def add_exporter(exporter):
+    """Registra outro destino para os spans (qualquer objeto com `export(dict)`)."""
+    get_exporters()
+    with _exporters_lock:
+        _exporters.append(exporter)
+
+
+def spans_do_trace(trace_id):
+    """Spans já finalizados de um trace deste processo (mais recentes ficam em memória)."""
+    return _memoria.spans(trace_id)
+
+
+@contextmanager
+def span(nome, **atributos):
+    """
+    Mede o bloco como um span filho do span atual (ou raiz de um novo trace) e o exporta ao final.
+
+    Exceções são registradas no campo `erro` do span e propagadas.
+    """
+    pai = _span_atual.get()
+    atual = Span(
+        nome,
+        trace_id=pai.trace_id if pai else uuid.uuid4().hex,
+        parent_id=pai.span_id if pai else None,
+        atributos=atributos,
+    )
+    token = _span_atual.set(atual)
+    try:
+        yield atual
+    except Exception as e:
+        atual.erro = str(e)
+        raise
+    finally:
+        _span_atual.reset(token)
+        atual.duracao_ms = (time.perf_counter() - atual._inicio_perf) * 1000
+        dados = atual.to_dict()
+        for exporter in get_exporters():
+            try:
+                exporter.export(dados)
+            except Exception as e:
+                print(f"ERRO AO EXPORTAR SPAN: {e}")
+
+
+def span_atual():
+    """Span ativo na thread/contexto atual, ou None."""
+    return _span_atual.get()
+
+
+def propagar(funcao):
+    """
+    Envolve `funcao` para rodar em outra thread como filha do span atual.
+
+    Use uma chamada por tarefa submetida (um mesmo contexto não pode rodar em duas threads ao mesmo tempo).
+    """
+    contexto = contextvars.copy_context()
+
+    def executar(*args, **kwargs):
+        return contexto.run(funcao, *args, **kwargs)
+
+    return executar
+
+
+def resumir_trace(spans):
+    """
+    Agrega os spans de um trace por nome de etapa.
+
+    Retorna:
+    list[dict]: etapa, chamadas, tempo total e máximo (ms), tokens de entrada/saída e custo (US$),
+    ordenadas pelo tempo total.
+    """
+    etapas = {}
+    for dados in spans:
+        etapa = etapas.setdefault(dados["nome"], {
+            "etapa": dados["nome"], "chamadas": 0, "total_ms": 0.0, "max_ms": 0.0,
+            "tokens_prompt": 0, "tokens_completion": 0, "custo_usd": 0.0, "erros": 0,
+        })
+        etapa["chamadas"] += 1
+        etapa["total_ms"] += dados["duracao_ms"] or 0.0
+        etapa["max_ms"] = max(etapa["max_ms"], dados["duracao_ms"] or 0.0)
+        etapa["tokens_prompt"] += dados["tokens_prompt"]
+        etapa["tokens_completion"] += dados["tokens_completion"]
+        etapa["custo_usd"] += dados["custo_usd"] or 0.0
+        etapa["erros"] += 1 if dados["erro"] else 0
+    return sorted(etapas.values(), key=lambda etapa: etapa["total_ms"], reverse=True)
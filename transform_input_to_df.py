@@ -1,6 +1,8 @@
 import pandas as pd
 import json
 import logging
+import re
+from functools import lru_cache
 from langchain_openai import ChatOpenAI
 from langchain.agents import initialize_agent, AgentType
 from langchain_experimental.tools import PythonREPLTool
@@ -8,13 +10,128 @@ from langchain.hub import pull as hub_pull
 from dotenv import load_dotenv
 import os
 import streamlit as st
+from settings import get_setting
+from rate_limiter import rate_limiter_langchain
+from tracing import span
 
 # Initialize logger
 logger = logging.getLogger(__name__)
 
 # Load OpenAI API key from environment variables
 load_dotenv()
-api_key = st.secrets["OPENAI_API_KEY"]
+api_key = get_setting("OPENAI_API_KEY")
+
+# Output columns, in the order produced by the Oportune signature
+COLUNAS = ["Oportunidade de Melhoria", "Solução", "Backlog de Atividades", "Investimento", "Ganhos"]
+
+# Minimum parser confidence to skip the ReAct agent fallback
+CONFIANCA_MINIMA = 0.8
+
+_ROTULOS = {
+    "oportunidade": "Oportunidade de Melhoria",
+    "solu": "Solução",
+    "backlog": "Backlog de Atividades",
+    "investimento": "Investimento",
+    "ganho": "Ganhos",
+}
+
+# A field label at the start of a line, e.g. "**Solução** :", "- **Solução:**", "3. Solução:",
+# "### Oportunidade de Melhoria 2:" or "**Backlog de Atividades**:"
+_RE_ROTULO = re.compile(
+    r"^[ \t>#*\-•]*(?:\d+[.)]\s*)?[ \t*]*"
+    r"(oportunidade(?:s)? de melhoria|solu[çc][ãa]o(?: proposta)?|backlog(?: de atividades)?|investimento(?: necess[áa]rio)?|ganhos?(?: esperados)?)"
+    r"(?:\s*\d+)?[ \t*]*:[ \t*]*",
+    re.IGNORECASE | re.MULTILINE,
+)
+
+def _limpar_valor(coluna, texto):
+    linhas = [linha.strip() for linha in texto.strip().splitlines()]
+    # Drop markdown separators and empty lines between sections
+    linhas = [linha for linha in linhas if linha and not re.fullmatch(r"[-*_=]{3,}", linha)]
+    if coluna == "Backlog de Atividades":
+        # Keep the activities as topics in the same cell
+        valor = "\n".join(linhas)
+    else:
+        valor = " ".join(linhas)
+    valor = valor.replace("**", "").strip()
+    if coluna == "Oportunidade de Melhoria":
+        valor = valor.rstrip(":").strip()
+    return valor
+
+def parse_oportune_answer(input_data):
+    """
+    Parse an answer in the Oportune signature format without calling an LLM.
+
+    Parameters:
+    input_data (str): Markdown answer with the five labelled sections per opportunity.
+
+    Returns:
+    tuple: (list of dicts with the COLUNAS keys, confidence between 0 and 1). The confidence
+    is the fraction of parsed opportunities with all five fields filled in. Records with every
+    field empty (e.g. a "**Oportunidades de Melhoria:**" heading before the items) are dropped.
+    """
+    if not isinstance(input_data, str) or not input_data.strip():
+        return [], 0.0
+
+    rotulos = list(_RE_ROTULO.finditer(input_data))
+    registros = []
+    atual = None
+    for i, match in enumerate(rotulos):
+        chave = match.group(1).lower()
+        coluna = next(col for prefixo, col in _ROTULOS.items() if chave.startswith(prefixo))
+        fim = rotulos[i + 1].start() if i + 1 < len(rotulos) else len(input_data)
+        valor = _limpar_valor(coluna, input_data[match.end():fim])
+        if coluna == "Oportunidade de Melhoria" or atual is None or atual.get(coluna):
+            atual = {col: "" for col in COLUNAS}
+            registros.append(atual)
+        atual[coluna] = valor
+
+    registros = [registro for registro in registros if any(registro.values())]
+    if not registros:
+        return [], 0.0
+    completos = sum(all(registro[col] for col in COLUNAS) for registro in registros)
+    return registros, completos / len(registros)
+
+class OportuneStreamParser:
+    """
+    Incremental version of parse_oportune_answer for streamed answers.
+
+    feed() returns the opportunities whose **Ganhos:** section is complete, i.e. followed by the
+    next opportunity or by a paragraph break; close() returns whatever is left at the end.
+    """
+
+    def __init__(self):
+        self.texto = ""
+        self.emitidos = 0
+
+    def feed(self, trecho):
+        self.texto += trecho or ""
+        # Sections only change at line breaks, so skip reparsing mid-line
+        if "\n" not in (trecho or ""):
+            return []
+        # Ignore the trailing partial line (it may be the start of the next label)
+        linhas_completas = self.texto[:self.texto.rfind("\n") + 1]
+        registros, _ = parse_oportune_answer(linhas_completas)
+        completos = registros[:-1]
+        if registros and registros[-1]["Ganhos"] and self._ganhos_encerrado(linhas_completas):
+            completos = registros
+        return self._novos(completos)
+
+    def close(self):
+        registros, _ = parse_oportune_answer(self.texto)
+        return self._novos(registros)
+
+    @staticmethod
+    def _ganhos_encerrado(texto):
+        ultimo = None
+        for match in _RE_ROTULO.finditer(texto):
+            ultimo = match
+        return ultimo is not None and "\n\n" in texto[ultimo.end():].lstrip(" \n")
+
+    def _novos(self, registros):
+        novos = registros[self.emitidos:]
+        self.emitidos = max(self.emitidos, len(registros))
+        return novos
 
 # Initialize LLM with specific settings
 def initialize_llm():
@@ -22,13 +139,20 @@ def initialize_llm():
         temperature=0.1,
         model="gpt-4o-mini",
         api_key=api_key,
+        rate_limiter=rate_limiter_langchain("gpt-4o-mini"),
+        max_retries=6,
         verbose=True
     )
 
+# The ReAct prompt is pulled from the hub once per process
+@lru_cache(maxsize=1)
+def _react_prompt_template():
+    return hub_pull("hwchase17/react")
+
 # Create ReAct agent
 def create_react_agent(llm):
     try:
-        react_prompt_template = hub_pull("hwchase17/react")
+        react_prompt_template = _react_prompt_template()
         tools = [PythonREPLTool()]
         agent = initialize_agent(
             tools,
@@ -45,7 +169,10 @@ def create_react_agent(llm):
 
 def transform_input_to_df(input_data):
     """
-    Transform input data into a pandas DataFrame using a ReAct agent.
+    Transform input data into a pandas DataFrame.
+
+    The answer is parsed locally with parse_oportune_answer; the ReAct agent only runs
+    as a fallback when the parser confidence is below CONFIANCA_MINIMA.
     
     Parameters:
     input_data (str): Input data in the specified format.
@@ -53,6 +180,14 @@ def transform_input_to_df(input_data):
     Returns:
     pandas.DataFrame: DataFrame with the transformed data.
     """
+    registros, confianca = parse_oportune_answer(input_data)
+    if registros and confianca >= CONFIANCA_MINIMA:
+        return pd.DataFrame(registros, columns=COLUNAS)
+    logger.info("Parser confidence %.2f below %.2f, falling back to ReAct agent", confianca, CONFIANCA_MINIMA)
+    return _transform_with_agent(input_data)
+
+def _transform_with_agent(input_data):
+    """Transform input data into a pandas DataFrame using a ReAct agent."""
     try:
         # Initialize LLM and ReAct agent
         llm = initialize_llm()
@@ -79,7 +214,11 @@ def transform_input_to_df(input_data):
         """
         
         # Run the agent to process the question and generate output
-        response = agent.run(question)
+        from langchain_community.callbacks import get_openai_callback
+
+        with span("transformacao.agente") as etapa, get_openai_callback() as uso:
+            response = agent.run(question)
+            etapa.registrar_tokens("gpt-4o-mini", uso.prompt_tokens, uso.completion_tokens)
         data = json.loads(response)
         df = pd.DataFrame(data)
         return df